@@ -515,6 +515,14 @@ preselect_first_completion = False
 # Asimov and Quasimodo, whereas the default behavior would match only Asimov.
 completion_mode = 'prefix'
 
+#: Use an index to speed up searching
+# calibre maintains an in-memory index of the values of text fields such as
+# tags, series, publisher and authors. It is used to speed up searches on
+# large libraries. Regular expression and case sensitive searches do not use
+# the index. If you are short on memory, you can turn the index off by setting
+# use_search_index = False
+use_search_index = True
+
 #: Recognize numbers inside text when sorting
 # This means that when sorting on text fields like title the text "Book 2"
 # will sort before the text "Book 100". If you want this behavior, set
@@ -68,14 +68,24 @@ def find_tests(which_tests=None):
         a(find_tests())
         from calibre.utils.shared_file import find_tests
         a(find_tests())
+        from calibre.utils.zipfile import find_tests
+        a(find_tests())
         from calibre.utils.test_lock import find_tests
         a(find_tests())
         from calibre.utils.search_query_parser_test import find_tests
         a(find_tests())
+        from calibre.utils.formatter_test import find_tests
+        a(find_tests())
+        from calibre.devices.usbms.test import find_tests
+        a(find_tests())
         from calibre.utils.html2text import find_tests
         a(find_tests())
         from calibre.library.comments import find_tests
         a(find_tests())
+        from calibre.ebooks.conversion.parallel import find_tests
+        a(find_tests())
+        from calibre.ebooks.oeb.tests.main import find_tests
+        a(find_tests())
     if ok('dbcli'):
         from calibre.db.cli.tests import find_tests
         a(find_tests())
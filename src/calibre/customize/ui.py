@@ -6,6 +6,7 @@ __copyright__ = '2008, Kovid Goyal <kovid at kovidgoyal.net>'
 import os, shutil, traceback, functools, sys
 from collections import defaultdict
 from itertools import chain
+from threading import Lock
 
 from calibre.customize import (CatalogPlugin, FileTypePlugin, PluginNotFound,
                               MetadataReaderPlugin, MetadataWriterPlugin,
@@ -371,14 +372,24 @@ def metadata_writers():
 
 class QuickMetadata(object):
 
+    # Counts active users so that it can be entered from several threads at
+    # once, for example when scanning a device for books
+
     def __init__(self):
-        self.quick = False
+        self.lock = Lock()
+        self.count = 0
+
+    @property
+    def quick(self):
+        return self.count > 0
 
     def __enter__(self):
-        self.quick = True
+        with self.lock:
+            self.count += 1
 
     def __exit__(self, *args):
-        self.quick = False
+        with self.lock:
+            self.count -= 1
 
 
 quick_metadata = QuickMetadata()
@@ -10,7 +10,7 @@ __docformat__ = 'restructuredtext en'
 import os, traceback, random, shutil, operator
 from io import BytesIO
 from collections import defaultdict, Set, MutableSet
-from functools import wraps, partial
+from functools import wraps, partial, reduce
 from polyglot.builtins import iteritems, itervalues, unicode_type, zip, string_or_bytes
 from time import time
 
@@ -19,12 +19,13 @@ from calibre.constants import iswindows, preferred_encoding
 from calibre.customize.ui import run_plugins_on_import, run_plugins_on_postimport, run_plugins_on_postadd
 from calibre.db import SPOOL_SIZE, _get_next_series_num_for_list
 from calibre.db.categories import get_categories
-from calibre.db.locking import create_locks, DowngradeLockError, SafeReadLock
+from calibre.db.locking import create_locks, DowngradeLockError, SafeReadLock, LockMetrics
 from calibre.db.errors import NoSuchFormat, NoSuchBook
-from calibre.db.fields import create_field, IDENTITY, InvalidLinkTable
-from calibre.db.search import Search
+from calibre.db.fields import create_field, IDENTITY, InvalidLinkTable, SortKeyCache
+from calibre.db.search import Search, SearchIndex
 from calibre.db.tables import VirtualTable
-from calibre.db.write import get_series_values, uniq
+from calibre.db.utils import Bitmap
+from calibre.db.write import get_series_values, uniq, IMPLICITLY_WRITTEN_FIELDS
 from calibre.db.lazy import FormatMetadata, FormatsList, ProxyMetadata
 from calibre.ebooks import check_ebook_format
 from calibre.ebooks.metadata import string_to_authors, author_to_author_sort
@@ -36,6 +37,7 @@ from calibre.utils.config import prefs, tweaks
 from calibre.utils.date import now as nowf, utcnow, UNDEFINED_DATE
 from calibre.utils.icu import sort_key
 from calibre.utils.localization import canonicalize_lang
+from calibre.utils.monotonic import monotonic
 
 
 def api(f):
@@ -69,6 +71,26 @@ def wrap_simple(lock, func):
     return call_func_with_lock
 
 
+def wrap_with_metrics(lock, func, metrics):
+    ' Like wrap_simple() but records lock wait and hold times in metrics '
+    name, is_shared = func.__name__, getattr(lock, '_is_shared', True)
+
+    @wraps(func)
+    def call_func_with_lock(*args, **kwargs):
+        start = monotonic()
+        try:
+            lock.acquire()
+        except DowngradeLockError:
+            return func(*args, **kwargs)
+        acquired = monotonic()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            lock.release()
+            metrics.record(name, is_shared, acquired - start, monotonic() - acquired)
+    return call_func_with_lock
+
+
 def run_import_plugins(path_or_stream, fmt):
     fmt = fmt.lower()
     if hasattr(path_or_stream, 'seek'):
@@ -113,6 +135,7 @@ class Cache(object):
         self.fields = {}
         self.composites = {}
         self.read_lock, self.write_lock = create_locks()
+        self.lock_metrics = LockMetrics() if tweaks.get('newdb_lock_metrics', False) else None
         self.format_metadata_cache = defaultdict(dict)
         self.formatter_template_cache = {}
         self.dirtied_cache = {}
@@ -132,9 +155,14 @@ class Cache(object):
                 setattr(self, '_'+name, func)
                 # Wrap it in a lock
                 lock = self.read_lock if ira else self.write_lock
-                setattr(self, name, wrap_simple(lock, func))
+                if self.lock_metrics is None:
+                    setattr(self, name, wrap_simple(lock, func))
+                else:
+                    setattr(self, name, wrap_with_metrics(lock, func, self.lock_metrics))
 
         self._search_api = Search(self, 'saved_searches', self.field_metadata.get_search_terms())
+        self.search_index = SearchIndex(enabled=tweaks['use_search_index'])
+        self.sort_key_cache = SortKeyCache()
         self.initialize_dynamic()
 
     @property
@@ -215,11 +243,12 @@ class Cache(object):
     def clear_composite_caches(self, book_ids=None):
         for field in itervalues(self.composites):
             field.clear_caches(book_ids=book_ids)
+        self.sort_key_cache.invalidate(book_ids, names=self.composites)
 
     @write_api
-    def clear_search_caches(self, book_ids=None):
+    def clear_search_caches(self, book_ids=None, field_names=None):
         self.clear_search_cache_count += 1
-        self._search_api.update_or_clear(self, book_ids)
+        self._search_api.update_or_clear(self, book_ids, field_names)
 
     @read_api
     def last_modified(self):
@@ -235,8 +264,11 @@ class Cache(object):
         if book_ids:
             for book_id in book_ids:
                 self.format_metadata_cache.pop(book_id, None)
+            self.search_index.update_books(book_ids)
         else:
             self.format_metadata_cache.clear()
+            self.search_index.clear()
+        self.sort_key_cache.invalidate(book_ids or None)
         if search_cache:
             self._clear_search_caches(book_ids)
 
@@ -250,6 +282,8 @@ class Cache(object):
             for field in itervalues(self.fields):
                 if hasattr(field, 'table'):
                     field.table.read(self.backend)  # Reread data from metadata.db
+            self.search_index.clear()
+            self.sort_key_cache.invalidate()
 
     @property
     def field_metadata(self):
@@ -920,61 +954,54 @@ class Cache(object):
         '''
         ids_to_sort = self._all_book_ids() if ids_to_sort is None else ids_to_sort
         get_metadata = self._get_proxy_metadata
-        lang_map = self.fields['languages'].book_value_map
+        lang_map = []
         virtual_fields = virtual_fields or {}
 
         fm = {'title':'sort', 'authors':'author_sort'}
 
-        def sort_key_func(field):
+        def get_lang_map():
+            if not lang_map:
+                lang_map.append(self.fields['languages'].book_value_map)
+            return lang_map[0]
+
+        def create_sort_key_func(field):
             'Handle series type fields, virtual fields and the id field'
             idx = field + '_index'
             is_series = idx in self.fields
             try:
-                func = self.fields[fm.get(field, field)].sort_keys_for_books(get_metadata, lang_map)
+                func = self.fields[fm.get(field, field)].sort_keys_for_books(get_metadata, get_lang_map())
             except KeyError:
                 if field == 'id':
                     return IDENTITY
                 else:
-                    return virtual_fields[fm.get(field, field)].sort_keys_for_books(get_metadata, lang_map)
+                    return virtual_fields[fm.get(field, field)].sort_keys_for_books(get_metadata, get_lang_map())
             if is_series:
-                idx_func = self.fields[idx].sort_keys_for_books(get_metadata, lang_map)
+                idx_func = self.fields[idx].sort_keys_for_books(get_metadata, get_lang_map())
 
                 def skf(book_id):
                     return (func(book_id), idx_func(book_id))
                 return skf
             return func
 
+        def sort_key_func(field):
+            # Sort keys for fields stored in the db are cached, keys for
+            # virtual fields like ondevice can change at any time
+            if field == 'id' or field == 'ondevice' or fm.get(field, field) not in self.fields:
+                return create_sort_key_func(field)
+            return self.sort_key_cache.key_func(field, partial(create_sort_key_func, field))
+
         # Sort only once on any given field
         fields = uniq(fields, operator.itemgetter(0))
 
         if len(fields) == 1:
             return sorted(ids_to_sort, key=sort_key_func(fields[0][0]),
                           reverse=not fields[0][1])
-        sort_key_funcs = tuple(sort_key_func(field) for field, order in fields)
-        orders = tuple(1 if order else -1 for _, order in fields)
-        Lazy = object()  # Lazy load the sort keys for sub-sort fields
-
-        class SortKey(object):
-
-            __slots__ = ('book_id', 'sort_key')
-
-            def __init__(self, book_id):
-                self.book_id = book_id
-                # Calculate only the first sub-sort key since that will always be used
-                self.sort_key = [key(book_id) if i == 0 else Lazy for i, key in enumerate(sort_key_funcs)]
-
-            def __cmp__(self, other):
-                for i, (order, self_key, other_key) in enumerate(zip(orders, self.sort_key, other.sort_key)):
-                    if self_key is Lazy:
-                        self_key = self.sort_key[i] = sort_key_funcs[i](self.book_id)
-                    if other_key is Lazy:
-                        other_key = other.sort_key[i] = sort_key_funcs[i](other.book_id)
-                    ans = cmp(self_key, other_key)
-                    if ans != 0:
-                        return ans * order
-                return 0
-
-        return sorted(ids_to_sort, key=SortKey)
+        # Since python sorts are stable, sorting on each field in turn,
+        # starting with the least significant one, gives the multisort
+        ans = list(ids_to_sort)
+        for field, ascending in reversed(fields):
+            ans.sort(key=sort_key_func(field), reverse=not ascending)
+        return ans
 
     @read_api
     def search(self, query, restriction='', virtual_fields=None, book_ids=None):
@@ -992,17 +1019,49 @@ class Cache(object):
         return self._search_api(self, query, restriction, virtual_fields=virtual_fields, book_ids=book_ids)
 
     @read_api
-    def books_in_virtual_library(self, vl, search_restriction=None):
-        ' Return the set of books in the specified virtual library '
+    def snapshot(self):
+        '''
+        Return a read-only :class:`calibre.db.snapshot.Snapshot` of the book
+        metadata in this library, as it is now. Long running readers should use
+        a snapshot, so as not to block writers for their whole run.
+        '''
+        from calibre.db.snapshot import Snapshot
+        return Snapshot(self)
+
+    @api
+    def lock_contention_stats(self, reset=False):
+        ''' Return the lock wait and hold times for every API that has been
+        called, or None if lock metrics are not enabled. Enable them by setting
+        the newdb_lock_metrics tweak. Useful to find write API calls that hold
+        up readers. '''
+        if self.lock_metrics is None:
+            return None
+        ans = self.lock_metrics.stats()
+        if reset:
+            self.lock_metrics.clear()
+        return ans
+
+    @read_api
+    def search_cache_stats(self):
+        ' Return hit/miss statistics for the search result and parsed query caches '
+        return self._search_api.cache_stats()
+
+    @read_api
+    def books_in_virtual_library(self, vl, search_restriction=None, as_bitmap=False):
+        ''' Return the set of books in the specified virtual library. If
+        as_bitmap is True, the books are returned as a
+        :class:`calibre.db.utils.Bitmap`, without building a set. '''
         vl = self._pref('virtual_libraries', {}).get(vl) if vl else None
         if not vl and not search_restriction:
-            return self.all_book_ids()
-        # We utilize the search restriction cache to speed this up
-        if vl:
-            if search_restriction:
-                return frozenset(self._search('', vl) & self._search('', search_restriction))
-            return frozenset(self._search('', vl))
-        return frozenset(self._search('', search_restriction))
+            ans = self._all_book_ids()
+            return Bitmap(ans) if as_bitmap else ans
+        # We utilize the search cache to speed this up, cached results are
+        # stored and intersected as bitmaps
+        if as_bitmap:
+            return reduce(operator.and_, (self._search_api.bitmap(self, q) for q in (vl, search_restriction) if q))
+        if vl and search_restriction:
+            return self._search_api.intersection(self, (vl, search_restriction))
+        return frozenset(self._search_api(self, vl or search_restriction, ''))
 
     @api
     def get_categories(self, sort='name', book_ids=None, already_fixed=None,
@@ -1021,19 +1080,24 @@ class Cache(object):
             return self.get_categories(sort=sort, book_ids=book_ids, already_fixed=bad_field)
 
     @write_api
-    def update_last_modified(self, book_ids, now=None):
+    def update_last_modified(self, book_ids, now=None, field_names=None):
+        ''' Set the last modified date of the specified books, and update the
+        caches for them. field_names, if specified, are the fields that were
+        changed, used to update only the search results that depend on them. '''
         if book_ids:
             if now is None:
                 now = nowf()
             f = self.fields['last_modified']
             f.writer.set_books({book_id:now for book_id in book_ids}, self.backend)
+            self.search_index.update_books(book_ids)
+            self.sort_key_cache.invalidate(book_ids)
             if self.composites:
                 self._clear_composite_caches(book_ids)
-            self._clear_search_caches(book_ids)
+            self._clear_search_caches(book_ids, field_names)
 
     @write_api
-    def mark_as_dirty(self, book_ids):
-        self._update_last_modified(book_ids)
+    def mark_as_dirty(self, book_ids, field_names=None):
+        self._update_last_modified(book_ids, field_names=field_names)
         already_dirtied = set(self.dirtied_cache).intersection(book_ids)
         new_dirtied = book_ids - already_dirtied
         already_dirtied = {book_id:self.dirtied_sequence+i for i, book_id in enumerate(already_dirtied)}
@@ -1091,14 +1155,17 @@ class Cache(object):
         dirtied = f.writer.set_books(
             book_id_to_val_map, self.backend, allow_case_change=allow_case_change)
 
+        field_names = {name} | IMPLICITLY_WRITTEN_FIELDS.get(name, frozenset())
         if is_series and simap:
             sf = self.fields[f.name+'_index']
             dirtied |= sf.writer.set_books(simap, self.backend, allow_case_change=False)
+            field_names.add(sf.name)
 
         if dirtied and update_path and do_path_update:
             self._update_path(dirtied, mark_as_dirtied=False)
+            field_names.add('path')
 
-        self._mark_as_dirty(dirtied)
+        self._mark_as_dirty(dirtied, field_names=field_names)
 
         return dirtied
 
@@ -1112,7 +1179,7 @@ class Cache(object):
                 author = _('Unknown')
             self.backend.update_path(book_id, title, author, self.fields['path'], self.fields['formats'])
             if mark_as_dirtied:
-                self._mark_as_dirty(book_ids)
+                self._mark_as_dirty(book_ids, field_names=('path', 'formats'))
 
     @read_api
     def get_a_dirtied_book(self):
@@ -1414,7 +1481,7 @@ class Cache(object):
 
             max_size = self.fields['formats'].table.update_fmt(book_id, fmt, fname, size, self.backend)
             self.fields['size'].table.update_sizes({book_id: max_size})
-            self._update_last_modified((book_id,))
+            self._update_last_modified((book_id,), field_names=('formats', 'size'))
 
         if run_hooks:
             # Run post import plugins, the write lock is released so the plugin
@@ -1458,7 +1525,7 @@ class Cache(object):
 
         size_map = table.remove_formats(formats_map, self.backend)
         self.fields['size'].table.update_sizes(size_map)
-        self._update_last_modified(tuple(formats_map))
+        self._update_last_modified(tuple(formats_map), field_names=('formats', 'size'))
 
     @read_api
     def get_next_series_num_for(self, series, field='series', current_indices=False):
@@ -1576,6 +1643,11 @@ class Cache(object):
             elif field == 'uuid':
                 self.fields[field].table.uuid_to_id_map[val] = book_id
             self.fields[field].table.book_col_map[book_id] = val
+        self.search_index.update_books((book_id,))
+        self.sort_key_cache.invalidate((book_id,))
+        # The new book has to be matched against all cached searches, not
+        # just the ones that depend on the fields set above
+        self._clear_search_caches((book_id,))
 
         return book_id
 
@@ -1740,7 +1812,7 @@ class Cache(object):
             elif change_index and hasattr(f, 'index_field') and tweaks['series_index_auto_increment'] != 'no_change':
                 for book_id in moved_books:
                     self._set_field(f.index_field.name, {book_id:self._get_next_series_num_for(self._fast_field_for(f, book_id), field=field)})
-            self._mark_as_dirty(affected_books)
+            self._mark_as_dirty(affected_books, field_names={field} | IMPLICITLY_WRITTEN_FIELDS.get(field, frozenset()))
         return affected_books, id_map
 
     @write_api
@@ -1757,8 +1829,7 @@ class Cache(object):
         if affected_books:
             if hasattr(field, 'index_field'):
                 self._set_field(field.index_field.name, {bid:1.0 for bid in affected_books})
-            else:
-                self._mark_as_dirty(affected_books)
+            self._mark_as_dirty(affected_books, field_names=(field.name,))
         return affected_books
 
     @write_api
@@ -2186,18 +2257,23 @@ class Cache(object):
                 'INSERT OR REPLACE INTO last_read_positions(book,format,user,device,cfi,epoch,pos_frac) VALUES (?,?,?,?,?,?,?)',
                 (book_id, fmt, user, device, cfi, epoch or time(), pos_frac))
 
-    @read_api
+    @api
     def export_library(self, library_key, exporter, progress=None, abort=None):
         from binascii import hexlify
         key_prefix = hexlify(library_key)
-        book_ids = self._all_book_ids()
-        total = len(book_ids) + 1
+        total = len(self.all_book_ids()) + 1
         format_metadata = {}
         if progress is not None:
             progress('metadata.db', 0, total)
         pt = PersistentTemporaryFile('-export.db')
         pt.close()
-        self.backend.backup_database(pt.name)
+        # The book ids and titles are read along with the backup, so that
+        # writers are not blocked for the whole export
+        with self.safe_read_lock:
+            self.backend.backup_database(pt.name)
+            book_ids = self._all_book_ids()
+            titles = {book_id:self._field_for('title', book_id) for book_id in book_ids}
+        total = len(book_ids) + 1
         dbkey = key_prefix + ':::' + 'metadata.db'
         with lopen(pt.name, 'rb') as f:
             exporter.add_file(f, dbkey)
@@ -2207,14 +2283,21 @@ class Cache(object):
             if abort is not None and abort.is_set():
                 return
             if progress is not None:
-                progress(self._field_for('title', book_id), i + 1, total)
+                progress(titles[book_id], i + 1, total)
             format_metadata[book_id] = {}
-            for fmt in self._formats(book_id):
+            for fmt in self.formats(book_id):
                 mdata = self.format_metadata(book_id, fmt)
                 key = '%s:%s:%s' % (key_prefix, book_id, fmt)
-                format_metadata[book_id][fmt] = key
                 with exporter.start_file(key, mtime=mdata.get('mtime')) as dest:
-                    self._copy_format_to(book_id, fmt, dest, report_file_size=dest.ensure_space)
+                    try:
+                        copied = self.copy_format_to(book_id, fmt, dest, report_file_size=dest.ensure_space)
+                    except NoSuchFormat:
+                        copied = False
+                    if copied is False:
+                        # The format was removed while the library was being exported
+                        dest.discard()
+                    else:
+                        format_metadata[book_id][fmt] = key
             cover_key = '%s:%s:%s' % (key_prefix, book_id, '.cover')
             with exporter.start_file(cover_key) as dest:
                 if not self.copy_cover_to(book_id, dest, report_file_size=dest.ensure_space):
@@ -7,6 +7,7 @@ __license__   = 'GPL v3'
 __copyright__ = '2011, Kovid Goyal <kovid@kovidgoyal.net>'
 __docformat__ = 'restructuredtext en'
 
+from copy import copy
 from threading import Lock
 from collections import defaultdict, Counter
 from functools import partial
@@ -19,7 +20,7 @@ from calibre.utils.config_base import tweaks
 from calibre.utils.icu import sort_key
 from calibre.utils.date import UNDEFINED_DATE, clean_date_for_sort, parse_date
 from calibre.utils.localization import calibre_langcode_to_name
-from polyglot.builtins import iteritems
+from polyglot.builtins import iteritems, itervalues
 
 
 def bool_sort_key(bools_are_tristate):
@@ -95,6 +96,17 @@ class Field(object):
     def metadata(self):
         return self.table.metadata
 
+    def snapshot(self):
+        '''
+        Return a read-only copy of this field, with a copy of its table, that
+        is not affected by later changes. References to other fields, such as
+        series_field, must be updated by the caller.
+        '''
+        ans = copy(self)
+        ans.table = self.table.snapshot()
+        ans.writer = None
+        return ans
+
     def for_book(self, book_id, default_value=None):
         '''
         Return the value of this field for the book identified by book_id.
@@ -291,6 +303,13 @@ class CompositeField(OneToOneField):
                 for book_id in book_ids:
                     self._render_cache.pop(book_id, None)
 
+    def snapshot(self):
+        ans = OneToOneField.snapshot(self)
+        with self._lock:
+            ans._render_cache = self._render_cache.copy()
+        ans._lock = Lock()
+        return ans
+
     def get_value_with_cache(self, book_id, get_metadata):
         with self._lock:
             ans = self._render_cache.get(book_id, None)
@@ -365,6 +384,13 @@ class OnDeviceField(OneToOneField):
     def metadata(self):
         return self._metadata
 
+    def snapshot(self):
+        ans = copy(self)
+        with self._lock:
+            ans.cache = self.cache.copy()
+        ans._lock = Lock()
+        return ans
+
     def clear_caches(self, book_ids=None):
         with self._lock:
             if book_ids is None:
@@ -413,6 +439,47 @@ class OnDeviceField(OneToOneField):
             yield val, book_ids
 
 
+class SortKeyCache(object):
+
+    '''
+    Stores the sort keys of books, one column per sort field, so that they are
+    not re-computed every time the library is sorted. Columns are filled in
+    lazily and invalidated per book whenever book metadata changes.
+    '''
+
+    def __init__(self):
+        self.columns = {}
+
+    def key_func(self, name, factory):
+        ''' Return a function that maps book_id to the sort key for the
+        field ``name``. ``factory`` is called to create the function that
+        actually computes sort keys, only if some keys are missing. '''
+        column = self.columns.get(name)
+        if column is None:
+            column = self.columns.setdefault(name, {})
+        compute = []
+
+        def key(book_id):
+            try:
+                return column[book_id]
+            except KeyError:
+                if not compute:
+                    compute.append(factory())
+                ans = column[book_id] = compute[0](book_id)
+                return ans
+        return key
+
+    def invalidate(self, book_ids=None, names=None):
+        columns = self.columns if names is None else {n:self.columns[n] for n in names if n in self.columns}
+        if book_ids is None:
+            for name in tuple(columns):
+                self.columns.pop(name, None)
+        else:
+            for column in itervalues(columns):
+                for book_id in book_ids:
+                    column.pop(book_id, None)
+
+
 class LazySortMap(object):
 
     __slots__ = ('default_sort_key', 'sort_key_func', 'id_map', 'cache')
@@ -9,7 +9,13 @@ __docformat__ = 'restructuredtext en'
 
 import traceback, sys
 from threading import Lock, Condition, current_thread
+try:
+    from _thread import get_ident
+except ImportError:
+    from thread import get_ident
+
 from calibre.utils.config_base import tweaks
+from polyglot.builtins import iteritems
 
 
 class LockingError(RuntimeError):
@@ -59,17 +65,22 @@ class SHLock(object):  # {{{
     should be possible.
 
     Based on code from: https://github.com/rfk/threading2
+
+    Lock owners are identified by thread ident rather than thread object, and
+    the uncontended cases of :meth:`acquire_shared` and
+    :meth:`acquire_exclusive` are handled without any further method calls,
+    as these are used for every call to the Cache API.
     '''
 
     def __init__(self):
         self._lock = Lock()
         #  When a shared lock is held, is_shared will give the cumulative
-        #  number of locks and _shared_owners maps each owning thread to
-        #  the number of locks is holds.
+        #  number of locks and _shared_owners maps each owning thread ident
+        #  to the number of locks is holds.
         self.is_shared = 0
         self._shared_owners = {}
         #  When an exclusive lock is held, is_exclusive will give the number
-        #  of locks held and _exclusive_owner will give the owning thread
+        #  of locks held and _exclusive_owner will give the owning thread ident
         self.is_exclusive = 0
         self._exclusive_owner = None
         #  When someone is forced to wait for a lock, they add themselves
@@ -87,27 +98,53 @@ class SHLock(object):  # {{{
         If blocking is False this method will return False if acquiring the
         lock failed.
         '''
+        me = get_ident()
         with self._lock:
             if shared:
-                return self._acquire_shared(blocking)
+                return self._acquire_shared(me, blocking)
             else:
-                return self._acquire_exclusive(blocking)
+                return self._acquire_exclusive(me, blocking)
             assert not (self.is_shared and self.is_exclusive)
 
+    def acquire_shared(self):
+        ''' Acquire the lock in shared mode, blocking until it is available. '''
+        me = get_ident()
+        with self._lock:
+            count = self._shared_owners.get(me)
+            if count:
+                self._shared_owners[me] = count + 1
+                self.is_shared += 1
+                return True
+            if not self.is_exclusive and not self._exclusive_queue:
+                self._shared_owners[me] = 1
+                self.is_shared += 1
+                return True
+            return self._acquire_shared(me)
+
+    def acquire_exclusive(self):
+        ''' Acquire the lock in exclusive mode, blocking until it is available. '''
+        me = get_ident()
+        with self._lock:
+            if not self.is_exclusive and not self.is_shared:
+                self._exclusive_owner = me
+                self.is_exclusive = 1
+                return True
+            return self._acquire_exclusive(me)
+
     def owns_lock(self):
-        me = current_thread()
+        me = get_ident()
         with self._lock:
-            return self._exclusive_owner is me or me in self._shared_owners
+            return self._exclusive_owner == me or me in self._shared_owners
 
     def release(self):
         ''' Release the lock. '''
         #  This decrements the appropriate lock counters, and if the lock
         #  becomes free, it looks for a queued thread to hand it off to.
         #  By doing the handoff here we ensure fairness.
-        me = current_thread()
+        me = get_ident()
         with self._lock:
             if self.is_exclusive:
-                if self._exclusive_owner is not me:
+                if self._exclusive_owner != me:
                     raise LockingError("release() called on unheld lock")
                 self.is_exclusive -= 1
                 if not self.is_exclusive:
@@ -148,8 +185,7 @@ class SHLock(object):  # {{{
             else:
                 raise LockingError("release() called on unheld lock")
 
-    def _acquire_shared(self, blocking=True):
-        me = current_thread()
+    def _acquire_shared(self, me, blocking=True):
         #  Each case: acquiring a lock we already hold.
         if self.is_shared and me in self._shared_owners:
             self.is_shared += 1
@@ -158,7 +194,7 @@ class SHLock(object):  # {{{
         #  If the lock is already spoken for by an exclusive, add us
         #  to the shared queue and it will give us the lock eventually.
         if self.is_exclusive or self._exclusive_queue:
-            if self._exclusive_owner is me:
+            if self._exclusive_owner == me:
                 raise DowngradeLockError("can't downgrade SHLock object")
             if not blocking:
                 return False
@@ -174,10 +210,9 @@ class SHLock(object):  # {{{
             self._shared_owners[me] = 1
         return True
 
-    def _acquire_exclusive(self, blocking=True):
-        me = current_thread()
+    def _acquire_exclusive(self, me, blocking=True):
         #  Each case: acquiring a lock we already hold.
-        if self._exclusive_owner is me:
+        if self._exclusive_owner == me:
             assert self.is_exclusive
             self.is_exclusive += 1
             return True
@@ -217,9 +252,10 @@ class RWLockWrapper(object):
     def __init__(self, shlock, is_shared=True):
         self._shlock = shlock
         self._is_shared = is_shared
+        self._acquire = shlock.acquire_shared if is_shared else shlock.acquire_exclusive
 
     def acquire(self):
-        self._shlock.acquire(shared=self._is_shared)
+        self._acquire()
 
     def release(self, *args):
         self._shlock.release()
@@ -278,3 +314,43 @@ class SafeReadLock(object):
 
     __enter__ = acquire
     __exit__  = release
+
+
+class LockMetrics(object):
+
+    '''
+    Collects contention metrics for the API calls made through a lock: the
+    time spent waiting for the lock and the time the lock was held, per API,
+    as well as the API that held the exclusive lock for the longest time.
+    '''
+
+    def __init__(self):
+        self.lock = Lock()
+        self.clear()
+
+    def clear(self):
+        with self.lock:
+            self.apis = {}
+            self.longest_write_hold = (0, None)
+
+    def record(self, name, is_shared, wait, hold):
+        with self.lock:
+            s = self.apis.get(name)
+            if s is None:
+                s = self.apis[name] = [0, 0, 0, 0, 0]
+            s[0] += 1
+            s[1] += wait
+            s[2] = max(s[2], wait)
+            s[3] += hold
+            s[4] = max(s[4], hold)
+            if not is_shared and hold > self.longest_write_hold[0]:
+                self.longest_write_hold = (hold, name)
+
+    def stats(self):
+        with self.lock:
+            return {
+                'apis': {name: {
+                    'calls': s[0], 'wait': s[1], 'max_wait': s[2], 'hold': s[3], 'max_hold': s[4]
+                } for name, s in iteritems(self.apis)},
+                'longest_write_hold': {'api': self.longest_write_hold[1], 'time': self.longest_write_hold[0]},
+            }
@@ -7,19 +7,22 @@ __license__   = 'GPL v3'
 __copyright__ = '2013, Kovid Goyal <kovid at kovidgoyal.net>'
 __docformat__ = 'restructuredtext en'
 
-import re, weakref, operator
-from functools import partial
+import re, sys, weakref, operator
+from bisect import bisect_left
+from functools import partial, reduce
 from datetime import timedelta
-from collections import deque, OrderedDict
+from threading import Lock
+from collections import OrderedDict, defaultdict
 
 from calibre.constants import preferred_encoding
-from calibre.db.utils import force_to_bool
+from calibre.db.tables import ONE_ONE, MANY_ONE, MANY_MANY
+from calibre.db.utils import Bitmap, force_to_bool
 from calibre.utils.config_base import prefs
 from calibre.utils.date import parse_date, UNDEFINED_DATE, now, dt_as_local
 from calibre.utils.icu import primary_contains, sort_key
 from calibre.utils.localization import lang_map, canonicalize_lang
 from calibre.utils.search_query_parser import SearchQueryParser, ParseException
-from polyglot.builtins import iteritems, unicode_type, string_or_bytes
+from polyglot.builtins import iteritems, itervalues, unicode_type, string_or_bytes, range
 
 CONTAINS_MATCH = 0
 EQUALS_MATCH   = 1
@@ -241,7 +244,7 @@ class NumericSearch(object):  # {{{
             for val, book_ids in field_iter():
                 if valcheck(val):
                     found |= book_ids
-            return found if query == 'true' else candidates - found
+            return found if query == 'true' else Bitmap(candidates) - found
 
         if query == 'false':
             if location == 'cover':
@@ -369,7 +372,7 @@ class KeyPairSearch(object):  # {{{
                 for val, book_ids in field_iter():
                     if val:
                         found |= book_ids
-            return found if valq == 'true' else candidates - found
+            return found if valq == 'true' else Bitmap(candidates) - found
 
         for m, book_ids in field_iter():
             for key, val in iteritems(m):
@@ -387,6 +390,171 @@ class KeyPairSearch(object):  # {{{
 # }}}
 
 
+# Inverted index {{{
+
+INDEXED_DATATYPES = frozenset(('text', 'series', 'enumeration'))
+
+
+def field_supports_index(field):
+    ''' Only fields whose values are stored in plain tables are indexed.
+    Composite and virtual fields have no stored values, formats and
+    identifiers are searched differently and comments are too large for an
+    index to be useful. '''
+    from calibre.db.fields import FormatsField, IdentifiersField, OnDeviceField
+    return (
+        field.metadata['datatype'] in INDEXED_DATATYPES and not field.is_composite and
+        getattr(field, 'table_type', None) in (ONE_ONE, MANY_ONE, MANY_MANY) and
+        not isinstance(field, (FormatsField, IdentifiersField, OnDeviceField)))
+
+
+class FieldIndex(object):
+
+    '''
+    An inverted index mapping the case folded values of a field to the ids of
+    the items that have those values. For one-one fields items are books, for
+    many-one and many-many fields they are the entries in the table's id_map,
+    which are converted to book ids via col_book_map at query time, so that
+    linking/unlinking books does not require changes to the index.
+    '''
+
+    __slots__ = ('table', 'is_one_one', 'key_map', 'item_key_map', '_sorted_keys')
+
+    def __init__(self, field):
+        self.table = field.table
+        self.is_one_one = field.table_type == ONE_ONE
+        self.key_map = defaultdict(set)
+        self.item_key_map = {}
+        self._sorted_keys = None
+        self.update_items(self.value_map)
+
+    @property
+    def value_map(self):
+        return self.table.book_col_map if self.is_one_one else self.table.id_map
+
+    @property
+    def sorted_keys(self):
+        ans = self._sorted_keys
+        if ans is None:
+            ans = self._sorted_keys = sorted(self.key_map)
+        return ans
+
+    def update_items(self, item_ids):
+        vm, key_map, item_key_map = self.value_map, self.key_map, self.item_key_map
+        for item_id in item_ids:
+            val = vm.get(item_id)
+            key = icu_lower(val) if isinstance(val, unicode_type) else None
+            old_key = item_key_map.get(item_id)
+            if old_key == key:
+                continue
+            if old_key is not None:
+                items = key_map[old_key]
+                items.discard(item_id)
+                if not items:
+                    del key_map[old_key]
+            if key is None:
+                del item_key_map[item_id]
+            else:
+                item_key_map[item_id] = key
+                key_map[key].add(item_id)
+            self._sorted_keys = None
+
+    def update_books(self, book_ids):
+        if self.is_one_one:
+            self.update_items(book_ids)
+            return
+        bcm = self.table.book_col_map
+        item_ids = set()
+        for book_id in book_ids:
+            val = bcm.get(book_id)
+            if val is not None:
+                if isinstance(val, tuple):
+                    item_ids.update(val)
+                else:
+                    item_ids.add(val)
+        self.update_items(item_ids)
+
+    def matching_keys(self, query, matchkind, use_primary_find_in_search):
+        if not query:
+            return ()
+        if matchkind == EQUALS_MATCH and not query.startswith('..'):
+            if query[0] != '.':
+                return (query,) if query in self.key_map else ()
+            # Hierarchical match, matches the item and all its children
+            prefix = query[1:]
+            ql = len(prefix)
+            keys = self.sorted_keys
+            ans = []
+            for i in range(bisect_left(keys, prefix), len(keys)):
+                key = keys[i]
+                if not key.startswith(prefix):
+                    break
+                if len(key) == ql or key[ql] == '.':
+                    ans.append(key)
+            return ans
+        # The keys are the distinct values of the field, so this is much
+        # cheaper than matching the value of every book
+        return [k for k in self.key_map if _match(
+            query, (k,), matchkind, use_primary_find_in_search=use_primary_find_in_search)]
+
+    def search(self, query, matchkind, use_primary_find_in_search, candidates):
+        key_map = self.key_map
+        item_ids = set()
+        for key in self.matching_keys(query, matchkind, use_primary_find_in_search):
+            item_ids |= key_map[key]
+        if self.is_one_one:
+            return item_ids.intersection(candidates)
+        cbm, empty = self.table.col_book_map, set()
+        ans = set()
+        for item_id in item_ids:
+            ans |= cbm.get(item_id, empty)
+        return ans.intersection(candidates)
+
+
+class SearchIndex(object):
+
+    '''
+    The inverted indices for the fields of a library. Indices are built lazily,
+    the first time a field is searched and are kept up to date by the Cache
+    whenever book metadata changes. Searches that cannot use an index, such as
+    regular expression or case sensitive searches, fall back to scanning the
+    field values.
+    '''
+
+    def __init__(self, enabled=True):
+        self.enabled = enabled
+        self.indices = {}
+        self.lock = Lock()
+
+    def index_for(self, field):
+        if not self.enabled:
+            return
+        name = field.name
+        ans = self.indices.get(name)
+        if ans is None:
+            if not field_supports_index(field):
+                return
+            # Multiple readers can search simultaneously, so building has to
+            # be serialized
+            with self.lock:
+                ans = self.indices.get(name)
+                if ans is None:
+                    ans = self.indices[name] = FieldIndex(field)
+        return ans
+
+    def update_books(self, book_ids):
+        for index in itervalues(self.indices):
+            index.update_books(book_ids)
+
+    def clear(self, field_names=None):
+        if field_names is None:
+            self.indices.clear()
+        else:
+            for name in field_names:
+                self.indices.pop(name, None)
+
+# }}}
+
+
 class SavedSearchQueries(object):  # {{{
     queries = {}
     opt_name = ''
@@ -464,6 +632,8 @@ class Parser(SearchQueryParser):  # {{{
         self.virtual_fields = virtual_fields or {}
         if 'marked' not in self.virtual_fields:
             self.virtual_fields['marked'] = self
+        self.dependencies = set()
+        self._universal_bitmap = None
         SearchQueryParser.__init__(self, locations, optimize=True, lookup_saved_search=lookup_saved_search, parse_cache=parse_cache)
 
     @property
@@ -473,6 +643,23 @@ class Parser(SearchQueryParser):  # {{{
     def universal_set(self):
         return self.all_book_ids
 
+    @property
+    def universal_bitmap(self):
+        if self._universal_bitmap is None:
+            self._universal_bitmap = Bitmap(self.all_book_ids)
+        return self._universal_bitmap
+
+    def add_dependency(self, name):
+        ''' Record that the current search reads the field name. Composite
+        columns can read any field, so searches on them have unknown
+        dependencies. '''
+        if self.dependencies is not None:
+            field = self.dbcache.fields.get(name)
+            if field is not None and field.is_composite:
+                self.dependencies = None
+            else:
+                self.dependencies.add(name)
+
     def field_iter(self, name, candidates):
         get_metadata = self.dbcache._get_proxy_metadata
         try:
@@ -480,6 +667,8 @@ class Parser(SearchQueryParser):  # {{{
         except KeyError:
             field = self.virtual_fields[name]
             self.virtual_field_used = True
+        else:
+            self.add_dependency(name)
         return field.iter_searchable_values(get_metadata, candidates)
 
     def iter_searchable_values(self, *args, **kwargs):
@@ -487,9 +676,30 @@ class Parser(SearchQueryParser):  # {{{
             yield x, set()
 
     def parse(self, *args, **kwargs):
+        ' Return the ids of the matching books as a :class:`Bitmap` '
         self.virtual_field_used = False
+        self.dependencies = set()
+        self._universal_bitmap = None
         return SearchQueryParser.parse(self, *args, **kwargs)
 
+    # The results of the individual terms of a query are combined as bitmaps
+    def evaluate_and(self, argument, candidates):
+        l = self.evaluate(argument[0], candidates)
+        return l & self.evaluate(argument[1], l)
+
+    def evaluate_or(self, argument, candidates):
+        l = self.evaluate(argument[0], candidates)
+        return l | self.evaluate(argument[1], Bitmap(candidates) - l)
+
+    def evaluate_not(self, argument, candidates):
+        return Bitmap(candidates) - self.evaluate(argument[0], candidates)
+
+    def evaluate_token(self, argument, candidates):
+        if isinstance(candidates, Bitmap):
+            # The fields look up the candidates in hash sets
+            candidates = set(candidates)
+        return as_bitmap(SearchQueryParser.evaluate_token(self, argument, candidates))
+
     def get_matches(self, location, query, candidates=None,
                     allow_recursion=True):
         # If candidates is not None, it must not be modified. Changing its
@@ -507,8 +717,9 @@ class Parser(SearchQueryParser):  # {{{
             vl = self.dbcache._pref('virtual_libraries', {}).get(query) if query else None
             if not vl:
                 raise ParseException(_('No such virtual library: {}').format(query))
+            self.dependencies = None
             try:
-                return candidates & self.dbcache.books_in_virtual_library(query)
+                return Bitmap(candidates) & self.dbcache.books_in_virtual_library(query, as_bitmap=True)
             except RuntimeError:
                 raise ParseException(_('Virtual library search is recursive: {}').format(query))
 
@@ -529,16 +740,19 @@ class Parser(SearchQueryParser):  # {{{
                     query = 'true'
                 else:
                     invert = False
+                # Books that have matched need not be searched again
+                matches = Bitmap()
+                remaining = candidates
                 for loc in location:
-                    c = candidates.copy()
                     m = self.get_matches(loc, query,
-                            candidates=c, allow_recursion=False)
-                    matches |= m
-                    c -= m
-                    if len(c) == 0:
-                        break
+                            candidates=remaining, allow_recursion=False)
+                    if m:
+                        matches |= m
+                        remaining = remaining.difference(m)
+                        if not remaining:
+                            break
                 if invert:
-                    matches = self.all_book_ids - matches
+                    matches = self.universal_bitmap - matches
                 return matches
             raise ParseException(
                        _('Recursive query group detected: {0}').format(query))
@@ -558,8 +772,8 @@ class Parser(SearchQueryParser):  # {{{
                     try:
                         m = self.get_matches(l, query,
                             candidates=c, allow_recursion=allow_recursion)
-                        matches |= m
-                        c -= m
+                        matches.update(m)
+                        c.difference_update(m)
                         if len(c) == 0:
                             break
                     except:
@@ -602,6 +816,7 @@ class Parser(SearchQueryParser):  # {{{
             # take care of the 'count' operator for is_multiples
             if (fm['is_multiple'] and
                 len(query) > 1 and query[0] == '#' and query[1] in '=<>!'):
+                self.add_dependency(location)
                 return self.num_search(icu_lower(query[1:]), partial(
                         self.dbcache.fields[location].iter_counts, candidates),
                     location, dt, candidates)
@@ -704,6 +919,13 @@ class Parser(SearchQueryParser):  # {{{
                 continue
 
             if location in text_fields:
+                index = None
+                if not case_sensitive and matchkind != REGEXP_MATCH and location in self.dbcache.fields:
+                    index = self.dbcache.search_index.index_for(self.dbcache.fields[location])
+                if index is not None:
+                    self.add_dependency(location)
+                    matches |= index.search(q, matchkind, upf, current_candidates)
+                    continue
                 for val, book_ids in self.field_iter(location, current_candidates):
                     if val is not None:
                         if isinstance(val, string_or_bytes):
@@ -712,6 +934,8 @@ class Parser(SearchQueryParser):  # {{{
                             matches |= book_ids
 
             if location == 'series_sort':
+                self.add_dependency('series')
+                self.add_dependency('languages')
                 book_lang_map = self.dbcache.fields['languages'].book_value_map
                 for val, book_ids in self.dbcache.fields['series'].iter_searchable_values_for_sort(current_candidates, book_lang_map):
                     if val is not None:
@@ -738,74 +962,142 @@ class Parser(SearchQueryParser):  # {{{
             if key == location or (check_subcats and key.startswith(location + '.')):
                 for (item, category, ign) in user_cats[key]:
                     s = self.get_matches(category, '=' + item, candidates=c)
-                    c -= s
-                    matches |= s
+                    c.difference_update(s)
+                    matches.update(s)
         if query == 'false':
-            return candidates - matches
+            return Bitmap(candidates) - matches
         return matches
 # }}}
 
 
 class LRUCache(object):  # {{{
 
-    'A simple Least-Recently-Used cache'
+    '''
+    A Least-Recently-Used cache, bounded both by the number of entries and,
+    optionally, by the total estimated size of the entries in bytes. Values
+    can be stored in a compact form, ``pack`` converts values when they are
+    added and ``unpack`` converts them back when they are retrieved.
+    '''
 
-    def __init__(self, limit=50):
-        self.item_map = {}
-        self.age_map = deque()
+    def __init__(self, limit=50, max_size=None, pack=None, unpack=None, size_of=None):
+        self.item_map = OrderedDict()
+        self.size_map = {}
         self.limit = limit
+        self.max_size = max_size
+        self.pack, self.unpack, self.size_of = pack, unpack, size_of
+        self.size = 0
+        self.hits = self.misses = self.evictions = 0
+        self.lock = Lock()
+
+    def _remove(self, key):
+        self.item_map.pop(key)
+        self.size -= self.size_map.pop(key, 0)
+
+    def _store(self, key, val):
+        if self.pack is not None:
+            val = self.pack(val)
+        self.item_map[key] = val
+        if self.size_of is not None:
+            self.size_map[key] = sz = self.size_of(val)
+            self.size += sz
 
-    def _move_up(self, key):
-        if key != self.age_map[-1]:
-            self.age_map.remove(key)
-            self.age_map.append(key)
+    def _unpack(self, val):
+        return val if self.unpack is None else self.unpack(val)
 
     def add(self, key, val):
-        if key in self.item_map:
-            self._move_up(key)
-            return
-
-        if len(self.age_map) >= self.limit:
-            self.item_map.pop(self.age_map.popleft())
-
-        self.item_map[key] = val
-        self.age_map.append(key)
+        with self.lock:
+            if key in self.item_map:
+                self._remove(key)
+            self._store(key, val)
+            while self.item_map and (len(self.item_map) > self.limit or (
+                    self.max_size is not None and self.size > self.max_size)):
+                self._remove(next(iter(self.item_map)))
+                self.evictions += 1
     __setitem__  = add
 
-    def get(self, key, default=None):
-        ans = self.item_map.get(key, default)
-        if ans is not default:
-            self._move_up(key)
-        return ans
+    def replace(self, key, val):
+        ''' Replace the value for key, if present, without changing its age '''
+        with self.lock:
+            if key in self.item_map:
+                self.size -= self.size_map.pop(key, 0)
+                self._store(key, val)
+
+    def get(self, key, default=None, unpack=True):
+        with self.lock:
+            try:
+                ans = self.item_map.pop(key)
+            except KeyError:
+                self.misses += 1
+                return default
+            self.item_map[key] = ans
+            self.hits += 1
+        return self._unpack(ans) if unpack else ans
+
+    def peek(self, key, default=None, unpack=True):
+        ' Get the value for key without changing its age or the hit counts '
+        with self.lock:
+            ans = self.item_map.get(key)
+        if ans is None:
+            return default
+        return self._unpack(ans) if unpack else ans
+
+    def keys(self):
+        with self.lock:
+            return tuple(self.item_map)
 
     def clear(self):
-        self.item_map.clear()
-        self.age_map.clear()
+        with self.lock:
+            self.item_map.clear()
+            self.size_map.clear()
+            self.size = 0
 
     def pop(self, key, default=None):
-        self.item_map.pop(key, default)
-        try:
-            self.age_map.remove(key)
-        except ValueError:
-            pass
+        with self.lock:
+            if key in self.item_map:
+                ans = self.item_map[key]
+                self._remove(key)
+                return self._unpack(ans)
+        return default
+
+    def stats(self):
+        with self.lock:
+            return {'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions,
+                    'entries': len(self.item_map), 'size': self.size}
 
     def __contains__(self, key):
         return key in self.item_map
 
     def __len__(self):
-        return len(self.age_map)
+        return len(self.item_map)
 
     def __getitem__(self, key):
-        return self.get(key)
+        # Used by dict(cache), which should not count as using the entries
+        return self.peek(key)
 
     def __iter__(self):
-        return iteritems(self.item_map)
+        with self.lock:
+            items = tuple(iteritems(self.item_map))
+        for key, val in items:
+            yield key, self._unpack(val)
+
+
+def as_bitmap(book_ids):
+    return book_ids if isinstance(book_ids, Bitmap) else Bitmap(book_ids)
+
+
+def size_of_bitmap(bitmap):
+    # The memory actually used by the bitmap, including the int object
+    return sys.getsizeof(bitmap.bits)
 # }}}
 
 
 class Search(object):
 
+    # The maximum number of (book, query) pairs that will be re-evaluated
+    # when books change, for cached queries whose dependencies are not known.
+    # Queries with known dependencies are always updated incrementally.
     MAX_CACHE_UPDATE = 50
+    MAX_CACHE_SIZE = 32 * 1024 * 1024
 
     def __init__(self, db, opt_name, all_search_locations=()):
         self.all_search_locations = all_search_locations
@@ -814,7 +1106,13 @@ class Search(object):
         self.bool_search = BooleanSearch()
         self.keypair_search = KeyPairSearch()
         self.saved_searches = SavedSearchQueries(db, opt_name)
-        self.cache = LRUCache()
+        # Cached results are stored as bitmaps of book ids, which use a
+        # fraction of the memory of a set and can be combined cheaply. They
+        # are returned as frozensets, so that callers cannot modify them.
+        self.cache = LRUCache(max_size=self.MAX_CACHE_SIZE, pack=as_bitmap, unpack=frozenset, size_of=size_of_bitmap)
+        # Map of cached query to the set of fields it reads, or None if that
+        # is not known
+        self.dependencies = {}
         self.parse_cache = LRUCache(limit=100)
 
     def get_saved_searches(self):
@@ -826,42 +1124,111 @@ class Search(object):
             self.parse_cache.clear()
         self.all_search_locations = newlocs
 
-    def update_or_clear(self, dbcache, book_ids=None):
-        if book_ids and (len(book_ids) * len(self.cache)) <= self.MAX_CACHE_UPDATE:
-            self.update_caches(dbcache, book_ids)
+    def update_or_clear(self, dbcache, book_ids=None, field_names=None):
+        ''' Update the cached results for the specified books. If field_names
+        is not None, only cached queries that read one of those fields are
+        re-evaluated. '''
+        if not book_ids:
+            return self.clear_caches()
+        if field_names is not None:
+            # Every change updates the last modified date
+            field_names = frozenset(field_names) | {'last_modified'}
+        affected, unknown = [], []
+        for query in self.cache.keys():
+            deps = self.dependencies.get(query)
+            if deps is None:
+                unknown.append(query)
+            elif field_names is None or not deps.isdisjoint(field_names):
+                affected.append(query)
+        if len(book_ids) * len(unknown) > self.MAX_CACHE_UPDATE:
+            for query in unknown:
+                self.cache.pop(query)
+                self.dependencies.pop(query, None)
         else:
-            self.clear_caches()
+            affected.extend(unknown)
+        if affected:
+            self.update_caches(dbcache, book_ids, affected)
 
     def clear_caches(self):
         self.cache.clear()
+        self.dependencies.clear()
 
-    def update_caches(self, dbcache, book_ids):
+    def update_caches(self, dbcache, book_ids, queries=None):
         sqp = self.create_parser(dbcache)
         try:
-            return self._update_caches(sqp, book_ids)
+            return self._update_caches(sqp, book_ids, queries)
         finally:
             sqp.dbcache = sqp.lookup_saved_search = None
 
-    def discard_books(self, book_ids):
-        book_ids = set(book_ids)
-        for query, result in self.cache:
-            result.difference_update(book_ids)
+    def cache_stats(self):
+        return {'search': self.cache.stats(), 'parse': self.parse_cache.stats()}
 
-    def _update_caches(self, sqp, book_ids):
-        book_ids = sqp.all_book_ids = set(book_ids)
+    def discard_books(self, book_ids):
+        book_ids = Bitmap(book_ids)
+        for query in self.cache.keys():
+            result = self.cache.peek(query, unpack=False)
+            if result is not None and not result.isdisjoint(book_ids):
+                self.cache.replace(query, result - book_ids)
+
+    def _update_caches(self, sqp, book_ids, queries=None):
+        sqp.all_book_ids = set(book_ids)
+        book_ids = Bitmap(book_ids)
         remove = set()
-        for query, result in tuple(self.cache):
+        for query in (self.cache.keys() if queries is None else queries):
+            result = self.cache.peek(query, unpack=False)
+            if result is None:
+                continue
             try:
                 matches = sqp.parse(query)
             except ParseException:
                 remove.add(query)
             else:
-                # remove books that no longer match
-                result.difference_update(book_ids - matches)
-                # add books that now match but did not before
-                result.update(matches)
+                # remove books that no longer match and add books that now
+                # match but did not before
+                self.cache.replace(query, (result - (book_ids - matches)) | matches)
+                self.dependencies[query] = self.dependencies_of(sqp)
         for query in remove:
             self.cache.pop(query)
+            self.dependencies.pop(query, None)
+
+    def dependencies_of(self, sqp):
+        return None if sqp.dependencies is None else frozenset(sqp.dependencies)
+
+    def add_to_cache(self, sqp, query, result):
+        self.cache.add(query, result)
+        self.dependencies[query] = self.dependencies_of(sqp)
+        if len(self.dependencies) > 2 * self.cache.limit:
+            # Forget the dependencies of queries that have been evicted
+            for query in frozenset(self.dependencies) - frozenset(self.cache.keys()):
+                self.dependencies.pop(query, None)
+
+    def bitmap(self, dbcache, query):
+        ''' Return the ids of all books matching query as a :class:`Bitmap`,
+        using the cached result if there is one. '''
+        query = query.strip()
+        ans = self.cache.get(query, unpack=False)
+        if ans is None:
+            sqp = self.create_parser(dbcache)
+            try:
+                ans = self._do_search(sqp, query, '', dbcache)
+            finally:
+                sqp.dbcache = sqp.lookup_saved_search = None
+        return as_bitmap(ans)
+
+    def intersection(self, dbcache, queries):
+        ''' Return the frozenset of ids of the books matching all of queries.
+        The result is cached, on a miss it is computed by intersecting the
+        bitmaps of the cached results for the individual queries. '''
+        queries = tuple(q.strip() for q in queries)
+        key = ' and '.join('(%s)' % q for q in queries)
+        ans = self.cache.get(key)
+        if ans is None:
+            bitmap = reduce(operator.and_, (self.bitmap(dbcache, q) for q in queries))
+            deps = tuple(self.dependencies.get(q) for q in queries)
+            self.cache.add(key, bitmap)
+            self.dependencies[key] = None if None in deps else frozenset().union(*deps)
+            ans = frozenset(bitmap)
+        return ans
 
     def create_parser(self, dbcache, virtual_fields=None):
         return Parser(
@@ -881,36 +1248,47 @@ class Search(object):
         # thread safe.
         sqp = self.create_parser(dbcache, virtual_fields)
         try:
-            return self._do_search(sqp, query, search_restriction, dbcache, book_ids=book_ids)
+            ans = self._do_search(sqp, query, search_restriction, dbcache, book_ids=book_ids)
         finally:
             sqp.dbcache = sqp.lookup_saved_search = None
+        # Results are computed and cached as bitmaps, callers get frozensets
+        return frozenset(ans) if isinstance(ans, Bitmap) else ans
 
     def _do_search(self, sqp, query, search_restriction, dbcache, book_ids=None):
         ''' Do the search, caching the results. Results are cached only if the
-        search is on the full library and no virtual field is searched on '''
+        search is on the full library and no virtual field is searched on.
+        Returns either a :class:`Bitmap` or a set of book ids. '''
         if isinstance(search_restriction, bytes):
             search_restriction = search_restriction.decode('utf-8')
         if isinstance(query, bytes):
             query = query.decode('utf-8')
 
         query = query.strip()
-        if book_ids is None and query and not search_restriction:
-            cached = self.cache.get(query)
+        restriction = search_restriction.strip() if search_restriction else ''
+        if book_ids is None and query and not restriction:
+            cached = self.cache.get(query, unpack=False)
             if cached is not None:
                 return cached
 
         restricted_ids = all_book_ids = dbcache._all_book_ids(type=set)
-        if search_restriction and search_restriction.strip():
-            cached = self.cache.get(search_restriction.strip())
+        if restriction:
+            cached = self.cache.get(restriction, unpack=False)
             if cached is None:
                 sqp.all_book_ids = all_book_ids if book_ids is None else book_ids
-                restricted_ids = sqp.parse(search_restriction)
+                restricted = sqp.parse(search_restriction)
                 if not sqp.virtual_field_used and sqp.all_book_ids is all_book_ids:
-                    self.cache.add(search_restriction.strip(), restricted_ids)
+                    self.add_to_cache(sqp, restriction, restricted)
             else:
-                restricted_ids = cached
-                if book_ids is not None:
-                    restricted_ids = book_ids.intersection(restricted_ids)
+                if book_ids is None and query and query in self.cache:
+                    # Both results are cached, intersect the bitmaps
+                    q = self.cache.get(query, unpack=False)
+                    if q is not None:
+                        return q & cached
+                restricted = cached if book_ids is None else cached & book_ids
+            if not query:
+                return restricted
+            # The fields look up the candidates in hash sets
+            restricted_ids = set(restricted)
         elif book_ids is not None:
             restricted_ids = book_ids
 
@@ -918,7 +1296,7 @@ class Search(object):
             return restricted_ids
 
         if restricted_ids is all_book_ids:
-            cached = self.cache.get(query)
+            cached = self.cache.get(query, unpack=False)
             if cached is not None:
                 return cached
 
@@ -926,6 +1304,6 @@ class Search(object):
         result = sqp.parse(query)
 
         if not sqp.virtual_field_used and sqp.all_book_ids is all_book_ids:
-            self.cache.add(query, result)
+            self.add_to_cache(sqp, query, result)
 
         return result
@@ -0,0 +1,81 @@
+#!/usr/bin/env python2
+# vim:fileencoding=utf-8
+# License: GPLv3 Copyright: 2019, Kovid Goyal <kovid at kovidgoyal.net>
+
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+from functools import wraps
+
+from calibre.db.cache import Cache
+from polyglot.builtins import iteritems, itervalues
+
+
+class ReadOnlySnapshotError(RuntimeError):
+    pass
+
+
+def read_only(name):
+    def write_not_allowed(*args, **kwargs):
+        raise ReadOnlySnapshotError('Cannot call %s() on a read-only snapshot of the library' % name)
+    return write_not_allowed
+
+
+class Snapshot(Cache):
+
+    '''
+    A read-only view of a library, with the metadata as it was when the
+    snapshot was created. Create it with :meth:`Cache.snapshot`. The
+    in-memory tables of the library are copied, so the snapshot has its own
+    locks and long running readers, such as catalog generation, can use it
+    without blocking writers to the library. The full read API is available,
+    calling any write API raises :class:`ReadOnlySnapshotError`.
+
+    The tables are copied, not shared copy-on-write, while holding the read
+    lock of the library, so creating a snapshot takes time and memory
+    proportional to the size of the library. Use it for readers that run
+    much longer than that, measure it with db/tests/benchmark.py.
+
+    Note that book files, covers and preferences are not part of the
+    snapshot. The APIs that read them are forwarded to the library, so that
+    they use its locks and the current locations of the files.
+    '''
+
+    # APIs that read from the database or the filesystem
+    LIVE_APIS = (
+        'format', 'cover', 'format_metadata', 'format_hash', 'format_files', 'pref', 'cover_or_cache',
+        'cover_last_modified', 'copy_cover_to', 'copy_format_to', 'format_abspath', 'has_format', 'formats',
+        'read_backup', 'get_custom_book_data', 'get_ids_for_custom_book_data', 'conversion_options',
+        'has_conversion_options', 'get_last_read_positions', 'last_modified',
+    )
+
+    def __init__(self, cache):
+        Cache.__init__(self, cache.backend)
+        for name in dir(self):
+            func = getattr(self, '_' + name, None)
+            if getattr(func, 'is_read_api', None) is False:
+                setattr(self, name, wraps(func)(read_only(name)))
+        for name in self.LIVE_APIS:
+            # The methods of the library acquire its read lock, so use them
+            # for the unlocked versions as well
+            func = getattr(cache, name)
+            setattr(self, name, func)
+            if hasattr(self, '_' + name):
+                setattr(self, '_' + name, func)
+
+        fields = self.fields = {name:field.snapshot() for name, field in iteritems(cache.fields)}
+        for field in itervalues(fields):
+            for attr in ('series_field', 'index_field', 'author_sort_field', 'title_sort_field'):
+                linked = getattr(field, attr, None)
+                if linked is not None:
+                    setattr(field, attr, fields[linked.name])
+        self.composites = {name:fields[name] for name in cache.composites}
+        self.dirtied_cache = cache.dirtied_cache.copy()
+        self.dirtied_sequence = cache.dirtied_sequence
+
+    def initialize_dynamic(self):
+        # The dynamic categories are stored in the field metadata, which is
+        # shared with the library
+        pass
+
+    def snapshot(self):
+        return self
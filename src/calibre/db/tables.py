@@ -8,6 +8,7 @@ __copyright__ = '2011, Kovid Goyal <kovid@kovidgoyal.net>'
 __docformat__ = 'restructuredtext en'
 
 import numbers
+from copy import copy
 from datetime import datetime, timedelta
 from collections import defaultdict
 
@@ -50,6 +51,18 @@ ONE_ONE, MANY_ONE, MANY_MANY = range(3)
 null = object()
 
 
+def snapshot_map(m):
+    ''' Copy the map m, along with any mutable values in it, such as the sets
+    in col_book_map, so that the copy is not affected by changes to m '''
+    ans = copy(m)
+    for val in itervalues(m):
+        if isinstance(val, (set, dict, list)):
+            for k, v in iteritems(m):
+                ans[k] = copy(v)
+        break
+    return ans
+
+
 class Table(object):
 
     def __init__(self, name, metadata, link_table=None):
@@ -71,6 +84,15 @@ class Table(object):
     def remove_books(self, book_ids, db):
         return set()
 
+    def snapshot(self):
+        ''' Return a copy of this table that is not affected by later changes
+        to this table '''
+        ans = copy(self)
+        for attr, val in iteritems(self.__dict__):
+            if isinstance(val, dict) and attr != 'metadata':
+                setattr(ans, attr, snapshot_map(val))
+        return ans
+
     def fix_link_table(self, db):
         pass
 
@@ -0,0 +1,82 @@
+#!/usr/bin/env python2
+# vim:fileencoding=utf-8
+# License: GPLv3 Copyright: 2019, Kovid Goyal <kovid at kovidgoyal.net>
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+# Measure the time taken to create a snapshot of a library, see
+# Cache.snapshot(). The snapshot copies the in-memory tables of the library,
+# so its cost grows with the number of books. Run it with:
+#   calibre-debug -e src/calibre/db/tests/benchmark.py [number of books] [path to library]
+# The books in the library are duplicated in memory, nothing is written to
+# disk, until there are the specified number of books (default 400000). If no
+# library is specified, a copy of the test library is used.
+
+import gc
+import os
+import shutil
+import sys
+import tempfile
+from copy import copy
+
+from calibre.utils.monotonic import monotonic
+from polyglot.builtins import itervalues, range
+
+
+def create_library():
+    base = os.path.dirname(os.path.abspath(__file__))
+    library_path = tempfile.mkdtemp(prefix='db-benchmark-')
+    shutil.copy2(os.path.join(base, 'metadata.db'), os.path.join(library_path, 'metadata.db'))
+    return library_path
+
+
+def inflate(cache, num_books):
+    ' Add copies of the existing books to the in-memory tables of cache, until it has num_books books '
+    book_ids = sorted(cache._all_book_ids())
+    next_id = book_ids[-1] + 1
+    tables = [f.table for f in itervalues(cache.fields)]
+    for i in range(num_books - len(book_ids)):
+        src, dest = book_ids[i % len(book_ids)], next_id + i
+        for table in tables:
+            bcm = getattr(table, 'book_col_map', None)
+            if bcm is None or src not in bcm:
+                continue
+            val = bcm[dest] = copy(bcm[src])
+            cbm = getattr(table, 'col_book_map', None)
+            if cbm is not None:
+                for item_id in (val if isinstance(val, (tuple, dict)) else (val,)):
+                    cbm[item_id].add(dest)
+            for attr in ('fname_map', 'size_map'):
+                m = getattr(table, attr, None)
+                if m is not None and src in m:
+                    m[dest] = copy(m[src])
+
+
+def main(args=sys.argv):
+    from calibre.db.backend import DB
+    from calibre.db.cache import Cache
+    num_books = int(args[1]) if len(args) > 1 else 400000
+    library_path = os.path.abspath(os.path.expanduser(args[2])) if len(args) > 2 else None
+    tdir = None
+    if library_path is None:
+        library_path = tdir = create_library()
+    try:
+        cache = Cache(DB(library_path))
+        cache.init()
+        inflate(cache, num_books)
+        print('Books in library:', len(cache.all_book_ids()))
+        times = []
+        for i in range(5):
+            gc.collect()
+            st = monotonic()
+            snapshot = cache.snapshot()
+            times.append(monotonic() - st)
+            del snapshot
+        print('Time to create a snapshot: min: %.3fs max: %.3fs' % (min(times), max(times)))
+        cache.close()
+    finally:
+        if tdir is not None:
+            shutil.rmtree(tdir, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()
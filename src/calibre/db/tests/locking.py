@@ -9,7 +9,7 @@ __copyright__ = '2013, Kovid Goyal <kovid at kovidgoyal.net>'
 import time, random
 from threading import Thread
 from calibre.db.tests.base import BaseTest
-from calibre.db.locking import SHLock, RWLockWrapper, LockingError
+from calibre.db.locking import SHLock, RWLockWrapper, LockingError, LockMetrics
 from polyglot.builtins import range
 
 
@@ -179,3 +179,28 @@ class TestLock(BaseTest):
         self.assertEqual(len(done), len(threads), 'SHLock locking failed')
         self.assertFalse(lock.is_shared)
         self.assertFalse(lock.is_exclusive)
+
+    def test_lock_metrics(self):
+        from calibre.db.cache import wrap_with_metrics
+        lock, metrics = SHLock(), LockMetrics()
+        r, w = RWLockWrapper(lock), RWLockWrapper(lock, is_shared=False)
+
+        def reader():
+            return lock.is_shared
+
+        def writer():
+            time.sleep(0.05)
+            return lock.is_exclusive
+        reader, writer = wrap_with_metrics(r, reader, metrics), wrap_with_metrics(w, writer, metrics)
+        self.assertEqual(reader(), 1)
+        self.assertEqual(writer(), 1)
+        self.assertEqual(reader(), 1)
+        self.assertFalse(lock.is_shared)
+        self.assertFalse(lock.is_exclusive)
+        s = metrics.stats()
+        self.assertEqual(s['apis']['reader']['calls'], 2)
+        self.assertEqual(s['apis']['writer']['calls'], 1)
+        self.assertGreaterEqual(s['apis']['writer']['max_hold'], 0.04)
+        self.assertEqual(s['longest_write_hold']['api'], 'writer')
+        metrics.clear()
+        self.assertEqual(metrics.stats()['apis'], {})
@@ -213,6 +213,12 @@ class ReadingTest(BaseTest):
         ae(list(range(1, 11)), cache.multisort([('#one', True), ('#two', True)], ids_to_sort=sorted(cache.all_book_ids())))
         ae([4, 5, 1, 2, 3, 7,8, 9, 10, 6], cache.multisort([('#one', True), ('#two', False)], ids_to_sort=sorted(cache.all_book_ids())))
         ae([5, 4, 3, 2, 1, 10, 9, 8, 7, 6], cache.multisort([('#one', True), ('#two', False), ('#three', False)], ids_to_sort=sorted(cache.all_book_ids())))
+
+        # Test that cached sort keys are invalidated on changes
+        ae([1, 2, 3], cache.multisort([('#three', True)], ids_to_sort=(3, 2, 1)))
+        cache.set_field('#three', {1:20})
+        ae([2, 3, 1], cache.multisort([('#three', True)], ids_to_sort=(3, 2, 1)))
+        ae([1, 3, 2], cache.multisort([('#one', True), ('#three', False)], ids_to_sort=(1, 2, 3)))
     # }}}
 
     def test_get_metadata(self):  # {{{
@@ -515,6 +521,13 @@ class ReadingTest(BaseTest):
         se({1,2}, cache.books_in_virtual_library('12'))
         se({1}, cache.books_in_virtual_library('12', 'id:1'))
         se({2}, cache.books_in_virtual_library('1', 'id:1 or id:2'))
+        from calibre.db.utils import Bitmap
+        bm = cache.books_in_virtual_library('12', 'id:1', as_bitmap=True)
+        self.assertIsInstance(bm, Bitmap), se({1}, set(bm))
+        se(cache.all_book_ids(), set(cache.books_in_virtual_library('', as_bitmap=True)))
+        se({1, 2}, cache.search('vl:12'))
+        se({3}, cache.search('not vl:12'))
+        se({1, 3}, cache.search('not vl:1 and (id:1 or id:3)'))
     # }}}
 
     def test_search_caching(self):  # {{{
@@ -525,8 +538,8 @@ class ReadingTest(BaseTest):
             hit_counter = 0
             miss_counter = 0
 
-            def get(self, key, default=None):
-                ans = LRUCache.get(self, key, default=default)
+            def get(self, key, default=None, unpack=True):
+                ans = LRUCache.get(self, key, default=default, unpack=unpack)
                 if ans is not None:
                     self.hit_counter += 1
                 else:
@@ -557,7 +570,7 @@ class ReadingTest(BaseTest):
         test(True, {3}, 'Unknown')
         cache._search_api.MAX_CACHE_UPDATE = 0
         cache.set_field('title', {3:'xxx'})
-        test(False, {3}, 'Unknown')  # cache cleared
+        test(False, {3}, 'Unknown')  # dependencies unknown because of composite columns, so removed
         test(True, {3}, 'Unknown')
         c.limit = 5
         for i in range(6):
@@ -571,6 +584,91 @@ class ReadingTest(BaseTest):
         cache.set_field('publisher', {3:'ppppp', 2:'other'})
         # Test cache update worked
         test(True, {2, 3}, 'title:=xxx or title:"=Title One"')
+
+        # Queries are re-evaluated only if they depend on the changed fields,
+        # however many books changed
+        cache._search_api.MAX_CACHE_UPDATE = 0
+        test(False, {3}, 'publisher:=ppppp')
+        ae(cache._search_api.dependencies['publisher:=ppppp'], frozenset({'publisher'}))
+        cache.set_field('publisher', {1:'ppppp'})
+        ae(c.peek('publisher:=ppppp'), {1, 3})
+        test(True, {2, 3}, 'title:=xxx or title:"=Title One"')
+        cache.set_field('title', {1:'xxx'})
+        ae(c.peek('title:=xxx or title:"=Title One"'), {1, 2, 3})
+        ae(c.peek('publisher:=ppppp'), {1, 3})
+
+        # Test the size bound and compact storage
+        import sys
+        from calibre.db.search import size_of_bitmap
+        from calibre.db.utils import Bitmap
+        c = LRUCache(limit=10, max_size=3 * size_of_bitmap(Bitmap({10, 11})),
+                     pack=Bitmap, unpack=frozenset, size_of=size_of_bitmap)
+        for i in range(4):
+            c.add(i, {i + 10, i + 11})
+        ae(len(c), 3)
+        ae(c.get(0), None)
+        ae(c.get(1), {11, 12})
+        self.assertIsInstance(c.get(1), frozenset)
+        c.add(4, {7, 8})
+        ae(c.get(2), None)
+        ae(dict(c), {1: {11, 12}, 3: {13, 14}, 4: {7, 8}})
+        ae(c.get(4, unpack=False), Bitmap({7, 8}))
+        ae({k:v for k, v in iteritems(c.stats()) if k != 'size'}, {'hits': 3, 'misses': 2, 'evictions': 2, 'entries': 3})
+
+        # The byte bound counts the memory really used by large results
+        big = set(range(1, 400001))
+        sz = size_of_bitmap(Bitmap(big))
+        self.assertGreaterEqual(sz, Bitmap(big).nbytes)
+        self.assertLess(sz * 20, sys.getsizeof(big))
+        c = LRUCache(limit=10, max_size=2 * sz, pack=Bitmap, unpack=frozenset, size_of=size_of_bitmap)
+        for i in range(3):
+            c.add(i, big)
+            self.assertLessEqual(c.stats()['size'], 2 * sz)
+        ae(len(c), 2), ae(c.stats()['size'], 2 * sz)
+        ae(c.get(0), None)
+        ae(c.get(2), big)
+
+        # Bitmaps are taken from the cache, including on a miss
+        cache = self.init_cache()
+        bm = cache._search_api.bitmap(cache, 'tags:one')
+        self.assertIs(bm, cache._search_api.cache.peek('tags:one', unpack=False))
+        ae(set(bm), cache.search('tags:one'))
+    # }}}
+
+    def test_search_index(self):  # {{{
+        ' Test that searches using the inverted index match full scans '
+        cache = self.init_cache()
+        queries = (
+            'tags:one', 'tags:=one', 'tags:"=tag one"', 'tags:"=Tag Two"', 'tags:.tag',
+            'tags:"=.tag one"', 'tags:..one', 'tags:~^t', 'title:one', 'title:"=title one"',
+            'series:"=a series one"', 'publisher:one', 'authors:"=author one"', 'one',
+            '#tags:"=My Tag One"', '#enum:=one', 'languages:eng', 'not tags:news',
+        )
+
+        def results():
+            cache._search_api.clear_caches()
+            return {q:cache.search(q) for q in queries}
+
+        def check():
+            cache.search_index.enabled = False
+            cache.search_index.clear()
+            scanned = results()
+            cache.search_index.enabled = True
+            self.assertEqual(scanned, results())
+
+        check()
+        self.assertIn('tags', cache.search_index.indices)
+        cache.set_field('tags', {1:('Tag One', 'Tag.Sub'), 3:('news', 'tag three')})
+        check()
+        self.assertEqual(cache.search('tags:"=.tag"'), {1})
+        cache.set_field('title', {2:'Changed'})
+        check()
+        cache.rename_items('tags', {cache.get_item_id('tags', 'tag three'):'Tag Four'})
+        check()
+        self.assertEqual(cache.search('tags:"=tag four"'), {3})
+        cache.remove_books((1,))
+        check()
+        self.assertEqual(cache.search('tags:"=tag one"'), {2})
     # }}}
 
     def test_proxy_metadata(self):  # {{{
@@ -10,7 +10,7 @@ import shutil
 
 from calibre import walk
 from calibre.db.tests.base import BaseTest
-from calibre.db.utils import ThumbnailCache
+from calibre.db.utils import Bitmap, ThumbnailCache
 
 
 class UtilsTest(BaseTest):
@@ -82,3 +82,21 @@ class UtilsTest(BaseTest):
         self.assertEqual(len(c), 0)
         self.assertEqual(tuple(walk(c.location)), ())
     # }}}
+
+    def test_bitmap(self):  # {{{
+        ae = self.assertEqual
+        a, b = {1, 3, 8, 64, 1000}, {0, 3, 9, 64, 999, 4000}
+        x, y = Bitmap(a), Bitmap(b)
+        ae(set(x), a), ae(len(x), len(a)), ae(sorted(y), sorted(b))
+        ae(Bitmap(), set()), ae(len(Bitmap(())), 0), self.assertFalse(Bitmap())
+        for op in ('__and__', '__or__', '__sub__', '__xor__'):
+            ae(set(getattr(x, op)(y)), getattr(a, op)(b), op)
+            ae(set(getattr(x, op)(b)), getattr(a, op)(b), op)
+        ae(set(b - x), b - a), ae(set(b & x), a & b)
+        for i in (0, 1, 2, 8, 1000, 1001, -1, 'x'):
+            ae(i in x, i in a)
+        ae(x, a), ae(x, Bitmap(a)), ae(hash(x), hash(Bitmap(list(a))))
+        self.assertTrue(Bitmap({3, 64}) <= x), self.assertFalse(x <= y)
+        self.assertTrue(x.isdisjoint({2, 4})), self.assertFalse(x.isdisjoint(y))
+        ae(x.nbytes, 126)
+    # }}}
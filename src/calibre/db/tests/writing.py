@@ -7,7 +7,9 @@ __license__   = 'GPL v3'
 __copyright__ = '2013, Kovid Goyal <kovid at kovidgoyal.net>'
 __docformat__ = 'restructuredtext en'
 
+import os
 from collections import namedtuple
+from copy import deepcopy
 from functools import partial
 from io import BytesIO
 
@@ -749,3 +751,41 @@ class WritingTest(BaseTest):
         prefs['test mutable'] = {k:k for k in reversed(range(10))}
         self.assertEqual(len(changes), 3, 'The database was written to despite there being no change in value')
     # }}}
+
+    def test_snapshot(self):  # {{{
+        ' Test that snapshots are not affected by changes to the library '
+        from calibre.db.snapshot import ReadOnlySnapshotError
+        cache = self.init_cache()
+        ae = self.assertEqual
+        fields = ('title', 'sort', 'authors', 'author_sort', 'tags', 'series', 'series_index', 'identifiers', 'formats', '#tags', '#comp_tags')
+        # field_for() can return the values held by the tables, which the
+        # writes below change in place, so keep copies of them
+        before = {f:{b:deepcopy(cache.field_for(f, b)) for b in cache.all_book_ids()} for f in fields}
+        searches = {q:cache.search(q) for q in ('tags:one', 'title:"=Title One"', 'identifiers:test:', '#comp_tags:one')}
+        order = cache.multisort([('title', True), ('tags', False)])
+        snap = cache.snapshot()
+        cache.set_field('title', {1:'changed'})
+        cache.set_field('tags', {1:('changed',), 2:()})
+        cache.set_field('series', {1:'changed [3]'})
+        cache.set_field('identifiers', {1:{'new':'1'}})
+        cache.rename_items('authors', {cache.get_item_id('authors', 'Author One'):'changed'})
+        cache.remove_formats({1:('FMT1',)})
+        cache.remove_books((3,))
+        ae(snap.all_book_ids(), {1, 2, 3})
+        for f, vals in iteritems(before):
+            for book_id, val in iteritems(vals):
+                ae(snap.field_for(f, book_id), val, 'Snapshot changed for %s of book %d' % (f, book_id))
+        for q, result in iteritems(searches):
+            ae(snap.search(q), result)
+        ae(snap.get_metadata(1).title, before['title'][1])
+        ae(snap.multisort([('title', True), ('tags', False)]), order)
+        self.assertRaises(ReadOnlySnapshotError, snap.set_field, 'title', {1:'x'})
+        self.assertRaises(ReadOnlySnapshotError, snap.remove_books, (1,))
+        # Files are read from the library, at their current locations
+        ae(snap.format_abspath(1, 'FMT2'), cache.format_abspath(1, 'FMT2'))
+        self.assertTrue(os.path.exists(snap.format_abspath(1, 'FMT2')))
+        ae(snap.format(1, 'FMT2'), cache.format(1, 'FMT2'))
+        ae(snap.cover(1), cache.cover(1))
+        ae(cache.field_for('title', 1), 'changed')
+        ae(cache.field_for('title', 2), snap.field_for('title', 2))
+    # }}}
@@ -7,9 +7,11 @@ __license__ = 'GPL v3'
 __copyright__ = '2013, Kovid Goyal <kovid at kovidgoyal.net>'
 
 import os, errno, sys, re
+from binascii import hexlify, unhexlify
 from locale import localeconv
 from collections import OrderedDict, namedtuple
-from polyglot.builtins import iteritems, itervalues, map, unicode_type, string_or_bytes
+from polyglot.builtins import iteritems, itervalues, map, range, unicode_type, string_or_bytes
+from polyglot.collections_abc import Iterable, Set, MutableSet
 from threading import Lock
 
 from calibre import as_unicode, prints
@@ -383,6 +385,138 @@ class ThumbnailCache(object):
                 self._apply_size()
 
 
+BIT_MASKS = tuple(1 << i for i in range(8))
+BIT_POSITIONS = tuple(tuple(i for i in range(8) if b & (1 << i)) for b in range(256))
+
+
+class Bitmap(Set):  # {{{
+
+    '''
+    An immutable set of non-negative integers (book ids) stored as a bitmap,
+    using one bit per possible id. Union, intersection and difference with
+    other bitmaps operate on whole machine words and the bitmap is much
+    smaller than the equivalent set of ints, which makes it suitable for
+    caching search results. Operations with other iterables convert them to
+    bitmaps first.
+    '''
+
+    __slots__ = ('bits',)
+
+    def __init__(self, book_ids=()):
+        if isinstance(book_ids, Bitmap):
+            self.bits = book_ids.bits
+            return
+        if not isinstance(book_ids, (Set, MutableSet, tuple, list)):
+            book_ids = tuple(book_ids)
+        if not book_ids:
+            self.bits = 0
+            return
+        buf = bytearray((max(book_ids) >> 3) + 1)
+        for book_id in book_ids:
+            buf[book_id >> 3] |= BIT_MASKS[book_id & 7]
+        buf.reverse()
+        self.bits = int(hexlify(bytes(buf)), 16)
+
+    @classmethod
+    def from_bits(cls, bits):
+        ans = cls()
+        ans.bits = bits
+        return ans
+
+    @classmethod
+    def _from_iterable(cls, it):
+        return cls(it)
+
+    @property
+    def nbytes(self):
+        return (self.bits.bit_length() + 7) >> 3
+
+    def __iter__(self):
+        if not self.bits:
+            return
+        h = '%x' % self.bits
+        if len(h) & 1:
+            h = '0' + h
+        buf = bytearray(unhexlify(h.encode('ascii')))
+        buf.reverse()
+        for i, byte in enumerate(buf):
+            if byte:
+                base = i << 3
+                for bit in BIT_POSITIONS[byte]:
+                    yield base + bit
+
+    def __len__(self):
+        return bin(self.bits).count('1')
+
+    def __bool__(self):
+        return self.bits != 0
+    __nonzero__ = __bool__
+
+    def __contains__(self, book_id):
+        try:
+            return book_id >= 0 and bool((self.bits >> book_id) & 1)
+        except TypeError:
+            return False
+
+    def __hash__(self):
+        return hash(self.bits)
+
+    def __eq__(self, other):
+        if isinstance(other, Bitmap):
+            return self.bits == other.bits
+        return Set.__eq__(self, other)
+
+    def __ne__(self, other):
+        return not self.__eq__(other)
+
+    def __le__(self, other):
+        if isinstance(other, Bitmap):
+            return not (self.bits & ~other.bits)
+        return Set.__le__(self, other)
+
+    def __ge__(self, other):
+        if isinstance(other, Bitmap):
+            return not (other.bits & ~self.bits)
+        return Set.__ge__(self, other)
+
+    def _coerce(self, other):
+        if isinstance(other, Bitmap):
+            return other.bits
+        if not isinstance(other, Iterable):
+            return None
+        return Bitmap(other).bits
+
+    def __and__(self, other):
+        o = self._coerce(other)
+        return NotImplemented if o is None else Bitmap.from_bits(self.bits & o)
+    __rand__ = __and__
+
+    def __or__(self, other):
+        o = self._coerce(other)
+        return NotImplemented if o is None else Bitmap.from_bits(self.bits | o)
+    __ror__ = __or__
+
+    def __xor__(self, other):
+        o = self._coerce(other)
+        return NotImplemented if o is None else Bitmap.from_bits(self.bits ^ o)
+    __rxor__ = __xor__
+
+    def __sub__(self, other):
+        o = self._coerce(other)
+        return NotImplemented if o is None else Bitmap.from_bits(self.bits & ~o)
+
+    def __rsub__(self, other):
+        o = self._coerce(other)
+        return NotImplemented if o is None else Bitmap.from_bits(o & ~self.bits)
+
+    def isdisjoint(self, other):
+        return not (self.bits & self._coerce(other))
+
+    def __repr__(self):
+        return 'Bitmap(%r)' % sorted(self)
+# }}}
+
+
 number_separators = None
 
 
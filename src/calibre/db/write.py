@@ -504,6 +504,13 @@ def identifiers(book_id_val_map, db, field, *args):  # {{{
 # }}}
 
 
+# Fields that are also changed when the keyed field is written
+IMPLICITLY_WRITTEN_FIELDS = {
+    'title': frozenset(('sort',)),
+    'authors': frozenset(('author_sort',)),
+}
+
+
 def dummy(book_id_val_map, *args):
     return set()
 
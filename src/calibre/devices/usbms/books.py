@@ -9,6 +9,7 @@ from functools import cmp_to_key
 
 from calibre.ebooks.metadata import title_sort
 from calibre.ebooks.metadata.book.base import Metadata
+from calibre.ebooks.metadata.book.json_codec import JsonCodec as _JsonCodec
 from calibre.devices.mime import mime_type_ext
 from calibre.devices.interface import BookList as _BookList
 from calibre.constants import preferred_encoding
@@ -70,6 +71,20 @@ class Book(Metadata):
         return None
 
 
+class JsonCodec(_JsonCodec):
+
+    ''' Also stores the modification time of the book file, so that files that
+    have not changed can be skipped when the device is scanned. The decoder
+    restores it as the file_mtime attribute of the book. '''
+
+    def encode_book_metadata(self, book):
+        result = _JsonCodec.encode_book_metadata(self, book)
+        mtime = getattr(book, 'file_mtime', None)
+        if mtime is not None:
+            result['file_mtime'] = mtime
+        return result
+
+
 class BookList(_BookList):
 
     def __init__(self, oncard, prefix, settings):
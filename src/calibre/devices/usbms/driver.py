@@ -18,8 +18,7 @@ from calibre import prints, isbytestring, fsync
 from calibre.constants import filesystem_encoding, DEBUG
 from calibre.devices.usbms.cli import CLI
 from calibre.devices.usbms.device import Device
-from calibre.devices.usbms.books import BookList, Book
-from calibre.ebooks.metadata.book.json_codec import JsonCodec
+from calibre.devices.usbms.books import BookList, Book, JsonCodec
 from polyglot.builtins import itervalues, unicode_type, string_or_bytes
 
 BASE_TIME = None
@@ -33,6 +32,39 @@ def debug_print(*args):
         prints('DEBUG: %6.1f'%(time.time()-BASE_TIME), *args)
 
 
+def run_in_threads(func, items, num_threads=4):
+    ''' Call func(*item) for every item in items using a pool of threads.
+    Yields (index, item, result) in the order in which the calls complete.
+    If a call fails, the traceback is printed and its result is None. '''
+    from threading import Thread
+    from polyglot.queue import Queue, Empty
+    tasks, results = Queue(), Queue()
+    for item in items:
+        tasks.put(item)
+
+    def worker():
+        while True:
+            try:
+                item = tasks.get_nowait()
+            except Empty:
+                break
+            try:
+                result = func(*item)
+            except Exception:
+                import traceback
+                traceback.print_exc()
+                result = None
+            results.put((item, result))
+
+    for i in range(max(1, min(num_threads, len(items)))):
+        t = Thread(target=worker, name='DeviceScan')
+        t.daemon = True
+        t.start()
+    for i in range(len(items)):
+        item, result = results.get()
+        yield i, item, result
+
+
 def safe_walk(top, topdown=True, onerror=None, followlinks=False):
     ' A replacement for os.walk that does not die when it encounters undecodeable filenames in a linux filesystem'
     islink, join, isdir = os.path.islink, os.path.join, os.path.isdir
@@ -99,6 +131,9 @@ class USBMS(CLI, Device):
     DRIVEINFO = 'driveinfo.calibre'
 
     SCAN_FROM_ROOT = False
+    # Number of threads used to read metadata from book files when scanning
+    # the device
+    SCAN_THREADS = 4
 
     def _update_driveinfo_record(self, dinfo, prefix, location_code, name=None):
         from calibre.utils.date import now, isoformat
@@ -220,29 +255,26 @@ class USBMS(CLI, Device):
             bl_cache[b.lpath] = idx
 
         all_formats = self.formats_to_scan_for()
+        # The files to scan, as (lpath, index into bl or None for new books)
+        scan_list, seen = [], set()
 
-        def update_booklist(filename, path, prefix):
-            changed = False
+        def add_to_scan_list(filename, path):
             if path_to_ext(filename) in all_formats and self.is_allowed_book_file(filename, path, prefix):
                 try:
                     lpath = os.path.join(path, filename).partition(self.normalize_path(prefix))[2]
                     if lpath.startswith(os.sep):
                         lpath = lpath[len(os.sep):]
                     lpath = lpath.replace('\\', '/')
-                    idx = bl_cache.get(lpath, None)
-                    if idx is not None:
-                        bl_cache[lpath] = None
-                        if self.update_metadata_item(bl[idx]):
-                            # print 'update_metadata_item returned true'
-                            changed = True
-                    else:
-                        if bl.add_book(self.book_from_path(prefix, lpath),
-                                              replace_metadata=False):
-                            changed = True
+                    if lpath not in seen:
+                        seen.add(lpath)
+                        idx = bl_cache.get(lpath, None)
+                        if idx is not None:
+                            bl_cache[lpath] = None
+                        scan_list.append((lpath, idx))
                 except:  # Probably a filename encoding error
                     import traceback
                     traceback.print_exc()
-            return changed
+
         if isinstance(ebook_dirs, string_or_bytes):
             ebook_dirs = [ebook_dirs]
         for ebook_dir in ebook_dirs:
@@ -258,25 +290,31 @@ class USBMS(CLI, Device):
                 continue
             # Get all books in the ebook_dir directory
             if self.SUPPORTS_SUB_DIRS or self.SUPPORTS_SUB_DIRS_FOR_SCAN:
-                # build a list of files to check, so we can accurately report progress
-                flist = []
                 for path, dirs, files in safe_walk(ebook_dir):
+                    path = self.path_to_unicode(path)
                     for filename in files:
                         if filename != self.METADATA_CACHE:
-                            flist.append({'filename': self.path_to_unicode(filename),
-                                          'path':self.path_to_unicode(path)})
-                for i, f in enumerate(flist):
-                    self.report_progress(i/float(len(flist)), _('Getting list of books on device...'))
-                    changed = update_booklist(f['filename'], f['path'], prefix)
-                    if changed:
-                        need_sync = True
+                            add_to_scan_list(self.path_to_unicode(filename), path)
             else:
-                paths = os.listdir(ebook_dir)
-                for i, filename in enumerate(paths):
-                    self.report_progress((i+1) / float(len(paths)), _('Getting list of books on device...'))
-                    changed = update_booklist(self.path_to_unicode(filename), ebook_dir, prefix)
-                    if changed:
-                        need_sync = True
+                for filename in os.listdir(ebook_dir):
+                    add_to_scan_list(self.path_to_unicode(filename), ebook_dir)
+
+        def scan_book(lpath, idx):
+            # Runs in a worker thread. Existing books are only re-read if the
+            # size or modification time of their file has changed.
+            if idx is None:
+                return self.book_from_path(prefix, lpath)
+            return self.update_metadata_item(bl[idx])
+
+        # Reading metadata is mostly waiting on the device, so read several
+        # files at once, reporting progress as each one completes.
+        for i, (lpath, idx), result in run_in_threads(scan_book, scan_list, self.SCAN_THREADS):
+            self.report_progress((i+1) / float(len(scan_list)), _('Getting list of books on device...'))
+            if idx is None:
+                if result is not None and bl.add_book(result, replace_metadata=False):
+                    need_sync = True
+            elif result:
+                need_sync = True
 
         # Remove books that are no longer in the filesystem. Cache contains
         # indices into the booklist if book not in filesystem, None otherwise
@@ -375,8 +413,10 @@ class USBMS(CLI, Device):
             if lpath.startswith('/') or lpath.startswith('\\'):
                 lpath = lpath[1:]
             book = self.book_class(prefix, lpath, other=info)
+            st = os.stat(self.normalize_path(path))
             if book.size is None:
-                book.size = os.stat(self.normalize_path(path)).st_size
+                book.size = st.st_size
+            book.file_mtime = st.st_mtime
             b = booklists[blist].add_book(book, replace_metadata=True)
             if b:
                 b._new_book = True
@@ -503,12 +543,18 @@ class USBMS(CLI, Device):
     @classmethod
     def update_metadata_item(cls, book):
         changed = False
-        size = os.stat(cls.normalize_path(book.path)).st_size
-        if size != book.size:
+        st = os.stat(cls.normalize_path(book.path))
+        # Caches written by older versions do not have the modification time,
+        # for those only the size is compared
+        mtime = getattr(book, 'file_mtime', None)
+        if st.st_size != book.size or (mtime is not None and mtime != st.st_mtime):
             changed = True
             mi = cls.metadata_from_path(book.path)
             book.smart_update(mi)
-            book.size = size
+            book.size = st.st_size
+        if mtime != st.st_mtime:
+            changed = True
+            book.file_mtime = st.st_mtime
         return changed
 
     @classmethod
@@ -536,6 +582,7 @@ class USBMS(CLI, Device):
         if mi is None:
             mi = Metadata(os.path.splitext(os.path.basename(lpath))[0],
                     [_('Unknown')])
-        size = os.stat(cls.normalize_path(os.path.join(prefix, lpath))).st_size
-        book = cls.book_class(prefix, lpath, other=mi, size=size)
+        st = os.stat(cls.normalize_path(os.path.join(prefix, lpath)))
+        book = cls.book_class(prefix, lpath, other=mi, size=st.st_size)
+        book.file_mtime = st.st_mtime
         return book
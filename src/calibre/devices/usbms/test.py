@@ -0,0 +1,119 @@
+#!/usr/bin/env python2
+# vim:fileencoding=utf-8
+# License: GPLv3 Copyright: 2019, Kovid Goyal <kovid at kovidgoyal.net>
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+import json
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+from calibre.devices.usbms.books import Book, JsonCodec
+from calibre.devices.usbms.driver import USBMS, run_in_threads
+from calibre.ebooks.metadata.book.base import Metadata
+
+
+class Driver(USBMS):
+
+    read_paths = []
+
+    @classmethod
+    def metadata_from_path(cls, path):
+        cls.read_paths.append(path)
+        return Metadata('Read from file', ['Some Author'])
+
+
+class TestUSBMS(unittest.TestCase):
+
+    def setUp(self):
+        self.prefix = tempfile.mkdtemp(prefix='usbms-test-')
+        self.lpath = 'books/one.epub'
+        self.path = os.path.join(self.prefix, 'books', 'one.epub')
+        os.mkdir(os.path.dirname(self.path))
+        with open(self.path, 'wb') as f:
+            f.write(b'a' * 100)
+        # Use whole seconds, so that the mtime survives filesystems with
+        # coarse timestamps
+        self.mtime = int(os.stat(self.path).st_mtime) - 100
+        os.utime(self.path, (self.mtime, self.mtime))
+        del Driver.read_paths[:]
+
+    def tearDown(self):
+        shutil.rmtree(self.prefix, ignore_errors=True)
+
+    def cached_book(self, with_mtime=True):
+        book = Book(self.prefix, self.lpath, size=100, other=Metadata('Cached', ['Cached Author']))
+        if with_mtime:
+            book.file_mtime = os.stat(self.path).st_mtime
+        return book
+
+    def round_trip(self, book):
+        codec = JsonCodec()
+        raw = json.loads(json.dumps(codec.encode_book_metadata(book)))
+        return raw, codec.raw_to_book(raw, Book, self.prefix)
+
+    def test_unchanged_file_is_skipped(self):
+        book = self.cached_book()
+        self.assertFalse(Driver.update_metadata_item(book))
+        self.assertEqual(Driver.read_paths, [])
+        self.assertEqual(book.title, 'Cached')
+
+    def test_changed_mtime_is_reread(self):
+        book = self.cached_book()
+        os.utime(self.path, (self.mtime + 10, self.mtime + 10))
+        self.assertTrue(Driver.update_metadata_item(book))
+        self.assertEqual(Driver.read_paths, [book.path])
+        self.assertEqual(book.title, 'Read from file')
+        self.assertEqual(book.size, 100)
+        self.assertEqual(book.file_mtime, os.stat(self.path).st_mtime)
+        # The book is not read again once the new mtime has been recorded
+        self.assertFalse(Driver.update_metadata_item(book))
+        self.assertEqual(len(Driver.read_paths), 1)
+
+    def test_codec_round_trip(self):
+        book = self.cached_book()
+        raw, decoded = self.round_trip(book)
+        self.assertEqual(raw['file_mtime'], book.file_mtime)
+        self.assertEqual(decoded.file_mtime, book.file_mtime)
+        self.assertEqual(decoded.lpath, self.lpath)
+        self.assertFalse(Driver.update_metadata_item(decoded))
+        self.assertEqual(Driver.read_paths, [])
+
+    def test_old_cache_is_upgraded(self):
+        raw, decoded = self.round_trip(self.cached_book(with_mtime=False))
+        self.assertNotIn('file_mtime', raw)
+        self.assertIsNone(getattr(decoded, 'file_mtime', None))
+        # The size is unchanged, so only the mtime is recorded, the file is
+        # not read
+        self.assertTrue(Driver.update_metadata_item(decoded))
+        self.assertEqual(Driver.read_paths, [])
+        self.assertEqual(decoded.title, 'Cached')
+        raw, decoded = self.round_trip(decoded)
+        self.assertEqual(raw['file_mtime'], os.stat(self.path).st_mtime)
+        self.assertFalse(Driver.update_metadata_item(decoded))
+
+    def test_run_in_threads(self):
+        def func(x):
+            if x % 3 == 0:
+                raise ValueError('failed on purpose')
+            return x * 10
+
+        items = [(x,) for x in range(20)]
+        # Failed calls print their tracebacks, keep them out of the test output
+        orig, sys.stderr = sys.stderr, open(os.devnull, 'w')
+        try:
+            results = list(run_in_threads(func, items, num_threads=4))
+        finally:
+            sys.stderr.close()
+            sys.stderr = orig
+        self.assertEqual([i for i, item, result in results], list(range(len(items))))
+        self.assertEqual(sorted(item for i, item, result in results), items)
+        for i, (x,), result in results:
+            self.assertEqual(result, None if x % 3 == 0 else x * 10)
+        self.assertEqual(list(run_in_threads(func, [])), [])
+
+
+def find_tests():
+    return unittest.defaultTestLoader.loadTestsFromTestCase(TestUSBMS)
@@ -191,7 +191,7 @@ def add_pipeline_options(parser, plumber):
                   [
                       'base_font_size', 'disable_font_rescaling',
                       'font_size_mapping', 'embed_font_family',
-                      'subset_embedded_fonts', 'embed_all_fonts',
+                      'subset_embedded_fonts', 'subset_fonts_in_parallel', 'embed_all_fonts',
                       'line_height', 'minimum_line_height',
                       'linearize_tables',
                       'extra_css', 'filter_css', 'transform_css_rules', 'expand_css',
@@ -0,0 +1,77 @@
+#!/usr/bin/env python2
+# vim:fileencoding=utf-8
+# License: GPLv3 Copyright: 2019, Kovid Goyal <kovid at kovidgoyal.net>
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+'''
+Run the expensive, independent parts of conversion transforms in worker
+processes. Currently only font subsetting does this, with each font as a
+separate job, when the subset_fonts_in_parallel conversion option is set.
+'''
+
+from calibre import detect_ncpus
+from polyglot.queue import Empty
+
+
+def run_in_workers(module, func, args_list, name='ConversionWorker', pool=None):
+    '''
+    Call func from module once for every tuple of arguments in args_list, in
+    worker processes, and return the results in the same order as args_list.
+    Raises :class:`calibre.utils.ipc.simple_worker.WorkerError` if any of the
+    calls fails and :class:`calibre.utils.ipc.pool.Failure` if a worker
+    process crashes. If pool is specified, its workers are used and it is
+    left running, so that it can be re-used, otherwise a new pool is created
+    and shutdown.
+    '''
+    from calibre.utils.ipc.pool import Pool, Failure
+    from calibre.utils.ipc.simple_worker import WorkerError
+    if not args_list:
+        return []
+    own_pool = pool is None
+    if own_pool:
+        pool = Pool(max_workers=min(len(args_list), detect_ncpus()), name=name)
+    ans = {}
+    try:
+        for i, args in enumerate(args_list):
+            pool(i, module, func, *args)
+        while len(ans) < len(args_list):
+            try:
+                worker_result = pool.results.get(True, 0.1)
+            except Empty:
+                if pool.failed:
+                    raise Failure(pool.terminal_failure)
+                continue
+            if worker_result.is_terminal_failure:
+                raise Failure(pool.terminal_failure)
+            result = worker_result.result
+            if result.err is not None:
+                raise WorkerError(result.err, result.traceback)
+            ans[worker_result.id] = result.value
+    finally:
+        if own_pool:
+            pool.shutdown()
+    return [ans[i] for i in range(len(args_list))]
+
+
+def find_tests():
+    import unittest
+
+    class TestParallel(unittest.TestCase):
+
+        def test_parallel_subset(self):
+            from calibre.ebooks.oeb.transforms.subset import subset_in_worker
+            fonts = [P('fonts/liberation/%s.ttf' % name, data=True) for name in (
+                'LiberationSerif-Regular', 'LiberationSans-Bold', 'LiberationMono-Italic')]
+            args_list = [(raw, chars) for raw in fonts for chars in (
+                {ord(c) for c in 'abcdefghij'}, {ord(c) for c in 'The quick brown fox'})]
+            args_list.append((b'\0\0\0\0' * 16, {ord('a')}))  # Unsupported font
+            serial = [subset_in_worker(*args) for args in args_list]
+            parallel = run_in_workers('calibre.ebooks.oeb.transforms.subset', 'subset_in_worker', args_list)
+            self.assertEqual(len(serial), len(parallel))
+            for s, p in zip(serial, parallel):
+                if isinstance(s, Exception):
+                    self.assertIs(type(s), type(p))
+                else:
+                    self.assertEqual(s, p)
+
+    return unittest.defaultTestLoader.loadTestsFromTestCase(TestParallel)
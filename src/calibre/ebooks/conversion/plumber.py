@@ -232,6 +232,15 @@ OptionRecommendation(name='subset_embedded_fonts',
             'particularly large font with lots of unused glyphs.')
         ),
 
+OptionRecommendation(name='subset_fonts_in_parallel',
+        recommended_value=False, level=OptionRecommendation.LOW,
+        help=_(
+            'Subset the embedded fonts in multiple worker processes, one font '
+            'per process. This speeds up the conversion of books with many '
+            'large fonts on computers with multiple CPU cores, at the cost of '
+            'extra memory. It has no effect unless fonts are being subset.')
+        ),
+
 OptionRecommendation(name='linearize_tables',
             recommended_value=False, level=OptionRecommendation.LOW,
             help=_('Some badly designed documents use tables to control the '
@@ -16,7 +16,7 @@ from calibre.ebooks.docx.writer.images import ImagesManager
 from calibre.ebooks.docx.writer.fonts import FontsManager
 from calibre.ebooks.docx.writer.tables import Table
 from calibre.ebooks.docx.writer.lists import ListsManager
-from calibre.ebooks.oeb.stylizer import Stylizer as Sz, Style as St
+from calibre.ebooks.oeb.stylizer import Stylizer as Sz, Style as St, shared_stylesheets
 from calibre.ebooks.oeb.base import XPath, barename
 from calibre.utils.localization import lang_as_iso639_1
 from polyglot.builtins import unicode_type, string_or_bytes
@@ -434,9 +434,10 @@ class Convert(object):
         self.blocks = Blocks(self.docx.namespace, self.styles_manager, self.links_manager)
         self.current_link = self.current_lang = None
 
-        for item in self.oeb.spine:
-            self.log.debug('Processing', item.href)
-            self.process_item(item)
+        with shared_stylesheets(self.oeb):
+            for item in self.oeb.spine:
+                self.log.debug('Processing', item.href)
+                self.process_item(item)
         if self.add_toc:
             self.links_manager.process_toc_links(self.oeb)
 
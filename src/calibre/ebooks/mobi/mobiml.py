@@ -13,7 +13,7 @@ import numbers
 from lxml import etree
 from calibre.ebooks.oeb.base import namespace, barename
 from calibre.ebooks.oeb.base import XHTML, XHTML_NS, urlnormalize
-from calibre.ebooks.oeb.stylizer import Stylizer
+from calibre.ebooks.oeb.stylizer import Stylizer, shared_stylesheets
 from calibre.ebooks.oeb.transforms.flatcss import KeyMapper
 from calibre.ebooks.mobi.utils import convert_color_for_font_tag
 from calibre.utils.imghdr import identify
@@ -130,16 +130,17 @@ class MobiMLizer(object):
 
     def mobimlize_spine(self):
         'Iterate over the spine and convert it to MOBIML'
-        for item in self.oeb.spine:
-            stylizer = Stylizer(item.data, item.href, self.oeb, self.opts, self.profile)
-            body = item.data.find(XHTML('body'))
-            nroot = etree.Element(XHTML('html'), nsmap=MOBI_NSMAP)
-            nbody = etree.SubElement(nroot, XHTML('body'))
-            self.current_spine_item = item
-            self.mobimlize_elem(body, stylizer, BlockState(nbody),
-                                [FormatState()])
-            item.data = nroot
-            # print etree.tostring(nroot)
+        with shared_stylesheets(self.oeb):
+            for item in self.oeb.spine:
+                stylizer = Stylizer(item.data, item.href, self.oeb, self.opts, self.profile)
+                body = item.data.find(XHTML('body'))
+                nroot = etree.Element(XHTML('html'), nsmap=MOBI_NSMAP)
+                nbody = etree.SubElement(nroot, XHTML('body'))
+                self.current_spine_item = item
+                self.mobimlize_elem(body, stylizer, BlockState(nbody),
+                                    [FormatState()])
+                item.data = nroot
+                # print etree.tostring(nroot)
 
     def mobimlize_font(self, ptsize):
         return self.fnums[self.fmap[ptsize]]
@@ -9,6 +9,7 @@ __license__   = 'GPL v3'
 __copyright__ = '2008, Marshall T. Vandegrift <llasram@gmail.com>'
 
 import os, re, logging, copy, unicodedata, numbers
+from contextlib import contextmanager
 from weakref import WeakKeyDictionary
 from xml.dom import SyntaxErr as CSSSyntaxError
 from css_parser.css import (CSSStyleRule, CSSPageRule, CSSFontFaceRule,
@@ -20,6 +21,8 @@ from calibre.ebooks import unit_convert
 from calibre.ebooks.oeb.base import XHTML, XHTML_NS, CSS_MIME, OEB_STYLES, xpath, urlnormalize
 from calibre.ebooks.oeb.normalize_css import DEFAULTS, normalizers
 from css_selectors import Select, SelectorError, INAPPROPRIATE_PSEUDO_CLASSES
+from css_selectors.parser import (parse as parse_selector, ascii_lower,
+        CombinedSelector, Class, Element, Hash, Pseudo)
 from polyglot.builtins import iteritems, unicode_type
 from tinycss.media3 import CSSMedia3Parser
 
@@ -95,6 +98,54 @@ def test_media_ok():
     assert not media_ok('screen and (device-width:10px)')
 
 
+def rightmost_key(tree):
+    ''' Return the id, class or tag name that every element matched by the
+    parsed selector tree must have, taken from its rightmost compound
+    selector, or None if there is no such key. '''
+    if isinstance(tree, CombinedSelector):
+        tree = tree.subselector
+    key = None
+    while tree is not None:
+        if isinstance(tree, Hash):
+            return 'id', ascii_lower(tree.id)
+        if isinstance(tree, Class):
+            key = key or ('class', ascii_lower(tree.class_name))
+        elif isinstance(tree, Element):
+            if key is None and tree.element and tree.element != '*':
+                key = 'element', ascii_lower(tree.element)
+            break
+        elif isinstance(tree, Pseudo) and tree.ident == 'root':
+            # :root matches the root element regardless of what precedes it
+            break
+        tree = getattr(tree, 'selector', None)
+    return key
+
+
+_selector_keys = {}
+
+
+def selector_keys(text):
+    ''' Return the keys (see :func:`rightmost_key`) for the selectors in text,
+    or None if text can match elements without a key. This is used to bucket
+    rules the way browsers do, so that a rule is only matched against
+    documents that contain its key. '''
+    try:
+        return _selector_keys[text]
+    except KeyError:
+        pass
+    try:
+        keys = tuple(rightmost_key(s.parsed_tree) for s in parse_selector(text))
+    except Exception:
+        # Invalid selectors are reported when they are matched
+        keys = None
+    if not keys or None in keys:
+        keys = None
+    if len(_selector_keys) > 10000:
+        _selector_keys.clear()
+    _selector_keys[text] = keys
+    return keys
+
+
 class Stylizer(object):
     STYLESHEETS = WeakKeyDictionary()
 
@@ -120,6 +171,9 @@ class Stylizer(object):
         basename = os.path.basename(path)
         cssname = os.path.splitext(basename)[0] + '.css'
         stylesheets = [html_css_stylesheet()]
+        # Stylesheets that can be shared with other Stylizers, see
+        # shared_stylesheets()
+        shareable = {id(stylesheets[0])}
         if base_css:
             stylesheets.append(parseString(base_css, validate=False))
         style_tags = xpath(tree, '//*[local-name()="style" or local-name()="link"]')
@@ -164,6 +218,7 @@ class Stylizer(object):
                                 self.logger.warn('CSS @import of non-CSS file %r' % rule.href)
                                 continue
                             stylesheets.append(sitem.data)
+                            shareable.add(id(sitem.data))
                     # Make links to resources absolute, since these rules will
                     # be folded into a stylesheet at the root
                     replaceUrls(stylesheet, item.abshref,
@@ -187,6 +242,7 @@ class Stylizer(object):
                         item.href))
                     continue
                 stylesheets.append(sitem.data)
+                shareable.add(id(sitem.data))
         csses = {'extra_css':extra_css, 'user_css':user_css}
         for w, x in csses.items():
             if x:
@@ -203,25 +259,41 @@ class Stylizer(object):
         index = 0
         self.stylesheets = set()
         self.page_rule = {}
+        shared = self.STYLESHEETS.get(oeb)
         for sheet_index, stylesheet in enumerate(stylesheets):
-            href = stylesheet.href
-            self.stylesheets.add(href)
-            for rule in stylesheet.cssRules:
-                if rule.type == rule.MEDIA_RULE:
-                    if media_ok(rule.media.mediaText):
-                        for subrule in rule.cssRules:
-                            rules.extend(self.flatten_rule(subrule, href, index, is_user_agent_sheet=sheet_index==0))
-                            index += 1
-                else:
-                    rules.extend(self.flatten_rule(rule, href, index, is_user_agent_sheet=sheet_index==0))
-                    index = index + 1
+            self.stylesheets.add(stylesheet.href)
+            is_user_agent_sheet = sheet_index == 0
+            key = (id(stylesheet), is_user_agent_sheet, id(self.profile),
+                   getattr(self.opts, 'change_justification', None))
+            if shared is not None and id(stylesheet) in shareable and key in shared:
+                flattened = shared[key][1]
+            else:
+                flattened = self.flatten_stylesheet(stylesheet, is_user_agent_sheet=is_user_agent_sheet)
+                if shared is not None and id(stylesheet) in shareable:
+                    # Keep a reference to the stylesheet so that its id is not reused
+                    shared[key] = (stylesheet, flattened)
+            sheet_rules, num, page_rule, font_face_rules = flattened
+            for specificity, selector, style, text, href in sheet_rules:
+                rules.append((specificity[:-1] + (specificity[-1] + index,), selector, style, text, href))
+            index += num
+            self.page_rule.update(page_rule)
+            self.font_face_rules.extend(font_face_rules)
         rules.sort()
         self.rules = rules
         self._styles = {}
         pseudo_pat = re.compile(u':{1,2}(%s)' % ('|'.join(INAPPROPRIATE_PSEUDO_CLASSES)), re.I)
         select = Select(tree, ignore_inappropriate_pseudo_classes=True)
 
+        def key_present(kind, name):
+            # The maps are defaultdicts, so do not create entries in them
+            return bool(getattr(select, kind + '_map').get(name))
+
         for _, _, cssdict, text, _ in rules:
+            # Matching a selector against a large tree is expensive, so skip
+            # rules whose rightmost id, class or tag does not occur in it
+            keys = selector_keys(text)
+            if keys is not None and not any(key_present(*k) for k in keys):
+                continue
             fl = pseudo_pat.search(text)
             try:
                 matches = tuple(select(text))
@@ -298,6 +370,29 @@ class Stylizer(object):
         data = item.data.cssText
         return ('utf-8', data)
 
+    def flatten_stylesheet(self, stylesheet, is_user_agent_sheet=False):
+        ''' Return the flattened rules of stylesheet, with indices starting at
+        zero, the number of indices used, and the @page style and @font-face
+        rules from stylesheet. '''
+        rules = []
+        index = 0
+        href = stylesheet.href
+        page_rule, font_face_rules = self.page_rule, self.font_face_rules
+        self.page_rule, self.font_face_rules = {}, []
+        try:
+            for rule in stylesheet.cssRules:
+                if rule.type == rule.MEDIA_RULE:
+                    if media_ok(rule.media.mediaText):
+                        for subrule in rule.cssRules:
+                            rules.extend(self.flatten_rule(subrule, href, index, is_user_agent_sheet=is_user_agent_sheet))
+                            index += 1
+                else:
+                    rules.extend(self.flatten_rule(rule, href, index, is_user_agent_sheet=is_user_agent_sheet))
+                    index = index + 1
+            return rules, index, self.page_rule, self.font_face_rules
+        finally:
+            self.page_rule, self.font_face_rules = page_rule, font_face_rules
+
     def flatten_rule(self, rule, href, index, is_user_agent_sheet=False):
         results = []
         sheet_index = 0 if is_user_agent_sheet else 1
@@ -369,6 +464,27 @@ class Stylizer(object):
         return '\n'.join(rules)
 
 
+@contextmanager
+def shared_stylesheets(oeb):
+    '''
+    Share the flattened rules of the user agent stylesheet and of the
+    stylesheets in the manifest of oeb between all the Stylizers created for
+    oeb inside this context, instead of flattening them again for every spine
+    item. The stylesheets must not be modified in place inside this context,
+    replacing the data of a manifest item is fine, as rules are cached per
+    stylesheet object.
+    '''
+    cache = Stylizer.STYLESHEETS
+    nested = oeb in cache
+    if not nested:
+        cache[oeb] = {}
+    try:
+        yield
+    finally:
+        if not nested:
+            cache.pop(oeb, None)
+
+
 class Style(object):
     MS_PAT = re.compile(r'^\s*(mso-|panose-|text-underline|tab-interval)')
 
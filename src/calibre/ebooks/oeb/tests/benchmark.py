@@ -0,0 +1,74 @@
+#!/usr/bin/env python2
+# vim:fileencoding=utf-8
+# License: GPLv3 Copyright: 2019, Kovid Goyal <kovid at kovidgoyal.net>
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+# Measure the time taken to create Stylizers for every spine item of a book,
+# with and without skipping the rules whose rightmost key is absent from the
+# document, and with and without sharing stylesheets between the Stylizers.
+# Run it with:
+#   calibre-debug -e src/calibre/ebooks/oeb/tests/benchmark.py book.epub
+
+import sys
+
+from calibre.utils.monotonic import monotonic
+from polyglot.builtins import range
+
+
+def load_book(path):
+    from calibre.ebooks.conversion.plumber import Plumber, create_oebbook
+    from calibre.ebooks.oeb.polish.container import get_container
+    from calibre.utils.logging import DevNull
+    log = DevNull()
+    container = get_container(path, log=log, tweak_mode=True)
+    opf = container.name_to_abspath(container.opf_name)
+    # The output path is only used to choose the output format, it is not written
+    plumber = Plumber(opf, 'benchmark.epub', log)
+    plumber.setup_options()
+    return create_oebbook(log, opf, plumber.opts), plumber.opts
+
+
+def stylize_spine(oeb, opts):
+    from calibre.ebooks.oeb.stylizer import Stylizer
+    for item in oeb.spine:
+        Stylizer(item.data, item.href, oeb, opts)
+
+
+def no_keys(text):
+    return None
+
+
+def run(oeb, opts, prune, share, repeat=3):
+    ' Return the best of repeat times for stylizing all the spine items of oeb '
+    from calibre.ebooks.oeb import stylizer
+    orig = stylizer.selector_keys
+    if not prune:
+        stylizer.selector_keys = no_keys
+    try:
+        times = []
+        for i in range(repeat):
+            st = monotonic()
+            if share:
+                with stylizer.shared_stylesheets(oeb):
+                    stylize_spine(oeb, opts)
+            else:
+                stylize_spine(oeb, opts)
+            times.append(monotonic() - st)
+        return min(times)
+    finally:
+        stylizer.selector_keys = orig
+
+
+def main():
+    if len(sys.argv) < 2:
+        raise SystemExit('Usage: benchmark.py book.epub')
+    oeb, opts = load_book(sys.argv[-1])
+    print('Stylizing', len(oeb.spine), 'spine items')
+    for prune in (False, True):
+        for share in (False, True):
+            print('Prune rules: %-5s Share stylesheets: %-5s %.3f seconds' % (
+                prune, share, run(oeb, opts, prune, share)))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,134 @@
+#!/usr/bin/env python2
+# vim:fileencoding=utf-8
+# License: GPLv3 Copyright: 2019, Kovid Goyal <kovid at kovidgoyal.net>
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+import unittest
+
+from lxml import etree
+
+from calibre.ebooks.oeb import stylizer
+from calibre.ebooks.oeb.base import CSS_MIME, XHTML, XHTML_MIME, OEBBook
+from calibre.ebooks.oeb.stylizer import Stylizer, selector_keys, shared_stylesheets
+from calibre.utils.logging import DevNull
+from polyglot.builtins import iteritems
+
+
+class Options(object):
+    change_justification = 'original'
+
+    def __init__(self):
+        from calibre.customize.ui import output_profiles
+        self.output_profile = [x for x in output_profiles() if x.short_name == 'default'][0]
+
+
+def create_book(*files):
+    oeb = OEBBook(DevNull(), None)
+    for i, (href, data) in enumerate(files):
+        if href.endswith('.css'):
+            oeb.manifest.add('id%d' % i, href, CSS_MIME, data=data)
+        else:
+            oeb.manifest.add('id%d' % i, href, XHTML_MIME, data=etree.fromstring(data))
+    return oeb
+
+
+def styles(s, root):
+    return [(elem.tag, s.style(elem).cssdict(), s.style(elem).pseudo_classes(None)) for elem in root.iter('*')]
+
+
+class TestStylizer(unittest.TestCase):
+
+    def test_media_ok(self):
+        stylizer.test_media_ok()
+
+    def test_selector_keys(self):
+        for text, keys in iteritems({
+            'p': (('element', 'p'),),
+            'DIV > P.Note': (('class', 'note'),),
+            'p#One.two': (('id', 'one'),),
+            'h1, .x': (('element', 'h1'), ('class', 'x')),
+            'svg|rect': (('element', 'rect'),),
+            'p a[href]:first-child': (('element', 'a'),),
+            'p:not(.x)': (('element', 'p'),),
+            '*': None, ':not(.x)': None, ':root': None, 'h1, *': None, '[title]': None,
+        }):
+            self.assertEqual(selector_keys(text), keys, text)
+
+    def test_rule_pruning(self):
+        css = '''
+            @namespace svg "http://www.w3.org/2000/svg";
+            p { color: red }
+            DIV > P.Note { font-weight: bold }
+            .absent, p.present { font-style: italic }
+            #missing, #one { text-indent: 1em }
+            .absent p { color: green }
+            :not(.present) { margin-left: 1px }
+            p:not(.note) { margin-right: 2px }
+            :root { font-size: 20px }
+            .root:root { line-height: 1.5 }
+            svg|rect { color: blue }
+            rect { text-decoration: underline }
+            a:hover, a:first-letter { color: purple }
+            *[title] { font-variant: small-caps }
+        '''
+        html = '''<html xmlns="http://www.w3.org/1999/xhtml" class="root"><head><link href="s.css" rel="stylesheet" type="text/css"/></head><body>
+            <div><p class="note">1</p><p class="present" id="One">2</p><p title="t">3 <a href="#">a</a></p></div>
+            <svg xmlns="http://www.w3.org/2000/svg"><rect width="1" height="1"/></svg></body></html>'''
+
+        def stylize():
+            oeb = create_book(('s.css', css), ('index.html', html))
+            item = oeb.manifest.hrefs['index.html']
+            return styles(Stylizer(item.data, item.href, oeb, Options()), item.data)
+
+        pruned = stylize()
+        # Without selector keys every rule is matched against every element
+        orig, stylizer.selector_keys = stylizer.selector_keys, lambda text: None
+        try:
+            self.assertEqual(pruned, stylize())
+        finally:
+            stylizer.selector_keys = orig
+        note, present = [x[1] for x in pruned if x[0] == XHTML('p')][:2]
+        self.assertIn('font-weight', note)
+        self.assertNotEqual(note.get('margin-right'), '2px')
+        self.assertEqual(present.get('margin-right'), '2px')
+
+    def test_shared_stylesheets(self):
+        files = (
+            ('styles/main.css', '''
+                @import "base.css";
+                @font-face { font-family: X; src: url(../fonts/x.ttf) }
+                p { text-indent: 1em }
+                .c1 { font-weight: bold }
+                h1 + p { text-indent: 0 }
+             '''),
+            ('styles/base.css', 'body { margin: 1em } p { color: red }'),
+            ('styles/extra.css', '@font-face { font-family: Y; src: url(../fonts/y.ttf) } .c2 { font-style: italic }'),
+        ) + tuple(('text/ch%d.html' % i, '''<html xmlns="http://www.w3.org/1999/xhtml"><head>
+            <link href="../styles/main.css" rel="stylesheet" type="text/css"/>
+            <style type="text/css">@import "../styles/extra.css"; @page {{ margin: {0}pt }} p {{ line-height: 1.{0} }}</style>
+            </head><body><h1>Chapter {0}</h1><p class="c{0}">a</p><p class="c2" style="color: blue">b</p></body></html>'''.format(i)) for i in range(1, 4))
+
+        def stylize(share):
+            oeb = create_book(*files)
+            items = [item for item in oeb.manifest.items if item.href.endswith('.html')]
+            items.sort(key=lambda item: item.href)
+            ans = []
+
+            def run():
+                for item in items:
+                    s = Stylizer(item.data, item.href, oeb, Options())
+                    ans.append((styles(s, item.data), s.page_rule, [r.cssText for r in s.font_face_rules]))
+
+            if share:
+                with shared_stylesheets(oeb):
+                    run()
+                    self.assertTrue(Stylizer.STYLESHEETS[oeb])
+                self.assertNotIn(oeb, Stylizer.STYLESHEETS)
+            else:
+                run()
+            return ans
+
+        shared = stylize(True)
+        self.assertEqual(shared, stylize(False))
+        self.assertEqual([len(x[2]) for x in shared], [2, 2, 2])
+        self.assertNotEqual(shared[0][1], shared[1][1])
@@ -18,7 +18,7 @@ from calibre import guess_type
 from calibre.ebooks import unit_convert
 from calibre.ebooks.oeb.base import (XHTML, XHTML_NS, CSS_MIME, OEB_STYLES,
         namespace, barename, XPath)
-from calibre.ebooks.oeb.stylizer import Stylizer
+from calibre.ebooks.oeb.stylizer import Stylizer, shared_stylesheets
 from calibre.utils.filenames import ascii_filename, ascii_text
 from calibre.utils.icu import numeric_sort_key
 from polyglot.builtins import iteritems, unicode_type, string_or_bytes
@@ -288,34 +288,35 @@ class CSSFlattener(object):
         self.stylizers = {}
         profile = self.context.source
         css = ''
-        for item in self.items:
-            html = item.data
-            body = html.find(XHTML('body'))
-            if 'style' in html.attrib:
-                b = body.attrib.get('style', '')
-                body.set('style',  html.get('style') + ';' + b)
-                del html.attrib['style']
-            bs = body.get('style', '').split(';')
-            bs.append('margin-top: 0pt')
-            bs.append('margin-bottom: 0pt')
-            if float(self.context.margin_left) >= 0:
-                bs.append('margin-left : %gpt'%
-                        float(self.context.margin_left))
-            if float(self.context.margin_right) >= 0:
-                bs.append('margin-right : %gpt'%
-                        float(self.context.margin_right))
-            bs.extend(['padding-left: 0pt', 'padding-right: 0pt'])
-            if self.page_break_on_body:
-                bs.extend(['page-break-before: always'])
-            if self.context.change_justification != 'original':
-                bs.append('text-align: '+ self.context.change_justification)
-            if self.body_font_family:
-                bs.append(u'font-family: '+self.body_font_family)
-            body.set('style', '; '.join(bs))
-            stylizer = Stylizer(html, item.href, self.oeb, self.context, profile,
-                    user_css=self.context.extra_css,
-                    extra_css=css)
-            self.stylizers[item] = stylizer
+        with shared_stylesheets(self.oeb):
+            for item in self.items:
+                html = item.data
+                body = html.find(XHTML('body'))
+                if 'style' in html.attrib:
+                    b = body.attrib.get('style', '')
+                    body.set('style',  html.get('style') + ';' + b)
+                    del html.attrib['style']
+                bs = body.get('style', '').split(';')
+                bs.append('margin-top: 0pt')
+                bs.append('margin-bottom: 0pt')
+                if float(self.context.margin_left) >= 0:
+                    bs.append('margin-left : %gpt'%
+                            float(self.context.margin_left))
+                if float(self.context.margin_right) >= 0:
+                    bs.append('margin-right : %gpt'%
+                            float(self.context.margin_right))
+                bs.extend(['padding-left: 0pt', 'padding-right: 0pt'])
+                if self.page_break_on_body:
+                    bs.extend(['page-break-before: always'])
+                if self.context.change_justification != 'original':
+                    bs.append('text-align: '+ self.context.change_justification)
+                if self.body_font_family:
+                    bs.append(u'font-family: '+self.body_font_family)
+                body.set('style', '; '.join(bs))
+                stylizer = Stylizer(html, item.href, self.oeb, self.context, profile,
+                        user_css=self.context.extra_css,
+                        extra_css=css)
+                self.stylizers[item] = stylizer
 
     def baseline_node(self, node, stylizer, sizes, csize):
         csize = stylizer.style(node)['font-size']
@@ -120,6 +120,18 @@ def elem_style(style_rules, cls, inherited_style):
     return style
 
 
+def subset_in_worker(raw, chars):
+    '''
+    Subset the font data raw to chars, in a worker process. Returns the result
+    of subset() or the NoGlyphs or UnsupportedFont error, so that it can be
+    re-raised by the caller.
+    '''
+    try:
+        return subset(raw, chars)
+    except (NoGlyphs, UnsupportedFont) as e:
+        return e
+
+
 class SubsetFonts(object):
 
     '''
@@ -152,13 +164,27 @@ class SubsetFonts(object):
             else:
                 fonts[item.href] = font
 
+        subsets = {}
+        used = [font for font in itervalues(fonts) if font['chars']]
+        if getattr(self.opts, 'subset_fonts_in_parallel', False) and len(used) > 1:
+            from calibre.ebooks.conversion.parallel import run_in_workers
+            results = run_in_workers(__name__, 'subset_in_worker', [
+                (font['item'].data, font['chars']) for font in used])
+            subsets = {font['item'].href:result for font, result in zip(used, results)}
+
         for font in itervalues(fonts):
             if not font['chars']:
                 self.log('The font %s is unused. Removing it.'%font['src'])
                 remove(font)
                 continue
             try:
-                raw, old_stats, new_stats = subset(font['item'].data, font['chars'])
+                if font['item'].href in subsets:
+                    result = subsets[font['item'].href]
+                    if isinstance(result, Exception):
+                        raise result
+                    raw, old_stats, new_stats = result
+                else:
+                    raw, old_stats, new_stats = subset(font['item'].data, font['chars'])
             except NoGlyphs:
                 self.log('The font %s has no used glyphs. Removing it.'%font['src'])
                 remove(font)
@@ -283,6 +283,9 @@ def _config():  # {{{
             help=_('Automatically download the cover, if available'))
     c.add_opt('enforce_cpu_limit', default=True,
             help=_('Limit max simultaneous jobs to number of CPUs'))
+    c.add_opt('prewarm_worker', default=False,
+            help=_('Keep a worker process with the conversion code already'
+                   ' loaded running, so that jobs start faster'))
     c.add_opt('gui_layout', choices=['wide', 'narrow'],
             help=_('The layout of the user interface. Wide has the '
                 'Book details panel on the right and narrow has '
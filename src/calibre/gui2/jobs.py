@@ -74,7 +74,8 @@ class JobManager(QAbstractTableModel, AdaptSQP):  # {{{
         self.jobs          = []
         self.add_job       = Dispatcher(self._add_job)
         self.server        = Server(limit=int(config['worker_limit']/2.0),
-                                enforce_cpu_limit=config['enforce_cpu_limit'])
+                                enforce_cpu_limit=config['enforce_cpu_limit'],
+                                prewarm=config['prewarm_worker'])
         self.threaded_server = ThreadedJobServer()
         self.changed_queue = Queue()
 
@@ -19,7 +19,7 @@ from calibre import (
     as_unicode, force_unicode, isbytestring, replace_entities, strftime,
     xml_replace_entities
 )
-from calibre.constants import cache_dir, isosx
+from calibre.constants import cache_dir, isosx, numeric_version
 from calibre.customize.conversion import DummyReporter
 from calibre.customize.ui import output_profiles
 from calibre.ebooks.BeautifulSoup import (
@@ -41,12 +41,69 @@ from calibre.utils.formatter import TemplateFormatter
 from calibre.utils.icu import capitalize, collation_order, sort_key
 from calibre.utils.img import scale_image
 from calibre.utils.localization import get_lang, lang_as_iso639_1
-from calibre.utils.zipfile import ZipFile
+from calibre.utils.zipfile import BadZipfile, ZipFile
 from polyglot.builtins import unicode_type, iteritems
 
 NBSP = u'\u00a0'
 
 
+class ArchiveCache(object):
+
+    ''' Cache of generated data, stored in a ZIP archive. The archive is opened
+    for reading only once, new entries are appended through a second handle
+    that is closed by close(). This avoids re-reading the central directory of
+    a large archive for every book. '''
+
+    def __init__(self, path):
+        self.path = path
+        self.reader = self.writer = None
+        self.names = frozenset()
+        try:
+            if not os.path.exists(path):
+                ZipFile(path, mode='w').close()
+            try:
+                self.reader = ZipFile(path, mode='r', allowZip64=True)
+            except BadZipfile:
+                # The archive is corrupted, for example because a previous
+                # run was interrupted before its central directory was
+                # written, start afresh
+                os.remove(path)
+                ZipFile(path, mode='w').close()
+                self.reader = ZipFile(path, mode='r', allowZip64=True)
+            self.names = frozenset(self.reader.namelist())
+        except:
+            # occurs under windows if the file is opened by another
+            # process
+            pass
+
+    def get(self, name):
+        if name in self.names:
+            return self.reader.read(name)
+
+    def set(self, name, data):
+        # If we failed to open the archive for reading, we dont know if it
+        # contained the entry or not
+        if self.reader is None or name in self.names:
+            return
+        if self.writer is None:
+            try:
+                self.writer = ZipFile(self.path, mode='a', allowZip64=True)
+            except:
+                # Stop using the archive, both for reading and writing
+                self.reader.close()
+                self.reader = None
+                self.names = frozenset()
+                return
+        self.writer.writestr(name, data)
+
+    def close(self):
+        for zf in (self.reader, self.writer):
+            if zf is not None:
+                zf.close()
+        self.reader = self.writer = None
+        self.names = frozenset()
+
+
 class Formatter(TemplateFormatter):
 
     def get_value(self, key, args, kwargs):
@@ -155,6 +212,7 @@ class CatalogBuilder(object):
                                               _opts.output_profile.startswith("kindle")) else False
 
         self.all_series = set()
+        self.author_anchors = {}
         self.authors = None
         self.bookmarked_books = None
         self.bookmarked_books_by_date_read = None
@@ -167,6 +225,7 @@ class CatalogBuilder(object):
         self.books_by_title_no_series_prefix = None
         self.books_to_catalog = None
         self.current_step = 0.0
+        self.descriptions_path = os.path.join(self.cache_dir, "descriptions.zip")
         self.error = []
         self.generate_recently_read = False
         self.genres = []
@@ -184,9 +243,12 @@ class CatalogBuilder(object):
         self.prefix_rules = self.get_prefix_rules()
         self.progress_int = 0.0
         self.progress_string = ''
+        self.series_anchors = {}
+        self.sort_titles = {}
         self.thumb_height = 0
         self.thumb_width = 0
         self.thumbs = None
+        self.thumbs_cache = None
         self.thumbs_path = os.path.join(self.cache_dir, "thumbs.zip")
         self.total_steps = 6.0
         self.use_series_prefix_in_titles_section = False
@@ -891,6 +953,7 @@ class CatalogBuilder(object):
          description        massaged record['comments'] + merge_comments
          id                 record['id']
          formats            massaged record['formats']
+         last_modified      record['last_modified']
          notes              from opts.header_note_source_field
          prefix             from self.discover_prefix()
          publisher          massaged record['publisher']
@@ -958,6 +1021,7 @@ class CatalogBuilder(object):
                 this_title['date'] = strftime(u'%B %Y', as_local_time(record['pubdate']).timetuple())
 
             this_title['timestamp'] = record['timestamp']
+            this_title['last_modified'] = record['last_modified']
 
             if record['comments']:
                 # Strip annotations
@@ -1396,7 +1460,11 @@ class CatalogBuilder(object):
         Return:
          (str): asciized version of author
         """
-        return re.sub("\\W", "", ascii_text(author))
+        try:
+            return self.author_anchors[author]
+        except KeyError:
+            ans = self.author_anchors[author] = re.sub("\\W", "", ascii_text(author))
+            return ans
 
     def generate_format_args(self, book):
         """ Generate the format args for template substitution.
@@ -2094,45 +2162,40 @@ class CatalogBuilder(object):
 
         self.update_progress_full_step(_("Genres HTML"))
 
-        # Extract books matching filtered_tags
+        # Index the books by genre in a single pass, rather than scanning every
+        # book for every genre
+        books_by_genre = {}
+        for book in self.books_by_author:
+            for friendly_tag in book.get('genres', ()):
+                if friendly_tag in self.genre_tags_dict:
+                    books_by_genre.setdefault(friendly_tag, []).append(book)
+
+        # Extract books matching filtered_tags. Synonymous tags share a
+        # normalized tag, books are listed once per normalized tag.
+        # genre_list => [ {normalized_genre_tag : [{book},{},{}]}, ... ]
         genre_list = []
+        genre_books = {}
         for friendly_tag in sorted(self.genre_tags_dict, key=sort_key):
-            # print("\ngenerate_html_by_genres(): looking for books with friendly_tag '%s'" % friendly_tag)
-            # tag_list => { normalized_genre_tag : [{book},{},{}],
-            #               normalized_genre_tag : [{book},{},{}] }
-
-            tag_list = {}
-            for book in self.books_by_author:
-                # Scan each book for tag matching friendly_tag
-                if 'genres' in book and friendly_tag in book['genres']:
-                    this_book = {}
-                    this_book['author'] = book['author']
-                    this_book['title'] = book['title']
-                    this_book['author_sort'] = capitalize(book['author_sort'])
-                    this_book['prefix'] = book['prefix']
-                    this_book['tags'] = book['tags']
-                    this_book['id'] = book['id']
-                    this_book['series'] = book['series']
-                    this_book['series_index'] = book['series_index']
-                    this_book['date'] = book['date']
-                    normalized_tag = self.genre_tags_dict[friendly_tag]
-                    genre_tag_list = [key for genre in genre_list for key in genre]
-                    if normalized_tag in genre_tag_list:
-                        for existing_genre in genre_list:
-                            for key in existing_genre:
-                                new_book = None
-                                if key == normalized_tag:
-                                    for book in existing_genre[key]:
-                                        if (book['title'], book['author']) == (this_book['title'], this_book['author']):
-                                            new_book = False
-                                            break
-                                    else:
-                                        new_book = True
-                                if new_book:
-                                    existing_genre[key].append(this_book)
-                    else:
-                        tag_list[normalized_tag] = [this_book]
-                        genre_list.append(tag_list)
+            normalized_tag = self.genre_tags_dict[friendly_tag]
+            for book in books_by_genre.get(friendly_tag, ()):
+                this_book = {}
+                this_book['author'] = book['author']
+                this_book['title'] = book['title']
+                this_book['author_sort'] = capitalize(book['author_sort'])
+                this_book['prefix'] = book['prefix']
+                this_book['tags'] = book['tags']
+                this_book['id'] = book['id']
+                this_book['series'] = book['series']
+                this_book['series_index'] = book['series_index']
+                this_book['date'] = book['date']
+                if normalized_tag in genre_books:
+                    books, seen = genre_books[normalized_tag]
+                    if (this_book['title'], this_book['author']) not in seen:
+                        seen.add((this_book['title'], this_book['author']))
+                        books.append(this_book)
+                else:
+                    genre_books[normalized_tag] = ([this_book], {(this_book['title'], this_book['author'])})
+                    genre_list.append({normalized_tag: genre_books[normalized_tag][0]})
 
         if self.opts.verbose:
             if len(genre_list):
@@ -2833,10 +2896,13 @@ class CatalogBuilder(object):
     def generate_html_descriptions(self):
         """ Generate Description HTML for each book.
 
-        Loop though books, write Description HTML for each book.
+        Loop though books, write Description HTML for each book. Descriptions
+        are cached in descriptions_path, keyed by the book's last_modified, so
+        only the descriptions of changed books are generated again.
 
         Inputs:
          books_by_title (list)
+         descriptions_path (file): archive of previously generated descriptions
 
         Output:
          (files): Description HTML for each book
@@ -2844,18 +2910,41 @@ class CatalogBuilder(object):
 
         self.update_progress_full_step(_("Descriptions HTML"))
 
-        for (title_num, title) in enumerate(self.books_by_title):
-            self.update_progress_micro_step("%s %d of %d" %
-                                            (_("Description HTML"),
-                                            title_num, len(self.books_by_title)),
-                                            float(title_num * 100 / len(self.books_by_title)) / 100)
-
-            # Generate the header from user-customizable template
-            soup = self.generate_html_description_header(title)
-
-            # Write the book entry to content_dir
-            with open("%s/book_%d.html" % (self.content_dir, int(title['id'])), 'wb') as outfile:
-                outfile.write(prettify(soup).encode('utf-8'))
+        # Start over when most of the cached descriptions are stale
+        if os.path.exists(self.descriptions_path):
+            cache = ArchiveCache(self.descriptions_path)
+            stale = len(cache.names) > 2 * len(self.books_by_title) + 100
+            cache.close()
+            if stale:
+                self.opts.log.info("  invalidating cache at '%s'" % self.descriptions_path)
+                os.remove(self.descriptions_path)
+
+        cache = ArchiveCache(self.descriptions_path)
+        signature = repr((numeric_version, get_lang(), self.opts.fmt,
+            self.output_profile.short_name, self.generate_for_kindle_mobi,
+            self.opts.generate_authors, self.opts.generate_genres, self.opts.generate_series,
+            sorted(iteritems(self.genre_tags_dict or {})),
+            P('catalog/template.xhtml', data=True), P('catalog/stylesheet.css', data=True)))
+        try:
+            for (title_num, title) in enumerate(self.books_by_title):
+                self.update_progress_micro_step("%s %d of %d" %
+                                                (_("Description HTML"),
+                                                title_num, len(self.books_by_title)),
+                                                float(title_num * 100 / len(self.books_by_title)) / 100)
+
+                key = self.get_description_cache_key(title, signature)
+                html = cache.get(key)
+                if html is None:
+                    # Generate the header from user-customizable template
+                    soup = self.generate_html_description_header(title)
+                    html = prettify(soup).encode('utf-8')
+                    cache.set(key, html)
+
+                # Write the book entry to content_dir
+                with open("%s/book_%d.html" % (self.content_dir, int(title['id'])), 'wb') as outfile:
+                    outfile.write(html)
+        finally:
+            cache.close()
 
     def generate_html_empty_header(self, title):
         """ Return a boilerplate HTML header.
@@ -3939,6 +4028,11 @@ class CatalogBuilder(object):
         navPointTag.insert(nptc, contentTag)
         nptc += 1
 
+        # Map normalized tags back to the first friendly tag using them
+        friendly_tags = {}
+        for friendly_tag, normalized_tag in iteritems(self.genre_tags_dict):
+            friendly_tags.setdefault(normalized_tag, friendly_tag)
+
         for genre in self.genres:
             # Add an article for each genre
             navPointVolumeTag = ncx_soup.new_tag('navPoint')
@@ -3950,12 +4044,8 @@ class CatalogBuilder(object):
             navLabelTag = ncx_soup.new_tag("navLabel")
             textTag = ncx_soup.new_tag("text")
 
-            # GwR *** Can this be optimized?
-            normalized_tag = None
-            for friendly_tag in self.genre_tags_dict:
-                if self.genre_tags_dict[friendly_tag] == genre['tag']:
-                    normalized_tag = self.genre_tags_dict[friendly_tag]
-                    break
+            normalized_tag = genre['tag']
+            friendly_tag = friendly_tags.get(normalized_tag)
             textTag.insert(0, self.format_ncx_text(NavigableString(friendly_tag), dest='description'))
             navLabelTag.insert(0, textTag)
             navPointVolumeTag.insert(0, navLabelTag)
@@ -4226,11 +4316,17 @@ class CatalogBuilder(object):
          (str): asciized version of series name
         """
 
+        try:
+            return self.series_anchors[series]
+        except KeyError:
+            pass
         # Generate a legal XHTML id/href string
         if self.letter_or_symbol(series) == self.SYMBOLS:
-            return "symbol_%s_series" % re.sub('\\W', '', series).lower()
+            ans = "symbol_%s_series" % re.sub('\\W', '', series).lower()
         else:
-            return "%s_series" % re.sub('\\W', '', ascii_text(series)).lower()
+            ans = "%s_series" % re.sub('\\W', '', ascii_text(series)).lower()
+        self.series_anchors[series] = ans
+        return ans
 
     def generate_short_description(self, description, dest=None):
         """ Generate a truncated version of the supplied string.
@@ -4296,6 +4392,12 @@ class CatalogBuilder(object):
         from calibre.ebooks.metadata import title_sort
         from calibre.library.catalogs.utils import NumberToText
 
+        # The same titles and series are sorted by several sections
+        try:
+            return self.sort_titles[title]
+        except KeyError:
+            pass
+
         # Strip stop words
         title_words = title_sort(title).split()
         translated = []
@@ -4333,7 +4435,8 @@ class CatalogBuilder(object):
                     else:
                         word = '%10.0f' % (float(word))
                 translated.append(word)
-        return ' '.join(translated)
+        ans = self.sort_titles[title] = ' '.join(translated)
+        return ans
 
     def generate_thumbnail(self, title, image_dir, thumb_file):
         """ Create thumbnail of cover or return previously cached thumb.
@@ -4348,17 +4451,10 @@ class CatalogBuilder(object):
 
         Output:
          (file): thumb written to /images
-         (archive): current thumb archived under cover crc
+         (archive): current thumb archived under cover crc, through
+                    thumbs_cache, opened by generate_thumbnails()
         """
 
-        def _open_archive(mode='r'):
-            try:
-                return ZipFile(self.thumbs_path, mode=mode, allowZip64=True)
-            except:
-                # occurs under windows if the file is opened by another
-                # process
-                pass
-
         # Generate crc for current cover
         with lopen(title['cover'], 'rb') as f:
             data = f.read()
@@ -4367,19 +4463,12 @@ class CatalogBuilder(object):
         # Test cache for uuid
         uuid = title.get('uuid')
         if uuid:
-            zf = _open_archive()
-            if zf is not None:
-                with zf:
-                    try:
-                        zf.getinfo(uuid + cover_crc)
-                    except:
-                        pass
-                    else:
-                        # uuid found in cache with matching crc
-                        thumb_data = zf.read(uuid + cover_crc)
-                        with open(os.path.join(image_dir, thumb_file), 'wb') as f:
-                            f.write(thumb_data)
-                        return
+            thumb_data = self.thumbs_cache.get(uuid + cover_crc)
+            if thumb_data is not None:
+                # uuid found in cache with matching crc
+                with open(os.path.join(image_dir, thumb_file), 'wb') as f:
+                    f.write(thumb_data)
+                return
 
             # Save thumb for catalog. If invalid data, error returns to generate_thumbnails()
             thumb_data = scale_image(data,
@@ -4388,14 +4477,7 @@ class CatalogBuilder(object):
                 f.write(thumb_data)
 
             # Save thumb to archive
-            if zf is not None:
-                # Ensure that the read succeeded
-                # If we failed to open the zip file for reading,
-                # we dont know if it contained the thumb or not
-                zf = _open_archive('a')
-                if zf is not None:
-                    with zf:
-                        zf.writestr(uuid + cover_crc, thumb_data)
+            self.thumbs_cache.set(uuid + cover_crc, thumb_data)
 
     def generate_thumbnails(self):
         """ Generate a thumbnail cover for each book.
@@ -4414,57 +4496,61 @@ class CatalogBuilder(object):
         self.update_progress_full_step(_("Thumbnails"))
         thumbs = ['thumbnail_default.jpg']
         image_dir = "%s/images" % self.catalog_path
-        for (i, title) in enumerate(self.books_by_title):
-            # Update status
-            self.update_progress_micro_step("%s %d of %d" %
-                (_("Thumbnail"), i, len(self.books_by_title)),
-                 i / float(len(self.books_by_title)))
-
-            thumb_file = 'thumbnail_%d.jpg' % int(title['id'])
-            thumb_generated = True
-            valid_cover = True
-            try:
-                self.generate_thumbnail(title, image_dir, thumb_file)
-                thumbs.append("thumbnail_%d.jpg" % int(title['id']))
-            except:
-                if 'cover' in title and os.path.exists(title['cover']):
-                    valid_cover = False
-                    self.opts.log.warn(" *** Invalid cover file for '%s'***" %
-                                            (title['title']))
-                    if not self.error:
-                        self.error.append('Invalid cover files')
-                    self.error.append("Warning: invalid cover file for '%s', default cover substituted.\n" % (title['title']))
-
-                thumb_generated = False
-
-            if not thumb_generated:
-                self.opts.log.warn("     using default cover for '%s' (%d)" % (title['title'], title['id']))
-                # Confirm thumb exists, default is current
-                default_thumb_fp = os.path.join(image_dir, "thumbnail_default.jpg")
-                cover = os.path.join(self.catalog_path, "DefaultCover.png")
-                title['cover'] = cover
-
-                if not os.path.exists(cover):
-                    shutil.copyfile(I('default_cover.png'), cover)
-
-                if os.path.isfile(default_thumb_fp):
-                    # Check to see if default cover is newer than thumbnail
-                    # os.path.getmtime() = modified time
-                    # os.path.ctime() = creation time
-                    cover_timestamp = os.path.getmtime(cover)
-                    thumb_timestamp = os.path.getmtime(default_thumb_fp)
-                    if thumb_timestamp < cover_timestamp:
+        self.thumbs_cache = ArchiveCache(self.thumbs_path)
+        try:
+            for (i, title) in enumerate(self.books_by_title):
+                # Update status
+                self.update_progress_micro_step("%s %d of %d" %
+                    (_("Thumbnail"), i, len(self.books_by_title)),
+                     i / float(len(self.books_by_title)))
+
+                thumb_file = 'thumbnail_%d.jpg' % int(title['id'])
+                thumb_generated = True
+                valid_cover = True
+                try:
+                    self.generate_thumbnail(title, image_dir, thumb_file)
+                    thumbs.append("thumbnail_%d.jpg" % int(title['id']))
+                except:
+                    if 'cover' in title and os.path.exists(title['cover']):
+                        valid_cover = False
+                        self.opts.log.warn(" *** Invalid cover file for '%s'***" %
+                                                (title['title']))
+                        if not self.error:
+                            self.error.append('Invalid cover files')
+                        self.error.append("Warning: invalid cover file for '%s', default cover substituted.\n" % (title['title']))
+
+                    thumb_generated = False
+
+                if not thumb_generated:
+                    self.opts.log.warn("     using default cover for '%s' (%d)" % (title['title'], title['id']))
+                    # Confirm thumb exists, default is current
+                    default_thumb_fp = os.path.join(image_dir, "thumbnail_default.jpg")
+                    cover = os.path.join(self.catalog_path, "DefaultCover.png")
+                    title['cover'] = cover
+
+                    if not os.path.exists(cover):
+                        shutil.copyfile(I('default_cover.png'), cover)
+
+                    if os.path.isfile(default_thumb_fp):
+                        # Check to see if default cover is newer than thumbnail
+                        # os.path.getmtime() = modified time
+                        # os.path.ctime() = creation time
+                        cover_timestamp = os.path.getmtime(cover)
+                        thumb_timestamp = os.path.getmtime(default_thumb_fp)
+                        if thumb_timestamp < cover_timestamp:
+                            if self.DEBUG and self.opts.verbose:
+                                self.opts.log.warn("updating thumbnail_default for %s" % title['title'])
+                            self.generate_thumbnail(title, image_dir,
+                                                "thumbnail_default.jpg" if valid_cover else thumb_file)
+                    else:
                         if self.DEBUG and self.opts.verbose:
-                            self.opts.log.warn("updating thumbnail_default for %s" % title['title'])
+                            self.opts.log.warn("     generating new thumbnail_default.jpg")
                         self.generate_thumbnail(title, image_dir,
-                                            "thumbnail_default.jpg" if valid_cover else thumb_file)
-                else:
-                    if self.DEBUG and self.opts.verbose:
-                        self.opts.log.warn("     generating new thumbnail_default.jpg")
-                    self.generate_thumbnail(title, image_dir,
-                                            "thumbnail_default.jpg" if valid_cover else thumb_file)
-                # Clear the book's cover property
-                title['cover'] = None
+                                                "thumbnail_default.jpg" if valid_cover else thumb_file)
+                    # Clear the book's cover property
+                    title['cover'] = None
+        finally:
+            self.thumbs_cache.close()
 
         # Write thumb_width to the file, validating cache contents
         # Allows detection of aborted catalog builds
@@ -4492,6 +4578,28 @@ class CatalogBuilder(object):
         terms = fullname.split()
         return "_".join(terms)
 
+    def get_description_cache_key(self, book, signature):
+        """ Return the name of the cached description of book.
+
+        The description is rendered from the book's metadata, which changes
+        its last_modified, and from catalog options, which are summarized in
+        signature. Values derived from the options are included as well.
+
+        Args:
+         book (dict): book metadata
+         signature (str): catalog options affecting descriptions
+
+        Return:
+         (str): name of the description in the descriptions archive
+        """
+        reading = bool(self.opts.connected_kindle and book['id'] in self.bookmarked_books)
+        key = repr((signature, book['id'], book['last_modified'].isoformat(),
+                    book['prefix'], book.get('genres'), bool(book.get('cover')),
+                    reading, book.get('notes'), book.get('description')))
+        if not isinstance(key, bytes):
+            key = key.encode('utf-8')
+        return '%s%s' % (book['uuid'], hex(zlib.crc32(key)))
+
     def get_excluded_tags(self):
         """ Get excluded_tags from opts.exclusion_rules.
 
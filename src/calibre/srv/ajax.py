@@ -15,13 +15,14 @@ from calibre.library.field_metadata import category_icon_map
 from calibre.db.view import sanitize_sort_field_name
 from calibre.ebooks.metadata import title_sort
 from calibre.ebooks.metadata.book.json_codec import JsonCodec
-from calibre.srv.errors import HTTPNotFound, BookNotFound
-from calibre.srv.routes import endpoint, json
+from calibre.srv.errors import HTTPForbidden, HTTPNotFound, BookNotFound
+from calibre.srv.routes import endpoint, json, json_fragments_dumps
 from calibre.srv.content import get as get_content, icon as get_icon
 from calibre.srv.utils import http_date, custom_fields_to_display, encode_name, decode_name, get_db
 from calibre.utils.config import prefs, tweaks
 from calibre.utils.date import isoformat, timestampfromdt
 from calibre.utils.icu import numeric_sort_key as sort_key
+from calibre.utils.serialize import json_dumps, json_loads
 
 
 def ensure_val(x, *allowed):
@@ -142,6 +143,14 @@ def book_to_json(ctx, rd, db, book_id,
     return data, mi.last_modified
 
 
+def cached_book_to_json(ctx, rd, db, book_id, get_category_urls=True, device_compatible=False, device_for_template=None):
+    ' Same as book_to_json() except that the result is returned JSON encoded and is cached until the book is changed '
+    variant = 'book_to_json', get_category_urls, device_compatible, device_for_template, prefs['output_format']
+    return ctx.cached_book_json(db, book_id, variant, lambda: book_to_json(
+        ctx, rd, db, book_id, get_category_urls=get_category_urls,
+        device_compatible=device_compatible, device_for_template=device_for_template)[0])
+
+
 @endpoint('/ajax/book/{book_id}/{library_id=None}', postprocess=json)
 def book(ctx, rd, book_id, library_id):
     '''
@@ -174,10 +183,11 @@ def book(ctx, rd, book_id, library_id):
         device_compatible = rd.query.get('device_compatible', 'false').lower()
         device_for_template = rd.query.get('device_for_template', None)
 
-        data, last_modified = book_to_json(ctx, rd, db, book_id,
+        data = cached_book_to_json(ctx, rd, db, book_id,
                 get_category_urls=category_urls == 'true',
                 device_compatible=device_compatible == 'true',
                 device_for_template=device_for_template)
+        last_modified = db.field_for('last_modified', book_id)
     rd.outheaders['Last-Modified'] = http_date(timestampfromdt(last_modified))
     return data
 
@@ -215,27 +225,36 @@ def books(ctx, rd, library_id):
         category_urls = rd.query.get('category_urls', 'true').lower() == 'true'
         device_compatible = rd.query.get('device_compatible', 'false').lower() == 'true'
         device_for_template = rd.query.get('device_for_template', None)
-        ans = {}
         allowed_book_ids = ctx.allowed_book_ids(rd, db)
         for book_id in ids:
-            if book_id not in allowed_book_ids:
-                ans[book_id] = None
-                continue
-            data, lm = book_to_json(
-                ctx, rd, db, book_id, get_category_urls=category_urls,
-                device_compatible=device_compatible, device_for_template=device_for_template)
-            last_modified = lm if last_modified is None else max(lm, last_modified)
-            ans[book_id] = data
+            if book_id in allowed_book_ids:
+                lm = db.field_for('last_modified', book_id)
+                last_modified = lm if last_modified is None else max(lm, last_modified)
     if last_modified is not None:
         rd.outheaders['Last-Modified'] = http_date(timestampfromdt(last_modified))
-    return ans
+
+    def book_data():
+        for book_id in ids:
+            if book_id not in allowed_book_ids:
+                yield book_id, None
+                continue
+            with db.safe_read_lock:
+                data = cached_book_to_json(
+                    ctx, rd, db, book_id, get_category_urls=category_urls,
+                    device_compatible=device_compatible, device_for_template=device_for_template)
+            yield book_id, data
+
+    # The response is built here, in the worker thread, rather than streamed
+    # from the server loop, which must never wait for the database. The
+    # per-book fragments are cached, so building it only joins them.
+    return json_fragments_dumps(book_data())
 
 # }}}
 
 # Categories (Tag Browser)  {{{
 
 
-@endpoint('/ajax/categories/{library_id=None}', postprocess=json)
+@endpoint('/ajax/categories/{library_id=None}', postprocess=json, heavy=True)
 def categories(ctx, rd, library_id):
     '''
     Return the list of top-level categories as a list of dictionaries. Each
@@ -296,7 +315,7 @@ def categories(ctx, rd, library_id):
         return ans
 
 
-@endpoint('/ajax/category/{encoded_name}/{library_id=None}', postprocess=json)
+@endpoint('/ajax/category/{encoded_name}/{library_id=None}', postprocess=json, heavy=True)
 def category(ctx, rd, encoded_name, library_id):
     '''
     Return a dictionary describing the category specified by name. The
@@ -485,11 +504,14 @@ def books_in(ctx, rd, encoded_category, encoded_item, library_id):
 
         if dname in ('allbooks', 'newest'):
             ids = ctx.allowed_book_ids(rd, db)
+            ids_key = ctx.book_ids_key(rd, db, 'all')
         elif dname == 'search':
+            query = 'search:"%s"'%ditem
             try:
-                ids = ctx.search(rd, db, 'search:"%s"'%ditem)
+                ids = ctx.search(rd, db, query)
             except Exception:
                 raise HTTPNotFound('Search: %r not understood'%ditem)
+            ids_key = ctx.book_ids_key(rd, db, 'search', query, '')
         else:
             try:
                 cid = int(ditem)
@@ -499,8 +521,9 @@ def books_in(ctx, rd, encoded_category, encoded_item, library_id):
             if dname == 'news':
                 dname = 'tags'
             ids = db.get_books_for_category(dname, cid) & ctx.allowed_book_ids(rd, db)
+            ids_key = ctx.book_ids_key(rd, db, 'category', dname, cid)
 
-        ids = db.multisort(fields=[(sfield, sort_order == 'asc')], ids_to_sort=ids)
+        ids = ctx.sorted_book_ids(db, ids, [(sfield, sort_order == 'asc')], key=ids_key)
         total_num = len(ids)
         ids = ids[offset:offset+num]
 
@@ -528,6 +551,19 @@ def books_in(ctx, rd, encoded_category, encoded_item, library_id):
 # Search {{{
 
 
+def encode_cursor(query, vl, sort, sort_order, offset, num):
+    ' An opaque token that can be used to fetch the next page of search results '
+    return encode_name(json_dumps([query, vl, sort, sort_order, offset, num]))
+
+
+def decode_cursor(cursor):
+    try:
+        query, vl, sort, sort_order, offset, num = json_loads(decode_name(cursor))
+        return query, vl, sort, sort_order, int(offset), int(num)
+    except Exception:
+        raise HTTPNotFound('Invalid cursor: %r' % cursor)
+
+
 def search_result(ctx, rd, db, query, num, offset, sort, sort_order, vl=''):
     multisort = [(sanitize_sort_field_name(db.field_metadata, s), ensure_val(o, 'asc', 'desc') == 'asc')
                  for s, o in zip(sort.split(','), cycle(sort_order.split(',')))]
@@ -537,9 +573,10 @@ def search_result(ctx, rd, db, query, num, offset, sort, sort_order, vl=''):
             raise HTTPNotFound('%s is not a valid sort field'%sort)
 
     ids, parse_error = ctx.search(rd, db, query, vl=vl, report_restriction_errors=True)
-    ids = db.multisort(fields=multisort, ids_to_sort=ids)
+    ids = ctx.sorted_book_ids(db, ids, multisort, key=ctx.book_ids_key(rd, db, 'search', query, vl))
     total_num = len(ids)
     ids = ids[offset:offset+num]
+    next_offset = offset + len(ids)
     ans = {
         'total_num': total_num, 'sort_order':sort_order,
         'offset':offset, 'num':len(ids), 'sort':sort,
@@ -548,6 +585,7 @@ def search_result(ctx, rd, db, query, num, offset, sort, sort_order, vl=''):
         'library_id': db.server_library_id,
         'book_ids':ids,
         'vl': vl,
+        'next_cursor': encode_cursor(query, vl, sort, sort_order, next_offset, num) if next_offset < total_num else None,
     }
     if parse_error is not None:
         ans['bad_restriction'] = unicode_type(parse_error)
@@ -563,12 +601,20 @@ def search(ctx, rd, library_id):
     :func:`search_result`.
 
     Optional: ?num=100&offset=0&sort=title&sort_order=asc&query=&vl=
+
+    Alternately, use ?cursor=next_cursor where next_cursor is the value of
+    that field from a previous result, to get the next page of results.
     '''
     db = get_db(ctx, rd, library_id)
-    query = rd.query.get('query')
-    num, offset = get_pagination(rd.query)
+    cursor = rd.query.get('cursor')
+    if cursor:
+        query, vl, sort, sort_order, offset, num = decode_cursor(cursor)
+    else:
+        query = rd.query.get('query')
+        num, offset = get_pagination(rd.query)
+        sort, sort_order, vl = rd.query.get('sort', 'title'), rd.query.get('sort_order', 'asc'), rd.query.get('vl') or ''
     with db.safe_read_lock:
-        return search_result(ctx, rd, db, query, num, offset, rd.query.get('sort', 'title'), rd.query.get('sort_order', 'asc'), rd.query.get('vl') or '')
+        return search_result(ctx, rd, db, query, num, offset, sort, sort_order, vl)
 
 # }}}
 
@@ -578,3 +624,21 @@ def library_info(ctx, rd):
     ' Return info about available libraries '
     library_map, default_library = ctx.library_info(rd)
     return {'library_map':library_map, 'default_library':default_library}
+
+
+@endpoint('/ajax/server-stats', postprocess=json)
+def server_stats(ctx, rd):
+    '''
+    Return statistics about the server, such as the number of connections, the
+    queue depths and latencies of the worker pool and the memory used by the
+    loaded libraries. Only available to connections from the computer running
+    the server.
+    '''
+    if not rd.is_local_connection:
+        raise HTTPForbidden('Server statistics are only available on the computer running the server')
+    if ctx.server_stats is None:
+        raise HTTPNotFound('Server statistics are not available')
+    ans = ctx.server_stats()
+    ans['libraries'] = {library_id:{'memory_usage':memory_usage, 'idle_time':idle_time}
+                        for library_id, (memory_usage, idle_time) in iteritems(ctx.library_broker.resident_libraries())}
+    return ans
@@ -122,7 +122,7 @@ def job_done(job):
                 failed_jobs[bhash] = (False, traceback.format_exc())
 
 
-@endpoint('/book-manifest/{book_id}/{fmt}', postprocess=json, types={'book_id':int})
+@endpoint('/book-manifest/{book_id}/{fmt}', postprocess=json, types={'book_id':int}, heavy=True)
 def book_manifest(ctx, rd, book_id, fmt):
     db, library_id = get_library_data(ctx, rd)[:2]
     force_reload = rd.query.get('force_reload') == '1'
@@ -161,7 +161,7 @@ def book_manifest(ctx, rd, book_id, fmt):
     return {'aborted': aborted, 'traceback':tb, 'job_status':status, 'job_id':job_id}
 
 
-@endpoint('/book-file/{book_id}/{fmt}/{size}/{mtime}/{+name}', types={'book_id':int, 'size':int, 'mtime':int})
+@endpoint('/book-file/{book_id}/{fmt}/{size}/{mtime}/{+name}', types={'book_id':int, 'size':int, 'mtime':int}, heavy=True)
 def book_file(ctx, rd, book_id, fmt, size, mtime, name):
     db, library_id = get_library_data(ctx, rd)[:2]
     if not ctx.has_id(rd, db, book_id):
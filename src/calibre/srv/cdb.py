@@ -62,7 +62,7 @@ def cdb_run(ctx, rd, which, version):
 
 
 @endpoint('/cdb/add-book/{job_id}/{add_duplicates}/{filename}/{library_id=None}',
-          needs_db_write=True, postprocess=json, methods=receive_data_methods, cache_control='no-cache')
+          needs_db_write=True, postprocess=json, methods=receive_data_methods, cache_control='no-cache', heavy=True)
 def cdb_add_book(ctx, rd, job_id, add_duplicates, filename, library_id):
     '''
     Add a file as a new book. The file contents must be in the body of the request.
@@ -114,7 +114,7 @@ def cdb_delete_book(ctx, rd, book_ids, library_id):
 
 
 @endpoint('/cdb/set-cover/{book_id}/{library_id=None}', types={'book_id': int},
-            needs_db_write=True, postprocess=json, methods=receive_data_methods, cache_control='no-cache')
+            needs_db_write=True, postprocess=json, methods=receive_data_methods, cache_control='no-cache', heavy=True)
 def cdb_set_cover(ctx, rd, book_id, library_id):
     db = get_db(ctx, rd, library_id)
     if ctx.restriction_for(rd, db):
@@ -180,7 +180,7 @@ def cdb_set_fields(ctx, rd, book_id, library_id):
 
 
 @endpoint('/cdb/copy-to-library/{target_library_id}/{library_id=None}', needs_db_write=True,
-        postprocess=msgpack_or_json, methods=receive_data_methods, cache_control='no-cache')
+        postprocess=msgpack_or_json, methods=receive_data_methods, cache_control='no-cache', heavy=True)
 def cdb_copy_to_library(ctx, rd, target_library_id, library_id):
     db_src = get_db(ctx, rd, library_id)
     db_dest = get_db(ctx, rd, target_library_id)
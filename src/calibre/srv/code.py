@@ -9,6 +9,7 @@ import random
 import shutil
 import sys
 import zipfile
+from functools import partial
 from json import load as load_json_file
 from threading import Lock
 
@@ -22,7 +23,7 @@ from calibre.srv.errors import (
 from calibre.srv.metadata import (
     book_as_json, categories_as_json, categories_settings, icon_map
 )
-from calibre.srv.routes import endpoint, json
+from calibre.srv.routes import JSONFragments, endpoint, json
 from calibre.srv.utils import get_library_data, get_use_roman
 from calibre.utils.config import prefs, tweaks
 from calibre.utils.icu import sort_key, numeric_sort_key
@@ -179,6 +180,10 @@ def get_field_list(db):
     return [f for f, d in fieldlist if d and f in available]
 
 
+def book_as_json_fragment(ctx, db, book_id):
+    return ctx.cached_book_json(db, book_id, 'book_as_json', partial(book_as_json, db, book_id))
+
+
 def get_library_init_data(ctx, rd, db, num, sorts, orders, vl):
     ans = {}
     with db.safe_read_lock:
@@ -202,7 +207,7 @@ def get_library_init_data(ctx, rd, db, num, sorts, orders, vl):
         ans['field_metadata'] = db.field_metadata.all_metadata()
         ans['virtual_libraries'] = db._pref('virtual_libraries', {})
         ans['book_display_fields'] = get_field_list(db)
-        mdata = ans['metadata'] = {}
+        mdata = ans['metadata'] = JSONFragments()
         try:
             extra_books = set(
                 int(x) for x in rd.query.get('extra_books', '').split(',')
@@ -212,7 +217,7 @@ def get_library_init_data(ctx, rd, db, num, sorts, orders, vl):
         for coll in (ans['search_result']['book_ids'], extra_books):
             for book_id in coll:
                 if book_id not in mdata:
-                    data = book_as_json(db, book_id)
+                    data = book_as_json_fragment(ctx, db, book_id)
                     if data is not None:
                         mdata[book_id] = data
     return ans
@@ -295,9 +300,9 @@ def more_books(ctx, rd):
         ans['search_result'] = search_result(
             ctx, rd, db, query, num, offset, sorts, orders, vl
         )
-        mdata = ans['metadata'] = {}
+        mdata = ans['metadata'] = JSONFragments()
         for book_id in ans['search_result']['book_ids']:
-            data = book_as_json(db, book_id)
+            data = book_as_json_fragment(ctx, db, book_id)
             if data is not None:
                 mdata[book_id] = data
 
@@ -337,7 +342,7 @@ def get_books(ctx, rd):
     searchq = rd.query.get('search', '')
     db = get_library_data(ctx, rd)[0]
     ans = {}
-    mdata = ans['metadata'] = {}
+    mdata = ans['metadata'] = JSONFragments()
     with db.safe_read_lock:
         try:
             ans['search_result'] = search_result(
@@ -348,7 +353,7 @@ def get_books(ctx, rd):
             # detect invalid search expressions
             raise HTTPBadRequest('Invalid search expression: %s' % as_unicode(err))
         for book_id in ans['search_result']['book_ids']:
-            data = book_as_json(db, book_id)
+            data = book_as_json_fragment(ctx, db, book_id)
             if data is not None:
                 mdata[book_id] = data
     return ans
@@ -375,7 +380,7 @@ def book_metadata(ctx, rd, book_id):
     return data
 
 
-@endpoint('/interface-data/tag-browser')
+@endpoint('/interface-data/tag-browser', heavy=True)
 def tag_browser(ctx, rd):
     '''
     Get the Tag Browser serialized as JSON
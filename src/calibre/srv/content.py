@@ -8,7 +8,7 @@ __copyright__ = '2015, Kovid Goyal <kovid at kovidgoyal.net>'
 
 import os, errno
 from binascii import hexlify
-from io import BytesIO
+from contextlib import contextmanager
 from threading import Lock
 from polyglot.builtins import map
 from functools import partial
@@ -23,8 +23,8 @@ from calibre.ebooks.metadata.opf2 import metadata_to_opf
 from calibre.library.save_to_disk import find_plugboard
 from calibre.srv.errors import HTTPNotFound, BookNotFound
 from calibre.srv.routes import endpoint, json
+from calibre.srv.thumbnails import render_thumbnail
 from calibre.srv.utils import http_date, get_db, get_use_roman
-from calibre.utils.config_base import tweaks
 from calibre.utils.date import timestampfromdt
 from calibre.utils.img import scale_image, image_from_data
 from calibre.utils.filenames import ascii_filename, atomic_rename
@@ -42,12 +42,35 @@ lock = Lock()
 # have only one second precision for mtimes
 mtimes = {}
 rename_counter = 0
+# Locks for the cached files currently being accessed, the global lock only
+# protects this map and rename_counter
+file_locks = {}
 
 
 def reset_caches():
     mtimes.clear()
 
 
+@contextmanager
+def lock_for(bname):
+    ''' Serialize access to the cached file bname, so that concurrent requests
+    for it wait for a single copy to be made, while copies of other files
+    proceed in parallel. '''
+    with lock:
+        entry = file_locks.get(bname)
+        if entry is None:
+            entry = file_locks[bname] = [Lock(), 0]
+        entry[1] += 1
+    try:
+        with entry[0]:
+            yield
+    finally:
+        with lock:
+            entry[1] -= 1
+            if not entry[1]:
+                del file_locks[bname]
+
+
 def open_for_write(fname):
     try:
         return share_open(fname, 'w+b')
@@ -78,7 +101,20 @@ def create_file_copy(ctx, rd, prefix, library_id, book_id, ext, mtime, copy_func
     fname = os.path.join(base, bname)
     used_cache = 'no'
 
-    with lock:
+    def do_copy():
+        ans = open_for_write(fname)
+        mtimes[bname] = mtime
+        try:
+            copy_func(ans)
+        except Exception:
+            # Do not let later requests use the partially written file
+            mtimes.pop(bname, None)
+            ans.close()
+            raise
+        ans.seek(0)
+        return ans
+
+    with lock_for(bname):
         previous_mtime = mtimes.get(bname)
         if previous_mtime is None or previous_mtime < mtime:
             if previous_mtime is not None:
@@ -88,16 +124,14 @@ def create_file_copy(ctx, rd, prefix, library_id, book_id, ext, mtime, copy_func
                 if iswindows:
                     # On windows in order to re-use bname, we have to rename it
                     # before deleting it
-                    rename_counter += 1
-                    dname = os.path.join(base, '_%x' % rename_counter)
+                    with lock:
+                        rename_counter += 1
+                        dname = os.path.join(base, '_%x' % rename_counter)
                     atomic_rename(fname, dname)
                     os.remove(dname)
                 else:
                     os.remove(fname)
-            ans = open_for_write(fname)
-            mtimes[bname] = mtime
-            copy_func(ans)
-            ans.seek(0)
+            ans = do_copy()
         else:
             try:
                 ans = share_open(fname, 'rb')
@@ -105,14 +139,11 @@ def create_file_copy(ctx, rd, prefix, library_id, book_id, ext, mtime, copy_func
             except EnvironmentError as err:
                 if err.errno != errno.ENOENT:
                     raise
-                ans = open_for_write(fname)
-                mtimes[bname] = mtime
-                copy_func(ans)
-                ans.seek(0)
-        if ctx.testing:
-            rd.outheaders['Used-Cache'] = used_cache
-            rd.outheaders['Tempfile'] = hexlify(fname.encode('utf-8'))
-        return rd.filesystem_file_with_custom_etag(ans, prefix, library_id, book_id, mtime, extra_etag_data)
+                ans = do_copy()
+    if ctx.testing:
+        rd.outheaders['Used-Cache'] = used_cache
+        rd.outheaders['Tempfile'] = hexlify(fname.encode('utf-8'))
+    return rd.filesystem_file_with_custom_etag(ans, prefix, library_id, book_id, mtime, extra_etag_data)
 
 
 def write_generated_cover(db, book_id, width, height, destf):
@@ -147,16 +178,29 @@ def cover(ctx, rd, library_id, db, book_id, width=None, height=None):
             db.copy_cover_to(book_id, dest)
     else:
         prefix += '-%sx%s' % (width, height)
+        if ctx.thumbnail_store.max_size:
+            ans = cached_thumbnail(ctx, rd, prefix, library_id, db, book_id, width, height, mtime)
+            if ans is not None:
+                return ans
 
         def copy_func(dest):
-            buf = BytesIO()
-            db.copy_cover_to(book_id, buf)
-            quality = min(99, max(50, tweaks['content_server_thumbnail_compression_quality']))
-            data = scale_image(buf.getvalue(), width=width, height=height, compression_quality=quality)[-1]
-            dest.write(data)
+            dest.write(render_thumbnail(db, book_id, width, height))
     return create_file_copy(ctx, rd, prefix, library_id, book_id, 'jpg', mtime, copy_func)
 
 
+def cached_thumbnail(ctx, rd, prefix, library_id, db, book_id, width, height, mtime):
+    size = (width, height)
+    ans, used_cache = ctx.thumbnail_store.get(
+        library_id, book_id, size, timestampfromdt(mtime), partial(render_thumbnail, db, book_id, width, height))
+    if ans is None:
+        return
+    ctx.thumbnail_prewarmer(library_id, db, size)
+    if ctx.testing:
+        rd.outheaders['Used-Cache'] = 'yes' if used_cache else 'no'
+        rd.outheaders['Tempfile'] = hexlify(ans.name.encode('utf-8'))
+    return rd.filesystem_file_with_custom_etag(ans, prefix, library_id, book_id, mtime)
+
+
 def book_filename(rd, book_id, mi, fmt, as_encoded_unicode=False):
     au = authors_to_string(mi.authors or [_('Unknown')])
     title = mi.title or _('Unknown')
@@ -267,8 +311,8 @@ def icon(ctx, rd, which):
             return share_open(path, 'rb')
         except EnvironmentError:
             raise HTTPNotFound()
-    with lock:
-        cached = os.path.join(rd.tdir, 'icons', '%d-%s.png' % (sz, which))
+    cached = os.path.join(rd.tdir, 'icons', '%d-%s.png' % (sz, which))
+    with lock_for(cached):
         try:
             return share_open(cached, 'rb')
         except EnvironmentError:
@@ -289,7 +333,7 @@ def icon(ctx, rd, which):
         return ans
 
 
-@endpoint('/get/{what}/{book_id}/{library_id=None}', android_workaround=True)
+@endpoint('/get/{what}/{book_id}/{library_id=None}', android_workaround=True, heavy=True)
 def get(ctx, rd, what, book_id, library_id):
     book_id, rest = book_id.partition('_')[::2]
     try:
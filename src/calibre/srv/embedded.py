@@ -85,7 +85,7 @@ class Server(object):
         if self.current_thread is None:
             try:
                 self.loop = ServerLoop(
-                    create_http_handler(self.handler.dispatch),
+                    create_http_handler(self.handler.dispatch, job_lane_for_request=self.handler.job_lane),
                     opts=self.opts,
                     log=self.log,
                     access_log=self.access_log,
@@ -102,6 +102,7 @@ class Server(object):
                         pass
                 return
             self.handler.set_jobs_manager(self.loop.jobs_manager)
+            self.handler.set_server_stats(self.loop.stats)
             self.current_thread = t = Thread(
                 name='EmbeddedServer', target=self.serve_forever
             )
@@ -133,6 +134,7 @@ class Server(object):
             self.loop.serve_forever()
         except BaseException as e:
             self.exception = e
+        self.ctx.shutdown()
         if self.state_callback is not None:
             try:
                 self.state_callback(False)
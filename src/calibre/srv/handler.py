@@ -12,9 +12,11 @@ from calibre.srv.auth import AuthController
 from calibre.srv.errors import HTTPForbidden
 from calibre.srv.library_broker import LibraryBroker, path_for_db
 from calibre.srv.routes import Router
+from calibre.srv.thumbnails import ThumbnailPrewarmer, ThumbnailStore
 from calibre.srv.users import UserManager
 from calibre.utils.date import utcnow
 from calibre.utils.search_query_parser import ParseException
+from calibre.utils.serialize import json_dumps
 from polyglot.builtins import itervalues
 
 
@@ -23,18 +25,30 @@ class Context(object):
     log = None
     url_for = None
     jobs_manager = None
+    server_stats = None
     CATEGORY_CACHE_SIZE = 25
     SEARCH_CACHE_SIZE = 100
+    SORT_CACHE_SIZE = 25
+    BOOK_JSON_CACHE_SIZE = 5000
 
     def __init__(self, libraries, opts, testing=False, notify_changes=None):
         self.opts = opts
-        self.library_broker = libraries if isinstance(libraries, LibraryBroker) else LibraryBroker(libraries)
+        self.library_broker = libraries if isinstance(libraries, LibraryBroker) else LibraryBroker(
+            libraries, max_resident=opts.max_resident_libraries, idle_timeout=opts.library_idle_timeout * 60,
+            memory_budget=opts.library_memory_budget * 1024 * 1024)
         self.testing = testing
         self.lock = Lock()
         self.user_manager = UserManager(opts.userdb)
         self.ignored_fields = frozenset(filter(None, (x.strip() for x in (opts.ignored_fields or '').split(','))))
         self.displayed_fields = frozenset(filter(None, (x.strip() for x in (opts.displayed_fields or '').split(','))))
         self._notify_changes = notify_changes
+        if testing:
+            from calibre.ptempfile import PersistentTemporaryDirectory
+            self.thumbnail_store = ThumbnailStore(opts.thumbnail_cache_size, location=PersistentTemporaryDirectory('srv-thumbnails'))
+        else:
+            self.thumbnail_store = ThumbnailStore(opts.thumbnail_cache_size)
+        self.thumbnail_prewarmer = ThumbnailPrewarmer(self.thumbnail_store)
+        self.library_broker.on_evict = self.thumbnail_prewarmer.forget
 
     def notify_changes(self, library_path, change_event):
         if self._notify_changes is not None:
@@ -49,6 +63,10 @@ class Context(object):
     def abort_job(self, job_id):
         return self.jobs_manager.abort_job(job_id)
 
+    def shutdown(self):
+        self.thumbnail_prewarmer.stop()
+        self.thumbnail_store.shutdown()
+
     def is_field_displayable(self, field):
         if self.displayed_fields and field not in self.displayed_fields:
             return False
@@ -60,16 +78,26 @@ class Context(object):
     def finalize_session(self, endpoint, data, output):
         pass
 
+    def lease_library(self, request_data, library_id):
+        # The library is leased until the response to the request has been
+        # generated, when the request supports it, see
+        # RequestData.release_libraries()
+        leases = getattr(request_data, 'leased_libraries', None)
+        db = self.library_broker.get(library_id, lease=leases is not None)
+        if db is not None and leases is not None:
+            leases.append(partial(self.library_broker.release, db.server_library_id))
+        return db
+
     def get_library(self, request_data, library_id=None):
         if not request_data.username:
-            return self.library_broker.get(library_id)
+            return self.lease_library(request_data, library_id)
         lf = partial(self.user_manager.allowed_library_names, request_data.username)
         allowed_libraries = self.library_broker.allowed_libraries(lf)
         if not allowed_libraries:
             raise HTTPForbidden('The user {} is not allowed to access any libraries on this server'.format(request_data.username))
         library_id = library_id or next(iter(allowed_libraries))
         if library_id in allowed_libraries:
-            return self.library_broker.get(library_id)
+            return self.lease_library(request_data, library_id)
         raise HTTPForbidden('The user {} is not allowed to access the library {}'.format(request_data.username, library_id))
 
     def library_info(self, request_data):
@@ -88,14 +116,15 @@ class Context(object):
         restriction = self.restriction_for(request_data, db)
         if restriction:
             try:
-                return book_id in db.search('', restriction=restriction)
+                return book_id in db.books_in_virtual_library('', restriction, as_bitmap=True)
             except ParseException:
                 return False
         return db.has_id(book_id)
 
     def get_allowed_book_ids_from_restriction(self, request_data, db):
         restriction = self.restriction_for(request_data, db)
-        return frozenset(db.search('', restriction=restriction)) if restriction else None
+        # The cached result is returned as a bitmap, without building a set
+        return db.books_in_virtual_library('', restriction, as_bitmap=True) if restriction else None
 
     def allowed_book_ids(self, request_data, db):
         try:
@@ -182,6 +211,59 @@ class Context(object):
                 return old[1], None
             return old[1]
 
+    def book_ids_key(self, request_data, db, *source):
+        ''' A key identifying the set of books obtained from source, such as
+        ('search', query, vl), for the user making the request '''
+        return source + (self.restriction_for(request_data, db),)
+
+    def sorted_book_ids(self, db, book_ids, sort_fields, key=None):
+        ''' Return book_ids sorted by sort_fields, a sequence of (field_name,
+        ascending) pairs, as a tuple. If key, see :meth:`book_ids_key`, is not
+        None, the sorted ids are cached, so that paging through a large result
+        set does not re-sort it for every page. '''
+        sort_fields = tuple(map(tuple, sort_fields))
+        if key is None:
+            return tuple(db.multisort(fields=sort_fields, ids_to_sort=book_ids))
+        key = key, sort_fields
+        with self.lock:
+            cache = self.library_broker.sort_caches[db.server_library_id]
+            old = cache.pop(key, None)
+            if old is not None and old[0] == db.clear_search_cache_count:
+                cache[key] = old
+                return old[1]
+        # Sort outside the lock, the sort can be slow for large libraries
+        version = db.clear_search_cache_count
+        ans = tuple(db.multisort(fields=sort_fields, ids_to_sort=book_ids))
+        with self.lock:
+            cache = self.library_broker.sort_caches[db.server_library_id]
+            cache[key] = (version, ans)
+            if len(cache) > self.SORT_CACHE_SIZE:
+                cache.popitem(last=False)
+        return ans
+
+    def cached_book_json(self, db, book_id, variant, create):
+        ''' Return the JSON encoded (UTF-8 bytes) value returned by create() for
+        the specified book, or None if create() returns None. The encoded value
+        is cached and re-used until the last_modified date of the book changes.
+        variant must identify everything other than the book that the value
+        depends on. '''
+        last_modified = db.field_for('last_modified', book_id)
+        key = book_id, variant
+        with self.lock:
+            cache = self.library_broker.book_json_caches[db.server_library_id]
+            old = cache.pop(key, None)
+            if old is not None and old[0] == last_modified:
+                cache[key] = old
+                return old[1]
+        data = create()
+        ans = None if data is None else json_dumps(data)
+        with self.lock:
+            cache = self.library_broker.book_json_caches[db.server_library_id]
+            cache[key] = (last_modified, ans)
+            if len(cache) > self.BOOK_JSON_CACHE_SIZE:
+                cache.popitem(last=False)
+        return ans
+
 
 SRV_MODULES = ('ajax', 'books', 'cdb', 'code', 'content', 'legacy', 'opds', 'users_api', 'convert')
 
@@ -203,16 +285,22 @@ class Handler(object):
         self.router.finalize()
         self.router.ctx.url_for = self.router.url_for
         self.dispatch = self.router.dispatch
+        self.job_lane = self.router.job_lane
 
     def set_log(self, log):
         self.router.ctx.log = log
+        self.router.ctx.library_broker.log = log
         if self.auth_controller is not None:
             self.auth_controller.log = log
 
     def set_jobs_manager(self, jobs_manager):
         self.router.ctx.jobs_manager = jobs_manager
 
+    def set_server_stats(self, server_stats):
+        self.router.ctx.server_stats = server_stats
+
     def close(self):
+        self.router.ctx.shutdown()
         self.router.ctx.library_broker.close()
 
     @property
@@ -115,6 +115,9 @@ decoded_headers = {
 uppercase_headers = {'WWW', 'TE'}
 
 
+header_name_cache = {}
+
+
 def normalize_header_name(name):
     parts = [x.capitalize() for x in name.split('-')]
     q = parts[0].upper()
@@ -125,61 +128,79 @@ def normalize_header_name(name):
     return '-'.join(parts)
 
 
+def header_name_from_bytes(raw):
+    # Clients send the same few header names over and over, so cache the
+    # normalized names, keyed by the raw bytes, up to a limit
+    try:
+        return header_name_cache[raw]
+    except KeyError:
+        pass
+    ans = normalize_header_name(raw.decode('ascii'))
+    if len(header_name_cache) < 512:
+        header_name_cache[raw] = ans
+    return ans
+
+
 class HTTPHeaderParser(object):
 
     '''
     Parse HTTP headers. Use this class by repeatedly calling the created object
-    with a single line at a time and checking the finished attribute. Can raise ValueError
+    with a single line at a time and checking the finished attribute, or by
+    calling :meth:`push_block` with a complete header block. Can raise ValueError
     for malformed headers, in which case you should probably return BAD_REQUEST.
 
     Headers which are repeated are folded together using a comma if their
-    specification so dictates.
+    specification so dictates. A parser can be re-used for successive header
+    blocks by calling :meth:`reset`.
     '''
     __slots__ = ('hdict', 'lines', 'finished')
 
     def __init__(self):
-        self.hdict = MultiDict()
         self.lines = []
+        self.reset()
+
+    def reset(self):
+        self.hdict = MultiDict()
+        del self.lines[:]
         self.finished = False
 
     def push(self, *lines):
         for line in lines:
             self(line)
 
+    def safe_decode(self, hname, value):
+        try:
+            return value.decode('utf-8')
+        except UnicodeDecodeError:
+            if hname in decoded_headers:
+                raise
+        return value
+
+    def commit(self):
+        if not self.lines:
+            return
+        line = b' '.join(self.lines)
+        del self.lines[:]
+
+        k, v = line.partition(b':')[::2]
+        key = header_name_from_bytes(k.strip())
+        val = self.safe_decode(key, v.strip())
+        if not key or not val:
+            raise ValueError('Malformed header line: %s' % reprlib.repr(line))
+        if key in comma_separated_headers:
+            existing = self.hdict.pop(key)
+            if existing is not None:
+                val = existing + ', ' + val
+        self.hdict[key] = val
+
     def __call__(self, line):
         'Process a single line'
-
-        def safe_decode(hname, value):
-            try:
-                return value.decode('utf-8')
-            except UnicodeDecodeError:
-                if hname in decoded_headers:
-                    raise
-            return value
-
-        def commit():
-            if not self.lines:
-                return
-            line = b' '.join(self.lines)
-            del self.lines[:]
-
-            k, v = line.partition(b':')[::2]
-            key = normalize_header_name(k.strip().decode('ascii'))
-            val = safe_decode(key, v.strip())
-            if not key or not val:
-                raise ValueError('Malformed header line: %s' % reprlib.repr(line))
-            if key in comma_separated_headers:
-                existing = self.hdict.pop(key)
-                if existing is not None:
-                    val = existing + ', ' + val
-            self.hdict[key] = val
-
         if self.finished:
             raise ValueError('Header block already terminated')
 
         if line == b'\r\n':
             # Normal end of headers
-            commit()
+            self.commit()
             self.finished = True
             return
 
@@ -189,9 +210,31 @@ class HTTPHeaderParser(object):
                 raise ValueError('Orphaned continuation line')
             self.lines.append(line.lstrip())
         else:
-            commit()
+            self.commit()
             self.lines.append(line)
 
+    def push_block(self, block):
+        ''' Process a complete header block, that is, a sequence of CRLF
+        terminated lines ending with an empty line, in a single pass '''
+        if self.finished:
+            raise ValueError('Header block already terminated')
+        lines = block.split(b'\r\n')
+        if len(lines) < 2 or lines[-1] or lines[-2]:
+            raise ValueError('Unterminated header block')
+        del lines[-2:]
+        for line in lines:
+            if not line:
+                raise ValueError('Empty line inside header block')
+            if line[0] in b' \t':
+                if not self.lines:
+                    raise ValueError('Orphaned continuation line')
+                self.lines.append(line.lstrip())
+            else:
+                self.commit()
+                self.lines.append(line)
+        self.commit()
+        self.finished = True
+
 
 def read_headers(readline):
     p = HTTPHeaderParser()
@@ -208,6 +251,8 @@ class HTTPRequest(Connection):
     translator_cache = None
 
     def __init__(self, *args, **kwargs):
+        # Re-used for every request on this connection
+        self.header_parser = HTTPHeaderParser()
         Connection.__init__(self, *args, **kwargs)
         self.max_header_line_size = int(1024 * self.opts.max_header_line_size)
         self.max_request_body_size = int(1024 * 1024 * self.opts.max_request_body_size)
@@ -253,37 +298,80 @@ class HTTPRequest(Connection):
         self.set_state(READ, self.parse_request_line, Accumulator(), first=True)
 
     def parse_request_line(self, buf, event, first=False):  # {{{
+        if not buf.total_length:
+            # Fast path: usually the request line and all headers are present
+            # in the read buffer, in which case they are parsed in one pass.
+            # This also handles pipelined requests, since the read buffer is
+            # consumed only up to the end of the header block.
+            block = self.read_buffer.readblock()
+            if block is not None:
+                return self.parse_request_block(block, first)
         line = self.readline(buf)
         if line is None:
             return
+        if self.process_request_line(line, first):
+            self.header_parser.reset()
+            self.set_state(READ, self.parse_header_line, self.header_parser, Accumulator())
+
+    def parse_request_block(self, block, first):
+        line, rest = block.partition(b'\r\n')[::2]
+        line += b'\r\n'
+        if line == b'\r\n' and first and rest:
+            # A single leading empty line
+            return self.parse_request_block(rest, False)
+        if block.count(b'\n') != block.count(b'\r\n'):
+            return self.simple_response(http_client.BAD_REQUEST, 'HTTP requires CRLF line terminators')
+        if len(line) > self.max_header_line_size:
+            return self.simple_response(http_client.REQUEST_URI_TOO_LONG)
+        if not self.process_request_line(line, False):
+            return
+        if len(rest) > self.max_header_line_size and max(map(len, rest.split(b'\r\n'))) + 2 > self.max_header_line_size:
+            return self.simple_response(self.header_line_too_long_error_code)
+        parser = self.header_parser
+        parser.reset()
+        try:
+            parser.push_block(rest)
+        except ValueError:
+            return self.simple_response(http_client.BAD_REQUEST, 'Failed to parse header line')
+        self.finalize_headers(parser.hdict)
+
+    def process_request_line(self, line, first):
+        # Returns True if the request line is valid and the headers should be
+        # read next
         self.request_line = line.rstrip()
         if line == b'\r\n':
             # Ignore a single leading empty line, as per RFC 2616 sec 4.1
             if first:
-                return self.set_state(READ, self.parse_request_line, Accumulator())
-            return self.simple_response(http_client.BAD_REQUEST, 'Multiple leading empty lines not allowed')
+                self.set_state(READ, self.parse_request_line, Accumulator())
+                return False
+            self.simple_response(http_client.BAD_REQUEST, 'Multiple leading empty lines not allowed')
+            return False
 
         try:
             method, uri, req_protocol = line.strip().split(b' ', 2)
             rp = int(req_protocol[5]), int(req_protocol[7])
             self.method = method.decode('ascii').upper()
         except Exception:
-            return self.simple_response(http_client.BAD_REQUEST, "Malformed Request-Line")
+            self.simple_response(http_client.BAD_REQUEST, "Malformed Request-Line")
+            return False
 
         if self.method not in HTTP_METHODS:
-            return self.simple_response(http_client.BAD_REQUEST, "Unknown HTTP method")
+            self.simple_response(http_client.BAD_REQUEST, "Unknown HTTP method")
+            return False
 
         try:
             self.request_protocol = protocol_map[rp]
         except KeyError:
-            return self.simple_response(http_client.HTTP_VERSION_NOT_SUPPORTED)
+            self.simple_response(http_client.HTTP_VERSION_NOT_SUPPORTED)
+            return False
         self.response_protocol = protocol_map[min((1, 1), rp)]
         try:
             self.scheme, self.path, self.query = parse_uri(uri)
         except HTTPSimpleResponse as e:
-            return self.simple_response(e.http_code, e.message, close_after_response=False)
+            self.simple_response(e.http_code, e.message, close_after_response=False)
+            return False
         self.header_line_too_long_error_code = http_client.REQUEST_ENTITY_TOO_LARGE
-        self.set_state(READ, self.parse_header_line, HTTPHeaderParser(), Accumulator())
+        return True
     # }}}
 
     @property
@@ -7,13 +7,15 @@ __license__ = 'GPL v3'
 __copyright__ = '2015, Kovid Goyal <kovid at kovidgoyal.net>'
 
 import os, hashlib, uuid, struct
-from collections import namedtuple
+from collections import namedtuple, OrderedDict
 from io import BytesIO, DEFAULT_BUFFER_SIZE
 from itertools import chain, repeat
 from operator import itemgetter
-from functools import wraps
+from functools import partial, wraps
+from threading import Lock
+from types import GeneratorType
 
-from polyglot.builtins import iteritems, itervalues, reraise, map, is_py3
+from polyglot.builtins import iteritems, itervalues, reraise, map, is_py3, unicode_type
 
 from calibre import guess_type, force_unicode
 from calibre.constants import __version__, plugins
@@ -24,6 +26,8 @@ from calibre.srv.sendfile import file_metadata, sendfile_to_socket_async, Cannot
 from calibre.srv.utils import (
     MultiDict, http_date, HTTP1, HTTP11, socket_errors_socket_closed,
     sort_q_values, get_translator_for_lang, Cookie, fast_now_strftime)
+from calibre.utils.filenames import atomic_rename
+from calibre.utils.shared_file import share_open
 from calibre.utils.speedups import ReadOnlyFileBuffer
 from calibre.utils.monotonic import monotonic
 from polyglot import http_client, reprlib
@@ -32,6 +36,8 @@ Range = namedtuple('Range', 'start stop size')
 MULTIPART_SEPARATOR = uuid.uuid4().hex
 if isinstance(MULTIPART_SEPARATOR, bytes):
     MULTIPART_SEPARATOR = MULTIPART_SEPARATOR.decode('ascii')
+# Size of the buffer used to send files when sendfile() cannot be used
+PUMP_BUFFER_SIZE = 256 * 1024
 COMPRESSIBLE_TYPES = {'application/json', 'application/javascript', 'application/xml', 'application/oebps-package+xml'}
 if is_py3:
     import zlib
@@ -42,6 +48,13 @@ else:
         raise RuntimeError('Failed to load the zlib2 module with error: ' + zlib2_err)
     del zlib2_err
     from itertools import izip_longest as zip_longest
+try:
+    import brotli
+except ImportError:
+    brotli = None
+COMPRESSION_ENCODINGS = frozenset({'gzip', 'br'} if brotli is not None else {'gzip'})
+# The file name extensions of precompressed versions of static files
+PRECOMPRESSED_EXTENSIONS = {'gzip': '.gz', 'br': '.br'}
 
 
 def header_list_to_file(buf):  # {{{
@@ -89,6 +102,17 @@ def parse_multipart_byterange(buf, content_type):  # {{{
 
 def parse_if_none_match(val):  # {{{
     return {x.strip() for x in val.split(',')}
+
+
+def matching_etag(etag, none_match, accept_encoding):
+    ''' Return the ETag of the response with the specified etag that matches
+    If-None-Match, or None. Compressed responses carry a variant of etag, see
+    variant_etag(). '''
+    encoding = acceptable_encoding(accept_encoding, COMPRESSION_ENCODINGS)
+    if encoding is not None and variant_etag(etag, encoding) in none_match:
+        return variant_etag(etag, encoding)
+    if '*' in none_match or etag in none_match:
+        return etag
 # }}}
 
 
@@ -169,25 +193,85 @@ def gzip_prefix():
     ))
 
 
-def compress_readable_output(src_file, compress_level=6):
+def compress_chunks(chunks, compress_level=6):
     crc = zlib.crc32(b"")
     size = 0
     zobj = zlib.compressobj(compress_level,
                             zlib.DEFLATED, -zlib.MAX_WBITS,
                             zlib.DEF_MEM_LEVEL, zlib.Z_DEFAULT_STRATEGY)
     prefix_written = False
-    while True:
-        data = src_file.read(DEFAULT_BUFFER_SIZE)
+    for data in chunks:
         if not data:
-            break
+            continue
+        if isinstance(data, unicode_type):
+            data = data.encode('utf-8')
         size += len(data)
         crc = zlib.crc32(data, crc)
         data = zobj.compress(data)
         if not prefix_written:
             prefix_written = True
             data = gzip_prefix() + data
-        yield data
-    yield zobj.flush() + struct.pack(b"<L", crc & 0xffffffff) + struct.pack(b"<L", size)
+        if data:
+            # Do not yield empty chunks, the compressor buffers small inputs
+            yield data
+    data = zobj.flush() + struct.pack(b"<L", crc & 0xffffffff) + struct.pack(b"<L", size)
+    if not prefix_written:
+        data = gzip_prefix() + data
+    yield data
+
+
+def compress_readable_output(src_file, compress_level=6):
+    return compress_chunks(iter(partial(src_file.read, DEFAULT_BUFFER_SIZE), b''), compress_level)
+
+
+def compress_data(data, encoding, brotli_quality=5):
+    if encoding == 'br':
+        return brotli.compress(data, quality=brotli_quality)
+    return b''.join(compress_readable_output(BytesIO(data)))
+
+
+def precompress_file(path):
+    ' Create compressed versions of the file at path, for static files that are sent by the server '
+    with lopen(path, 'rb') as f:
+        data = f.read()
+    for encoding in COMPRESSION_ENCODINGS:
+        dest = path + PRECOMPRESSED_EXTENSIONS[encoding]
+        with lopen(dest + '.tmp', 'wb') as f:
+            f.write(compress_data(data, encoding, brotli_quality=11))
+        atomic_rename(dest + '.tmp', dest)
+
+
+def variant_etag(etag, encoding):
+    return etag[:-1] + '-' + encoding + '"'
+
+
+class CompressedCache(object):
+
+    ' A cache of compressed response bodies, bounded by their total size in bytes '
+
+    def __init__(self):
+        self.items = OrderedDict()
+        self.size = 0
+        self.lock = Lock()
+
+    def get(self, key):
+        with self.lock:
+            ans = self.items.pop(key, None)
+            if ans is not None:
+                self.items[key] = ans
+            return ans
+
+    def add(self, key, data, max_size):
+        with self.lock:
+            old = self.items.pop(key, None)
+            if old is not None:
+                self.size -= len(old)
+            if len(data) > max_size:
+                return
+            self.items[key] = data
+            self.size += len(data)
+            while self.size > max_size:
+                self.size -= len(self.items.popitem(last=False)[1])
 # }}}
 
 
@@ -234,6 +318,14 @@ class RequestData(object):  # {{{
         self.lang_code = self.gettext_func = self.ngettext_func = None
         self.set_translator(self.get_preferred_language())
         self.tdir = tdir
+        # Functions that release the libraries leased by this request, see
+        # release_libraries()
+        self.leased_libraries = []
+        self.route = None
+
+    def release_libraries(self):
+        while self.leased_libraries:
+            self.leased_libraries.pop()()
 
     def generate_static_output(self, name, generator, content_type='text/html; charset=UTF-8'):
         ans = self.static_cache.get(name)
@@ -317,6 +409,7 @@ def filesystem_file_output(output, outheaders, stat_result):
     etag = '"%s"' % etag
     self = ReadableOutput(output, etag=etag, content_length=stat_result.st_size)
     self.name = output.name
+    self.mtime = stat_result.st_mtime
     self.use_sendfile = True
     return self
 
@@ -338,9 +431,13 @@ class ETaggedDynamicOutput(object):
 
     def __init__(self, func, etag):
         self.func, self.etag = func, etag
+        self.output = None
 
     def __call__(self):
-        return self.func()
+        # The output is generated only once
+        if self.output is None:
+            self.output = self.func()
+        return self.output
 
 
 class GeneratedOutput(object):
@@ -352,6 +449,23 @@ class GeneratedOutput(object):
         self.accept_ranges = False
 
 
+def release_when_done(chunks, release):
+    ' Iterate over chunks, calling release() once they are exhausted or the iteration is abandoned '
+    ans = _release_when_done(chunks, release)
+    # Start the generator so that closing or discarding it calls release()
+    next(ans)
+    return ans
+
+
+def _release_when_done(chunks, release):
+    try:
+        yield
+        for chunk in chunks:
+            yield chunk
+    finally:
+        release()
+
+
 class StaticOutput(object):
 
     def __init__(self, data):
@@ -365,6 +479,9 @@ class StaticOutput(object):
 class HTTPConnection(HTTPRequest):
 
     use_sendfile = False
+    job_lane_for_request = None
+    compressed_cache = None
+    pump_buffer = pump_pending = None
 
     def write(self, buf, end=None):
         pos = buf.tell()
@@ -395,12 +512,39 @@ class HTTPConnection(HTTPRequest):
                 # another process?
                 self.use_sendfile = self.ready = False
                 raise IOError('sendfile() failed to write any bytes to the socket')
-        else:
+        elif isinstance(buf, (BytesIO, ReadOnlyFileBuffer)) or not hasattr(buf, 'readinto'):
             data = buf.read(min(limit, self.send_bufsize))
             sent = self.send(data)
+        else:
+            sent = self.pump(buf, pos, limit)
         buf.seek(pos + sent)
+        self.bytes_sent += sent
         return buf.tell() >= end
 
+    def pump(self, buf, pos, limit):
+        ''' Send data from the file buf, when sendfile() cannot be used, for
+        example, with SSL. The data is read into a large buffer that is re-used
+        and sent from it without copying. Data not accepted by the socket is
+        sent from the buffer next time, instead of being read again. '''
+        pending = self.pump_pending
+        if pending is None or pending[0] is not buf or pending[1] != pos:
+            if self.pump_buffer is None:
+                self.pump_buffer = memoryview(bytearray(PUMP_BUFFER_SIZE))
+            view = self.pump_buffer[:min(limit, PUMP_BUFFER_SIZE)]
+            num = buf.readinto(view)
+            if not num:
+                self.pump_pending = None
+                return 0
+            pending = self.pump_pending = [buf, pos, view[:num]]
+        data = pending[2]
+        sent = self.send(data[:limit])
+        if sent >= len(data):
+            self.pump_pending = None
+        else:
+            pending[1] += sent
+            pending[2] = data[sent:]
+        return sent
+
     def simple_response(self, status_code, msg='', close_after_response=True, extra_headers=None):
         if self.response_protocol is HTTP1:
             # HTTP/1.0 has no 413/414/303 codes
@@ -444,10 +588,30 @@ class HTTPConnection(HTTPRequest):
             self.remote_addr, self.remote_port, self.is_local_connection,
             self.translator_cache, self.tdir, self.forwarded_for
         )
+        if self.job_lane_for_request is not None:
+            self.job_lane = self.job_lane_for_request(data)
         self.queue_job(self.run_request_handler, data)
 
     def run_request_handler(self, data):
-        result = self.request_handler(data)
+        # The libraries leased by the request handler must stay leased until
+        # the response body has been generated, as bodies can be generated
+        # lazily, after the handler has returned
+        release = True
+        try:
+            result = self.request_handler(data)
+            if isinstance(result, ETaggedDynamicOutput):
+                none_match = parse_if_none_match(data.inheaders.get('If-None-Match', ''))
+                if matching_etag(result.etag, none_match, data.inheaders.get('Accept-Encoding', '')) is None:
+                    result()
+            elif data.leased_libraries and isinstance(result, (GeneratedOutput, GeneratorType)):
+                if isinstance(result, GeneratedOutput):
+                    result.output = release_when_done(result.output, data.release_libraries)
+                else:
+                    result = release_when_done(result, data.release_libraries)
+                release = False
+        finally:
+            if release:
+                data.release_libraries()
         return data, result
 
     def send_range_not_satisfiable(self, content_length):
@@ -493,7 +657,7 @@ class HTTPConnection(HTTPRequest):
             reraise(etype, e, tb)
 
         data, output = result
-        output = self.finalize_output(output, data, self.method is HTTP1)
+        output = self.finalize_output(output, data, self.response_protocol is HTTP1)
         if output is None:
             return
         outheaders = data.outheaders
@@ -550,6 +714,7 @@ class HTTPConnection(HTTPRequest):
 
     def response_ready(self, header_file, output=None):
         self.response_started = True
+        self.response_started_at = monotonic()
         self.optimize_for_sending_packet()
         self.use_sendfile = False
         self.set_state(WRITE, self.write_response_headers, header_file, output)
@@ -624,6 +789,8 @@ class HTTPConnection(HTTPRequest):
 
     def reset_state(self):
         ready = not self.close_after_response
+        self.send_time += monotonic() - self.response_started_at
+        self.pump_buffer = self.pump_pending = None
         self.end_send_optimization()
         self.connection_ready()
         self.ready = ready
@@ -631,13 +798,51 @@ class HTTPConnection(HTTPRequest):
     def report_unhandled_exception(self, e, formatted_traceback):
         self.simple_response(http_client.INTERNAL_SERVER_ERROR)
 
+    def compressed_output(self, output, encoding):
+        ''' Return the compressed representation of output, either from a
+        precompressed static file or from the cache of compressed bodies, so
+        that a body is compressed only once per ETag. As different resources
+        can share an ETag, the cache is keyed by the file name or the request
+        path as well. Returns None if output must be compressed on the fly,
+        which is the case for bodies without an ETag. '''
+        name = getattr(output, 'name', None)
+        if name:
+            try:
+                f = share_open(name + PRECOMPRESSED_EXTENSIONS[encoding], 'rb')
+            except EnvironmentError:
+                pass
+            else:
+                stat_result = file_metadata(f)
+                if stat_result is not None and stat_result.st_mtime >= output.mtime:
+                    ans = ReadableOutput(f, etag=variant_etag(output.etag, encoding), content_length=stat_result.st_size)
+                    ans.name = f.name
+                    ans.use_sendfile = True
+                    return ans
+                f.close()
+        max_size = int(self.opts.compressed_cache_size * 1024 * 1024)
+        if self.compressed_cache is None or output.content_length > max_size // 4:
+            return
+        etag = output.etag
+        if etag is None:
+            # Bodies without an ETag are rarely sent twice
+            return
+        key = etag, name or self.path, encoding
+        cdata = self.compressed_cache.get(key)
+        if cdata is None:
+            cdata = compress_data(output.src_file.read(), encoding)
+            output.src_file.seek(0)
+            self.compressed_cache.add(key, cdata, max_size)
+        ans = ReadableOutput(ReadOnlyFileBuffer(cdata), etag=variant_etag(etag, encoding))
+        ans.accept_ranges = output.accept_ranges
+        return ans
+
     def finalize_output(self, output, request, is_http1):
         none_match = parse_if_none_match(request.inheaders.get('If-None-Match', ''))
         if isinstance(output, ETaggedDynamicOutput):
-            matched = '*' in none_match or (output.etag and output.etag in none_match)
-            if matched:
+            etag = matching_etag(output.etag, none_match, request.inheaders.get('Accept-Encoding', ''))
+            if etag is not None:
                 if self.method in ('GET', 'HEAD'):
-                    self.send_not_modified(output.etag)
+                    self.send_not_modified(etag)
                 else:
                     self.simple_response(http_client.PRECONDITION_FAILED)
                 return
@@ -663,12 +868,32 @@ class HTTPConnection(HTTPRequest):
             output = dynamic_output(output(), outheaders, etag=output.etag)
         else:
             output = GeneratedOutput(output)
+        if is_http1 and isinstance(output, GeneratedOutput):
+            # HTTP/1.0 has no chunked transfer encoding
+            output = dynamic_output(b''.join(
+                chunk if isinstance(chunk, bytes) else chunk.encode('utf-8') for chunk in output.output if chunk), outheaders, etag=output.etag)
         ct = outheaders.get('Content-Type', '').partition(';')[0]
         compressible = (not ct or ct.startswith('text/') or ct.startswith('image/svg') or
                         ct.partition(';')[0] in COMPRESSIBLE_TYPES)
-        compressible = (compressible and request.status_code == http_client.OK and
-                        (opts.compress_min_size > -1 and output.content_length >= opts.compress_min_size) and
-                        acceptable_encoding(request.inheaders.get('Accept-Encoding', '')) and not is_http1)
+        # Generated output has no known length, it is compressed when large
+        # enough to be worth streaming
+        compressible = (compressible and request.status_code == http_client.OK and opts.compress_min_size > -1 and
+                        (output.content_length is None or output.content_length >= opts.compress_min_size) and not is_http1)
+        # The response depends on Accept-Encoding even when it is sent
+        # uncompressed
+        vary = compressible
+        encoding = compressed = None
+        if compressible:
+            accept_encoding = request.inheaders.get('Accept-Encoding', '')
+            encoding = acceptable_encoding(accept_encoding, COMPRESSION_ENCODINGS)
+            if encoding is not None and not isinstance(output, GeneratedOutput):
+                compressed = self.compressed_output(output, encoding)
+            if compressed is None:
+                # Compress on the fly, which is only supported for gzip
+                compressible = acceptable_encoding(accept_encoding) is not None
+            else:
+                uncompressed_length = output.content_length
+                output, compressible = compressed, False
         accept_ranges = (not compressible and output.accept_ranges is not None and request.status_code == http_client.OK and
                         not is_http1)
         ranges = get_ranges(request.inheaders.get('Range'), output.content_length) if output.accept_ranges and self.method in ('GET', 'HEAD') else None
@@ -695,11 +920,19 @@ class HTTPConnection(HTTPRequest):
             outheaders.set('ETag', output.etag, replace_all=True)
         if accept_ranges:
             outheaders.set('Accept-Ranges', 'bytes', replace_all=True)
+        if vary:
+            outheaders.set('Vary', 'Accept-Encoding', replace_all=True)
         if compressible and not ranges:
             outheaders.set('Content-Encoding', 'gzip', replace_all=True)
             if getattr(output, 'content_length', None):
                 outheaders.set('Calibre-Uncompressed-Length', '%d' % output.content_length)
-            output = GeneratedOutput(compress_readable_output(output.src_file), etag=output.etag)
+            if isinstance(output, GeneratedOutput):
+                output = GeneratedOutput(compress_chunks(output.output), etag=output.etag)
+            else:
+                output = GeneratedOutput(compress_readable_output(output.src_file), etag=output.etag)
+        elif compressed is not None:
+            outheaders.set('Content-Encoding', encoding, replace_all=True)
+            outheaders.set('Calibre-Uncompressed-Length', '%d' % uncompressed_length)
         if output.content_length is not None and not compressible and not ranges:
             outheaders.set('Content-Length', '%d' % output.content_length, replace_all=True)
 
@@ -722,10 +955,11 @@ class HTTPConnection(HTTPRequest):
         return output
 
 
-def create_http_handler(handler=None, websocket_handler=None):
+def create_http_handler(handler=None, websocket_handler=None, job_lane_for_request=None):
     from calibre.srv.web_socket import WebSocketConnection
     static_cache = {}
     translator_cache = {}
+    compressed_cache = CompressedCache()
     if handler is None:
         def dummy_http_handler(data):
             return 'Hello'
@@ -735,8 +969,10 @@ def create_http_handler(handler=None, websocket_handler=None):
     def wrapper(*args, **kwargs):
         ans = WebSocketConnection(*args, **kwargs)
         ans.request_handler = handler
+        ans.job_lane_for_request = job_lane_for_request
         ans.websocket_handler = websocket_handler
         ans.static_cache = static_cache
         ans.translator_cache = translator_cache
+        ans.compressed_cache = compressed_cache
         return ans
     return wrapper
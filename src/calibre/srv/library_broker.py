@@ -5,8 +5,9 @@
 from __future__ import absolute_import, division, print_function, unicode_literals
 
 import os
-from collections import OrderedDict, defaultdict
-from threading import RLock as Lock
+from collections import Counter, OrderedDict, defaultdict
+from sys import getsizeof
+from threading import Event, RLock as Lock, Thread
 
 from calibre import filesystem_encoding
 from calibre.db.cache import Cache
@@ -63,9 +64,33 @@ def library_id_from_path(path, existing=frozenset()):
     return make_library_id_unique(library_id, existing)
 
 
+def estimate_memory_usage(db):
+    ' A rough estimate of the memory used by the in-memory tables of db, in bytes '
+    db = getattr(db, 'new_api', db)
+    seen, ans = set(), 0
+    for field in itervalues(db.fields):
+        table = getattr(field, 'table', None)
+        for attr in ('id_map', 'book_col_map', 'col_book_map'):
+            m = getattr(table, attr, None)
+            if m is None or id(m) in seen:
+                continue
+            seen.add(id(m))
+            ans += getsizeof(m) + sum(getsizeof(v) for v in itervalues(m))
+    return ans
+
+
 class LibraryBroker(object):
 
-    def __init__(self, libraries):
+    '''
+    Loads libraries on demand. The default library is never evicted, other
+    libraries are closed, to be re-opened on the next request for them, when
+    they have not been used for idle_timeout seconds, when there are more than
+    max_resident of them or when their estimated memory usage exceeds
+    memory_budget bytes. A value of zero disables the corresponding limit.
+    Libraries that are leased, see :meth:`get`, are never evicted.
+    '''
+
+    def __init__(self, libraries, max_resident=0, idle_timeout=0, memory_budget=0):
         self.lock = Lock()
         self.lmap = OrderedDict()
         self.library_name_map = {}
@@ -88,15 +113,34 @@ class LibraryBroker(object):
             self.library_name_map[library_id] = basename(original_path)
             self.original_path_map[path] = original_path
         self.loaded_dbs = {}
-        self.category_caches, self.search_caches, self.tag_browser_caches = (
+        self.category_caches, self.search_caches, self.tag_browser_caches, self.sort_caches, self.book_json_caches = (
             defaultdict(OrderedDict), defaultdict(OrderedDict),
-            defaultdict(OrderedDict))
-
-    def get(self, library_id=None):
+            defaultdict(OrderedDict), defaultdict(OrderedDict), defaultdict(OrderedDict))
+        self.max_resident, self.idle_timeout, self.memory_budget = max_resident, idle_timeout, memory_budget
+        self.last_used, self.memory_usage = {}, {}
+        self.leases = Counter()
+        self.log = None
+        # Called with the library id of every library that is evicted, before
+        # it is closed
+        self.on_evict = None
+        self.shutting_down = Event()
+        if idle_timeout > 0:
+            t = Thread(name='PruneLibraries', target=self.prune_periodically)
+            t.daemon = True
+            t.start()
+
+    def get(self, library_id=None, lease=False):
+        ''' Return the specified library, loading it if needed. If lease is
+        True, the library is not evicted until :meth:`release` has been called
+        for it. '''
         with self:
             library_id = library_id or self.default_library
+            self.last_used[library_id] = monotonic()
             if library_id in self.loaded_dbs:
-                return self.loaded_dbs[library_id]
+                ans = self.loaded_dbs[library_id]
+                if lease and ans is not None:
+                    self.leases[library_id] += 1
+                return ans
             path = self.lmap.get(library_id)
             if path is None:
                 return
@@ -107,13 +151,94 @@ class LibraryBroker(object):
             except Exception:
                 self.loaded_dbs[library_id] = None
                 raise
-            return ans
+            if lease:
+                self.leases[library_id] += 1
+            evicted = self._evict()
+        self.close_evicted(evicted)
+        return ans
+
+    def release(self, library_id):
+        ' Release a lease on the specified library, taken by :meth:`get` '
+        with self:
+            self.last_used[library_id] = monotonic()
+            self.leases[library_id] -= 1
+            if self.leases[library_id] < 1:
+                del self.leases[library_id]
+
+    def library_memory_usage(self, library_id):
+        # Must be called with lock held
+        ans = self.memory_usage.get(library_id)
+        if ans is None:
+            db = self.loaded_dbs.get(library_id)
+            ans = self.memory_usage[library_id] = 0 if db is None else estimate_memory_usage(db)
+        return ans
+
+    def resident_libraries(self):
+        ' Return a map of library id to (estimated memory usage in bytes, seconds since last use) for all loaded libraries '
+        with self:
+            now = monotonic()
+            return {library_id:(self.library_memory_usage(library_id), now - self.last_used.get(library_id, now))
+                    for library_id, db in iteritems(self.loaded_dbs) if db is not None}
+
+    def _evict(self):
+        # Must be called with lock held. Removes libraries that should be
+        # evicted from loaded_dbs, returning them, so that they can be closed
+        # without holding the lock.
+        if not self.idle_timeout and not self.max_resident and not self.memory_budget:
+            return ()
+        now = monotonic()
+        resident = [library_id for library_id, db in iteritems(self.loaded_dbs) if db is not None]
+        candidates = sorted((
+            library_id for library_id in resident if library_id != self.default_library and
+            library_id not in self.leases), key=lambda x: self.last_used.get(x, 0))
+        evict = []
+        if self.idle_timeout:
+            evict = [library_id for library_id in candidates if now - self.last_used.get(library_id, 0) > self.idle_timeout]
+            candidates = candidates[len(evict):]
+        num = len(resident) - len(evict)
+        while self.max_resident and num > self.max_resident and candidates:
+            evict.append(candidates.pop(0))
+            num -= 1
+        if self.memory_budget:
+            total = sum(self.library_memory_usage(library_id) for library_id in resident if library_id not in evict)
+            while total > self.memory_budget and candidates:
+                library_id = candidates.pop(0)
+                evict.append(library_id)
+                total -= self.library_memory_usage(library_id)
+        ans = []
+        for library_id in evict:
+            if self.log is not None:
+                self.log('Unloading library: %s using about %.1f MB, unused for %d seconds' % (
+                    library_id, self.library_memory_usage(library_id) / (1024 * 1024), now - self.last_used.get(library_id, 0)))
+            ans.append((library_id, self.loaded_dbs.pop(library_id)))
+            self.memory_usage.pop(library_id, None)
+            for cache in (self.category_caches, self.search_caches, self.tag_browser_caches, self.sort_caches, self.book_json_caches):
+                cache.pop(library_id, None)
+        return ans
+
+    def close_evicted(self, evicted):
+        for library_id, db in evicted:
+            if self.on_evict is not None:
+                self.on_evict(library_id)
+            # Wait for anything still reading from the db
+            with db.write_lock:
+                db.close()
+
+    def prune(self):
+        with self:
+            evicted = self._evict()
+        self.close_evicted(evicted)
+
+    def prune_periodically(self):
+        while not self.shutting_down.wait(min(60, self.idle_timeout)):
+            self.prune()
 
     def init_library(self, library_path, is_default_library):
         library_path = self.original_path_map.get(library_path, library_path)
         return init_library(library_path, is_default_library)
 
     def close(self):
+        self.shutting_down.set()
         with self:
             for db in itervalues(self.loaded_dbs):
                 getattr(db, 'close', lambda: None)()
@@ -171,9 +296,9 @@ class GuiLibraryBroker(LibraryBroker):
         library_path = self.original_path_map.get(library_path, library_path)
         return LibraryDatabase(library_path, is_second_db=True)
 
-    def get(self, library_id=None):
+    def get(self, library_id=None, lease=False):
         try:
-            return getattr(LibraryBroker.get(self, library_id), 'new_api', None)
+            return getattr(LibraryBroker.get(self, library_id, lease=lease), 'new_api', None)
         finally:
             self.last_used_times[library_id or self.default_library] = monotonic()
 
@@ -6,14 +6,16 @@ from __future__ import (unicode_literals, division, absolute_import,
 __license__ = 'GPL v3'
 __copyright__ = '2015, Kovid Goyal <kovid at kovidgoyal.net>'
 
-import ssl, socket, select, os, traceback
+import ssl, socket, select, os, traceback, errno
 from io import BytesIO
 from functools import partial
+from heapq import heappush, heappop
+from itertools import count
 
 from calibre import as_unicode
 from calibre.ptempfile import TemporaryDirectory
 from calibre.srv.errors import JobQueueFull
-from calibre.srv.pool import ThreadPool, PluginPool
+from calibre.srv.pool import ThreadPool, PluginPool, FAST
 from calibre.srv.opts import Options
 from calibre.srv.jobs import JobsManager
 from calibre.srv.utils import (
@@ -24,12 +26,13 @@ from calibre.utils.socket_inheritance import set_socket_inherit
 from calibre.utils.logging import ThreadSafeLog
 from calibre.utils.monotonic import monotonic
 from calibre.utils.mdns import get_external_ip
-from polyglot.builtins import iteritems, range
+from polyglot.builtins import iteritems, itervalues, range
 from polyglot.queue import Empty, Full
 
 READ, WRITE, RDWR, WAIT = 'READ', 'WRITE', 'RDWR', 'WAIT'
 WAKEUP, JOB_DONE = bytes(bytearray(range(2)))
 IPPROTO_IPV6 = getattr(socket, "IPPROTO_IPV6", 41)
+POLL_READ, POLL_WRITE = 1, 2
 
 
 class ReadBuffer(object):  # {{{
@@ -117,11 +120,40 @@ class ReadBuffer(object):  # {{{
                 if self.read_pos == self.write_pos:
                     self.full_state = WRITE
         return ans
+
+    def readblock(self, terminator=b'\r\n\r\n'):
+        # Return whatever is in the buffer up to (and including) the first
+        # occurrence of terminator. If terminator is not present, returns None
+        # and leaves the buffer untouched.
+        if self.read_pos == self.write_pos and self.full_state is WRITE:
+            return
+        if self.read_pos < self.write_pos:
+            pos = self.ba.find(terminator, self.read_pos, self.write_pos)
+            if pos < 0:
+                return
+            end = pos + len(terminator)
+            ans = self.buf[self.read_pos:end].tobytes()
+            self.read_pos = end % len(self.buf)
+        else:
+            # The data wraps around the end of the buffer
+            data = self.buf[self.read_pos:].tobytes() + self.buf[:self.write_pos].tobytes()
+            pos = data.find(terminator)
+            if pos < 0:
+                return
+            end = pos + len(terminator)
+            ans = data[:end]
+            self.read_pos = (self.read_pos + end) % len(self.buf)
+        if self.read_pos == self.write_pos:
+            self.full_state = WRITE
+        return ans
     # }}}
 
 
 class Connection(object):  # {{{
 
+    # The lane of the worker pool in which jobs for this connection are queued
+    job_lane = FAST
+
     def __init__(self, socket, opts, ssl_context, tdir, addr, pool, log, access_log, wakeup):
         self.opts, self.pool, self.log, self.wakeup, self.access_log = opts, pool, log, wakeup, access_log
         try:
@@ -132,6 +164,10 @@ class Connection(object):  # {{{
             self.remote_addr = self.remote_port = None
         self.is_local_connection = self.remote_addr in ('127.0.0.1', '::1')
         self.orig_send_bufsize = self.send_bufsize = 4096
+        # The number of bytes sent and the time spent sending responses, used
+        # to report the throughput of this connection
+        self.bytes_sent, self.send_time = 0, 0.0
+        self.response_started_at = 0.0
         self.tdir = tdir
         self.wait_for = READ
         self.response_started = False
@@ -150,6 +186,14 @@ class Connection(object):  # {{{
         self.last_activity = monotonic()
         self.ready = True
 
+    @property
+    def bytes_per_second(self):
+        ' The average rate at which this connection has sent data, including the response being sent now '
+        send_time = self.send_time
+        if self.response_started:
+            send_time += monotonic() - self.response_started_at
+        return (self.bytes_sent / send_time) if send_time > 0 else 0
+
     def optimize_for_sending_packet(self):
         start_cork(self.socket)
         self.orig_send_bufsize = self.send_bufsize = self.socket.getsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF)
@@ -300,7 +344,7 @@ class Connection(object):  # {{{
         if args:
             func = partial(func, *args)
         try:
-            self.pool.put_nowait(self.socket.fileno(), func)
+            self.pool.put_nowait(self.socket.fileno(), func, self.job_lane)
         except Full:
             raise JobQueueFull()
         self.set_state(WAIT, self._job_done)
@@ -329,6 +373,99 @@ class Connection(object):  # {{{
 # }}}
 
 
+class SelectorsPoller(object):  # {{{
+
+    ' Wraps a selector from the selectors module (epoll, kqueue, etc.) '
+
+    def __init__(self, selector):
+        self.selector = selector
+
+    def register(self, fd, events):
+        self.selector.register(fd, events)
+
+    def modify(self, fd, events):
+        self.selector.modify(fd, events)
+
+    def unregister(self, fd):
+        try:
+            self.selector.unregister(fd)
+        except (KeyError, ValueError):
+            pass
+
+    def poll(self, timeout):
+        return [(key.fd, events) for key, events in self.selector.select(timeout)]
+
+    def close(self):
+        self.selector.close()
+# }}}
+
+
+class EpollPoller(object):  # {{{
+
+    ' Uses epoll directly, for python versions without the selectors module '
+
+    def __init__(self):
+        self.epoll = select.epoll()
+        self.interest = {}
+
+    def mask(self, events):
+        return (select.EPOLLIN if events & POLL_READ else 0) | (select.EPOLLOUT if events & POLL_WRITE else 0)
+
+    def register(self, fd, events):
+        self.epoll.register(fd, self.mask(events))
+        self.interest[fd] = events
+
+    def modify(self, fd, events):
+        self.epoll.modify(fd, self.mask(events))
+        self.interest[fd] = events
+
+    def unregister(self, fd):
+        if self.interest.pop(fd, None) is not None:
+            try:
+                self.epoll.unregister(fd)
+            except (EnvironmentError, ValueError):
+                pass
+
+    def poll(self, timeout):
+        try:
+            events = self.epoll.poll(timeout)
+        except EnvironmentError as e:
+            if e.errno == errno.EINTR:
+                return ()
+            raise
+        ans = []
+        failed = select.EPOLLERR | select.EPOLLHUP
+        for fd, ev in events:
+            ready = 0
+            if ev & (select.EPOLLIN | failed):
+                ready |= POLL_READ
+            if ev & (select.EPOLLOUT | failed):
+                ready |= POLL_WRITE
+            ready &= self.interest.get(fd, 0)
+            if ready:
+                ans.append((fd, ready))
+        return ans
+
+    def close(self):
+        self.epoll.close()
+# }}}
+
+
+def create_poller():
+    '''
+    Return a poller that keeps socket registrations across calls, or None if
+    the only mechanism available is select(), in which case the select() based
+    event loop is used.
+    '''
+    try:
+        import selectors
+    except ImportError:
+        return EpollPoller() if hasattr(select, 'epoll') else None
+    if selectors.DefaultSelector is selectors.SelectSelector:
+        return None
+    return SelectorsPoller(selectors.DefaultSelector())
+
+
 class ServerLoop(object):
 
     LISTENING_MSG = 'calibre server listening on'
@@ -359,6 +496,14 @@ class ServerLoop(object):
         self.bind_address = ba
         self.bound_address = None
         self.connection_map = {}
+        # Set to False to always use the select() based event loop
+        self.use_poller = True
+        self.poller = None
+        self.registered, self.pending, self.timeouts = {}, set(), []
+        self.timeout_counter = count()
+        # Bytes sent by connections that have been closed
+        self.bytes_sent = 0
+        self.resync_needed = False
 
         self.ssl_context = None
         if self.opts.ssl_certfile is not None and self.opts.ssl_keyfile is not None:
@@ -375,7 +520,7 @@ class ServerLoop(object):
                 self.bind_address = self.pre_activated_socket.getsockname()
 
         self.create_control_connection()
-        self.pool = ThreadPool(self.log, self.job_completed, count=self.opts.worker_count)
+        self.pool = ThreadPool(self.log, self.job_completed, count=self.opts.worker_count, max_count=self.opts.max_worker_count)
         self.plugin_pool = PluginPool(self, plugins)
 
     def on_ssl_servername(self, socket, server_name, ssl_context):
@@ -387,7 +532,12 @@ class ServerLoop(object):
             return ssl.ALERT_DESCRIPTION_NO_RENEGOTIATION
 
     def create_control_connection(self):
+        old = getattr(self, 'control_out', None)
         self.control_in, self.control_out = create_sock_pair()
+        if self.poller is not None:
+            if old is not None:
+                self.poller.unregister(old.fileno())
+            self.poller.register(self.control_out.fileno(), POLL_READ)
 
     def __str__(self):
         return "%s(%r)" % (self.__class__.__name__, self.bind_address)
@@ -397,6 +547,20 @@ class ServerLoop(object):
     def num_active_connections(self):
         return len(self.connection_map)
 
+    def stats(self):
+        ' Statistics about the server, such as the queue depths and latencies of the worker pool '
+        # Called from worker threads, copy the map, as it is changed by the
+        # server loop
+        conns = tuple(itervalues(self.connection_map.copy()))
+        return {
+            'connections': self.num_active_connections, 'pool': self.pool.stats(),
+            'bytes_sent': self.bytes_sent + sum(c.bytes_sent for c in conns),
+            'throughput': [{
+                'remote_addr': c.remote_addr, 'remote_port': c.remote_port, 'bytes_sent': c.bytes_sent,
+                'bytes_per_second': c.bytes_per_second,
+            } for c in conns]
+        }
+
     def do_bind(self):
         # Get the correct address family for our host (allows IPv6 addresses)
         host, port = self.bind_address
@@ -454,6 +618,11 @@ class ServerLoop(object):
         if isinstance(ba, tuple):
             ba = ':'.join(map(type(''), ba))
         self.pool.start()
+        self.poller = create_poller() if self.use_poller else None
+        if self.poller is not None:
+            self.registered, self.pending, self.timeouts = {}, set(), []
+            self.poller.register(self.socket.fileno(), POLL_READ)
+            self.poller.register(self.control_out.fileno(), POLL_READ)
         with TemporaryDirectory(prefix='srv-') as tdir:
             self.tdir = tdir
             self.ready = True
@@ -502,6 +671,96 @@ class ServerLoop(object):
         self.socket.bind(self.bind_address)
 
     def tick(self):
+        if self.poller is None:
+            self.select_tick()
+        else:
+            self.poll_tick()
+
+    def poll_tick(self):
+        now = monotonic()
+        self.expire_connections(now)
+        # Connections with buffered data are readable without waiting
+        pending = self.pending
+        self.pending = set()
+        readable, writable = list(pending), []
+        timeout = 0
+        if not readable:
+            timeout = self.opts.timeout
+            if self.timeouts:
+                timeout = max(0, min(timeout, self.timeouts[0][0] - now))
+        try:
+            events = self.poller.poll(timeout)
+        except (select.error, socket.error, EnvironmentError) as e:
+            if getattr(e, 'errno', e.args[0]) in socket_errors_eintr:
+                return
+            raise
+        for s, ev in events:
+            if ev & POLL_READ and s not in pending:
+                readable.append(s)
+            if ev & POLL_WRITE:
+                writable.append(s)
+
+        if not self.ready:
+            return
+
+        handled = self.handle_actions(readable, writable)
+        if self.resync_needed:
+            # Woken up by another thread, which may have changed the state of
+            # any connection
+            self.resync_needed = False
+            handled = tuple(self.connection_map)
+        for s in handled:
+            conn = self.connection_map.get(s)
+            if conn is not None:
+                self.watch(s, conn)
+
+    def watch(self, s, conn):
+        ' Make the poller wait for the events conn is currently waiting for '
+        wf = conn.wait_for
+        events = 0
+        if wf is READ or wf is RDWR:
+            events = POLL_READ | (POLL_WRITE if wf is RDWR else 0)
+            if conn.read_buffer.has_data:
+                self.pending.add(s)
+            elif self.ssl_context is not None:
+                conn.drain_ssl_buffer()
+                if not conn.ready:
+                    return self.close(s, conn)
+                if conn.read_buffer.has_data:
+                    self.pending.add(s)
+        elif wf is WRITE:
+            events = POLL_WRITE
+        current = self.registered.get(s, 0)
+        if events != current:
+            if not events:
+                del self.registered[s]
+                self.poller.unregister(s)
+            else:
+                (self.poller.modify if current else self.poller.register)(s, events)
+                self.registered[s] = events
+
+    def schedule_timeout(self, s, conn):
+        heappush(self.timeouts, (conn.last_activity + self.opts.timeout, next(self.timeout_counter), s, conn))
+
+    def expire_connections(self, now):
+        timeouts, timeout = self.timeouts, self.opts.timeout
+        # The heap holds the earliest time at which each connection could
+        # time out, checked against last_activity only when that time comes
+        while timeouts and timeouts[0][0] <= now:
+            s, conn = heappop(timeouts)[2:]
+            if self.connection_map.get(s) is not conn:
+                continue
+            if now - conn.last_activity >= timeout:
+                if conn.handle_timeout():
+                    conn.last_activity = now
+                    self.watch(s, conn)
+                else:
+                    self.log('Closing connection because of extended inactivity: %s' % conn.state_description)
+                    self.close(s, conn)
+                    continue
+            self.schedule_timeout(s, conn)
+
+    def select_tick(self):
         now = monotonic()
         read_needed, write_needed, readable, remove, close_needed = [], [], [], [], []
         has_ssl = self.ssl_context is not None
@@ -562,10 +821,14 @@ class ServerLoop(object):
         if not self.ready:
             return
 
-        ignore = set()
+        self.handle_actions(readable, writable)
+
+    def handle_actions(self, readable, writable):
+        ignore, handled = set(), set()
         for s, conn, event in self.get_actions(readable, writable):
             if s in ignore:
                 continue
+            handled.add(s)
             try:
                 conn.handle_event(event)
                 if not conn.ready:
@@ -599,6 +862,7 @@ class ServerLoop(object):
                     else:
                         self.log.error('Error in SSL handshake, terminating connection: %s' % as_unicode(e))
                         self.close(s, conn)
+        return handled
 
     def wakeup(self):
         self.control_in.sendall(WAKEUP)
@@ -618,6 +882,11 @@ class ServerLoop(object):
 
     def close(self, s, conn):
         self.connection_map.pop(s, None)
+        self.bytes_sent += conn.bytes_sent
+        if self.poller is not None:
+            if self.registered.pop(s, None) is not None:
+                self.poller.unregister(s)
+            self.pending.discard(s)
         conn.close()
 
     def get_actions(self, readable, writable):
@@ -631,6 +900,9 @@ class ServerLoop(object):
                     if s > -1:
                         self.connection_map[s] = conn = self.handler(
                             sock, self.opts, self.ssl_context, self.tdir, addr, self.pool, self.log, self.access_log, self.wakeup)
+                        if self.poller is not None:
+                            self.schedule_timeout(s, conn)
+                            self.watch(s, conn)
                         if self.ssl_context is not None:
                             yield s, conn, RDWR
             elif s == control:
@@ -646,7 +918,7 @@ class ServerLoop(object):
                     for s, conn, event in self.dispatch_job_results():
                         yield s, conn, event
                 elif c == WAKEUP:
-                    pass
+                    self.resync_needed = True
                 elif not c:
                     if not self.ready:
                         return
@@ -683,6 +955,9 @@ class ServerLoop(object):
             pass
         for s, conn in tuple(iteritems(self.connection_map)):
             self.close(s, conn)
+        if self.poller is not None:
+            self.poller.close()
+            self.poller = None
         wait_till = monotonic() + self.opts.shutdown_timeout
         for pool in (self.plugin_pool, self.pool):
             pool.stop(wait_till)
@@ -392,20 +392,27 @@ class RequestContext(object):
     def search(self, query):
         return self.ctx.search(self.rd, self.db, query)
 
+    def sorted_book_ids(self, ids, sort_fields, key=None):
+        if key is not None:
+            key = self.ctx.book_ids_key(self.rd, self.db, *key)
+        return self.ctx.sorted_book_ids(self.db, ids, sort_fields, key=key)
+
 
 def get_acquisition_feed(rc, ids, offset, page_url, up_url, id_,
-        sort_by='title', ascending=True, feed_title=None):
+        sort_by='title', ascending=True, feed_title=None, ids_key=None):
     if not ids:
         raise HTTPNotFound('No books found')
-    with rc.db.safe_read_lock:
-        sort_by = sanitize_sort_field_name(rc.db.field_metadata, sort_by)
-        items = rc.db.multisort([(sort_by, ascending)], ids)
-        max_items = rc.opts.max_opds_items
-        offsets = Offsets(offset, max_items, len(items))
-        items = items[offsets.offset:offsets.offset+max_items]
-        lm = rc.last_modified()
-        rc.outheaders['Last-Modified'] = http_date(timestampfromdt(lm))
-        return AcquisitionFeed(id_, lm, rc, items, offsets, page_url, up_url, title=feed_title).root
+    # The read lock is not held for the whole feed, the sort and every book
+    # entry lock the library for as long as they need it, so that writers are
+    # not blocked while the feed is generated
+    sort_by = sanitize_sort_field_name(rc.db.field_metadata, sort_by)
+    items = rc.sorted_book_ids(ids, [(sort_by, ascending)], key=ids_key)
+    max_items = rc.opts.max_opds_items
+    offsets = Offsets(offset, max_items, len(items))
+    items = items[offsets.offset:offsets.offset+max_items]
+    lm = rc.last_modified()
+    rc.outheaders['Last-Modified'] = http_date(timestampfromdt(lm))
+    return AcquisitionFeed(id_, lm, rc, items, offsets, page_url, up_url, title=feed_title).root
 
 
 def get_all_books(rc, which, page_url, up_url, offset=0):
@@ -422,7 +429,7 @@ def get_all_books(rc, which, page_url, up_url, offset=0):
     ids = rc.allowed_book_ids()
     return get_acquisition_feed(rc, ids, offset, page_url, up_url,
             id_='calibre-all:'+sort, sort_by=sort, ascending=ascending,
-            feed_title=feed_title)
+            feed_title=feed_title, ids_key=('all',))
 
 
 def get_navcatalog(request_context, which, page_url, up_url, offset=0):
@@ -562,11 +569,12 @@ def opds_category(ctx, rd, category, which):
         raise HTTPNotFound('Category %r not found'%which)
 
     if category == 'search':
+        query = 'search:"%s"'%which
         try:
-            ids = rc.search('search:"%s"'%which)
+            ids = rc.search(query)
         except Exception:
             raise HTTPNotFound('Search: %r not understood'%which)
-        return get_acquisition_feed(rc, ids, offset, page_url, up_url, 'calibre-search:'+which)
+        return get_acquisition_feed(rc, ids, offset, page_url, up_url, 'calibre-search:'+which, ids_key=('search', query, ''))
 
     if type_ != 'I':
         raise HTTPNotFound('Non id categories not supported')
@@ -577,7 +585,8 @@ def opds_category(ctx, rd, category, which):
     ids = rc.db.get_books_for_category(q, which)
     sort_by = 'series' if category == 'series' else 'title'
 
-    return get_acquisition_feed(rc, ids, offset, page_url, up_url, 'calibre-category:'+category+':'+str(which), sort_by=sort_by)
+    return get_acquisition_feed(rc, ids, offset, page_url, up_url, 'calibre-category:'+category+':'+str(which), sort_by=sort_by,
+                                ids_key=('category', q, which))
 
 
 @endpoint('/opds/categorygroup/{category}/{which}', postprocess=atom)
@@ -637,4 +646,4 @@ def opds_search(ctx, rd, query):
     except Exception:
         raise HTTPNotFound('Search: %r not understood'%query)
     page_url = rc.url_for('/opds/search', query=query)
-    return get_acquisition_feed(rc, ids, offset, page_url, rc.url_for('/opds'), 'calibre-search:'+query)
+    return get_acquisition_feed(rc, ids, offset, page_url, rc.url_for('/opds'), 'calibre-search:'+query, ids_key=('search', query, ''))
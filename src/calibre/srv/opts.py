@@ -68,10 +68,22 @@ raw_options = (
     'compress_min_size', 1024,
     None,
 
+    _('Max. size of the cache of compressed responses (in MB)'),
+    'compressed_cache_size', 20,
+    _('Compressed versions of responses, such as the JavaScript used by the browser'
+    ' interface, are kept in memory so that they do not have to be compressed again'
+    ' for every request. Set to zero to disable the cache.'),
+
     _('Number of worker threads used to process requests'),
     'worker_count', 10,
     None,
 
+    _('Maximum number of worker threads used to process requests'),
+    'max_worker_count', 30,
+    _('When all worker threads are busy, more are started, up to this number.'
+      ' The extra threads are stopped once they have been idle for a while. If'
+      ' this is less than the number of worker threads, no extra threads are started.'),
+
     _('Maximum number of worker processes'),
     'max_jobs', 0,
     _('Worker processes are launched as needed and used for large jobs such as preparing'
@@ -129,6 +141,32 @@ raw_options = (
     ' increasing performance. However, it can cause corrupted file transfers on some'
     ' broken filesystems. If you experience corrupted file transfers, turn it off.'),
 
+    _('Max. number of libraries to keep loaded'),
+    'max_resident_libraries', 10,
+    _('Libraries are loaded into memory when they are first used. When more than'
+    ' this many libraries are loaded, the least recently used ones are unloaded.'
+    ' They are loaded again, transparently, the next time they are needed.'
+    ' The default library is always kept loaded. Set to zero for no limit.'),
+
+    _('Unload libraries not used for (minutes)'),
+    'library_idle_timeout', 60,
+    _('Libraries, other than the default library, that have not been used for'
+    ' this many minutes are unloaded, to free up memory. Set to zero to never'
+    ' unload idle libraries.'),
+
+    _('Max. memory used by loaded libraries (in MB)'),
+    'library_memory_budget', 0,
+    _('When the estimated memory used by loaded libraries exceeds this size,'
+    ' the least recently used libraries, other than the default library, are'
+    ' unloaded. Set to zero for no limit.'),
+
+    _('Max. size of the thumbnail cache (in MB)'),
+    'thumbnail_cache_size', 200,
+    _('Thumbnails of book covers are stored in a cache on disk that is kept across'
+    ' restarts of the server, so that they do not have to be generated again. When'
+    ' the cache becomes larger than this size, the least recently used thumbnails'
+    ' are removed. Set to zero to disable the cache.'),
+
     _('Max. log file size (in MB)'),
     'max_log_size', 20,
     _('The maximum size of log files, generated by the server. When the log becomes larger'
@@ -7,84 +7,212 @@ __license__ = 'GPL v3'
 __copyright__ = '2015, Kovid Goyal <kovid at kovidgoyal.net>'
 
 import sys
-from threading import Thread
+from collections import deque
+from threading import Thread, Lock, Condition
 
 from calibre.utils.monotonic import monotonic
-from polyglot.builtins import range
+from polyglot.builtins import iteritems, range
 from polyglot.queue import Queue, Full
 
+# The lanes of the worker pool. Jobs in the heavy lane, such as sending book
+# files or resizing covers, can use only some of the workers, so that fast
+# jobs do not have to wait behind them.
+FAST, HEAVY = 'fast', 'heavy'
+
 
 class Worker(Thread):
 
     daemon = True
 
-    def __init__(self, log, notify_server, num, request_queue, result_queue):
-        self.request_queue, self.result_queue = request_queue, result_queue
-        self.notify_server = notify_server
-        self.log = log
+    def __init__(self, pool, num):
+        self.pool = pool
         self.working = False
         Thread.__init__(self, name='ServerWorker%d' % num)
 
     def run(self):
+        pool = self.pool
         while True:
-            x = self.request_queue.get()
+            x = pool.next_job(self)
             if x is None:
                 break
-            job_id, func = x
+            lane, job_id, func = x
             self.working = True
+            st = monotonic()
             try:
                 result = func()
             except Exception:
                 self.handle_error(job_id)  # must be a separate function to avoid reference cycles with sys.exc_info()
             else:
-                self.result_queue.put((job_id, True, result))
+                pool.result_queue.put((job_id, True, result))
             finally:
                 self.working = False
+                pool.job_finished(lane, monotonic() - st)
             try:
-                self.notify_server()
+                pool.notify_server()
             except Exception:
-                self.log.exception('ServerWorker failed to notify server on job completion')
+                pool.log.exception('ServerWorker failed to notify server on job completion')
 
     def handle_error(self, job_id):
-        self.result_queue.put((job_id, False, sys.exc_info()))
+        self.pool.result_queue.put((job_id, False, sys.exc_info()))
+
+
+class LaneStats(object):
+
+    __slots__ = ('completed', 'rejected', 'total_wait', 'max_wait', 'total_time', 'max_time')
+
+    def __init__(self):
+        self.completed = self.rejected = 0
+        self.total_wait = self.max_wait = self.total_time = self.max_time = 0.0
+
+    def started(self, wait):
+        self.total_wait += wait
+        self.max_wait = max(self.max_wait, wait)
+
+    def finished(self, duration):
+        self.completed += 1
+        self.total_time += duration
+        self.max_time = max(self.max_time, duration)
+
+    def as_dict(self):
+        n = max(1, self.completed)
+        return {
+            'completed': self.completed, 'rejected': self.rejected,
+            'average_wait': self.total_wait / n, 'max_wait': self.max_wait,
+            'average_time': self.total_time / n, 'max_time': self.max_time,
+        }
 
 
 class ThreadPool(object):
 
-    def __init__(self, log, notify_server, count=10, queue_size=1000):
-        self.request_queue, self.result_queue = Queue(queue_size), Queue(queue_size)
-        self.workers = [Worker(log, notify_server, i, self.request_queue, self.result_queue) for i in range(count)]
+    '''
+    A pool of worker threads that grows from count to max_count threads when
+    jobs are waiting and no workers are idle. Threads beyond count exit after
+    being idle for idle_timeout seconds. Jobs are queued in lanes, at most half
+    the workers run jobs from the HEAVY lane at any time.
+    '''
+
+    def __init__(self, log, notify_server, count=10, queue_size=1000, max_count=None, idle_timeout=60):
+        self.log, self.notify_server = log, notify_server
+        self.min_count = count
+        self.max_count = max(count, max_count or count)
+        self.heavy_limit = max(1, self.max_count // 2)
+        self.queue_size, self.idle_timeout = queue_size, idle_timeout
+        self.lock = Lock()
+        self.has_jobs = Condition(self.lock)
+        self.queues = {FAST: deque(), HEAVY: deque()}
+        self.running = {FAST: 0, HEAVY: 0}
+        self.lane_stats = {FAST: LaneStats(), HEAVY: LaneStats()}
+        self.result_queue = Queue(queue_size)
+        self.num_idle = self.num_started = 0
+        self.stopping = False
+        self.workers = []
 
     def start(self):
-        for w in self.workers:
-            w.start()
-
-    def put_nowait(self, job_id, func):
-        self.request_queue.put_nowait((job_id, func))
+        with self.lock:
+            for i in range(self.min_count):
+                self.start_worker()
+
+    def start_worker(self):
+        w = Worker(self, self.num_started)
+        self.num_started += 1
+        self.workers.append(w)
+        w.start()
+
+    def runnable_jobs(self):
+        heavy = min(len(self.queues[HEAVY]), self.heavy_limit - self.running[HEAVY])
+        return len(self.queues[FAST]) + max(0, heavy)
+
+    def put_nowait(self, job_id, func, lane=FAST):
+        with self.lock:
+            q = self.queues[lane]
+            if len(q) >= self.queue_size or self.stopping:
+                self.lane_stats[lane].rejected += 1
+                raise Full()
+            q.append((job_id, func, monotonic()))
+            if self.runnable_jobs() > self.num_idle and len(self.workers) < self.max_count:
+                self.start_worker()
+            self.has_jobs.notify()
 
     def get_nowait(self):
         return self.result_queue.get_nowait()
 
-    def stop(self, wait_till):
-        for w in self.workers:
+    def pop_job(self):
+        fast, heavy = self.queues[FAST], self.queues[HEAVY]
+        # Oldest job first, as long as there are workers left for the heavy lane
+        if heavy and self.running[HEAVY] < self.heavy_limit and (not fast or heavy[0][2] <= fast[0][2]):
+            lane, q = HEAVY, heavy
+        elif fast:
+            lane, q = FAST, fast
+        else:
+            return None
+        job_id, func, queued_at = q.popleft()
+        self.running[lane] += 1
+        self.lane_stats[lane].started(monotonic() - queued_at)
+        return lane, job_id, func
+
+    def next_job(self, worker):
+        with self.lock:
+            self.num_idle += 1
             try:
-                self.request_queue.put_nowait(None)
-            except Full:
-                break
-        for w in self.workers:
+                while True:
+                    x = self.pop_job()
+                    if x is not None:
+                        return x
+                    if self.stopping:
+                        break
+                    if len(self.workers) > self.min_count:
+                        st = monotonic()
+                        self.has_jobs.wait(self.idle_timeout)
+                        if monotonic() - st >= self.idle_timeout and len(self.workers) > self.min_count and not self.runnable_jobs():
+                            break
+                    else:
+                        self.has_jobs.wait()
+                if worker in self.workers:
+                    self.workers.remove(worker)
+            finally:
+                self.num_idle -= 1
+
+    def job_finished(self, lane, duration):
+        with self.lock:
+            self.running[lane] -= 1
+            self.lane_stats[lane].finished(duration)
+            if lane is HEAVY and self.queues[HEAVY]:
+                self.has_jobs.notify()
+
+    def stop(self, wait_till):
+        with self.lock:
+            self.stopping = True
+            self.has_jobs.notify_all()
+            workers = list(self.workers)
+        for w in workers:
             now = monotonic()
             if now >= wait_till:
                 break
             w.join(wait_till - now)
-        self.workers = [w for w in self.workers if w.is_alive()]
+        with self.lock:
+            self.workers = [w for w in workers if w.is_alive()]
 
     @property
     def busy(self):
-        return sum(int(w.working) for w in self.workers)
+        return sum(int(w.working) for w in tuple(self.workers))
 
     @property
     def idle(self):
-        return sum(int(not w.working) for w in self.workers)
+        return sum(int(not w.working) for w in tuple(self.workers))
+
+    def stats(self):
+        ''' The number of workers and the queue depth, number of running jobs
+        and wait and run times (in seconds) of each lane '''
+        with self.lock:
+            lanes = {}
+            for lane, q in iteritems(self.queues):
+                lanes[lane] = ls = self.lane_stats[lane].as_dict()
+                ls['queued'], ls['running'] = len(q), self.running[lane]
+            return {
+                'workers': len(self.workers), 'idle': self.num_idle,
+                'min_workers': self.min_count, 'max_workers': self.max_count,
+                'lanes': lanes,
+            }
 
 
 class PluginPool(object):
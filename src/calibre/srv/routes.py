@@ -10,6 +10,7 @@ import sys, inspect, re, time, numbers, json as jsonlib, textwrap
 from operator import attrgetter
 
 from calibre.srv.errors import HTTPSimpleResponse, HTTPNotFound, RouteError
+from calibre.srv.pool import FAST, HEAVY
 from calibre.srv.utils import http_date
 from calibre.utils.serialize import msgpack_dumps, json_dumps, MSGPACK_MIME
 from polyglot.builtins import iteritems, itervalues, unicode_type, range, zip
@@ -19,10 +20,36 @@ from polyglot.urllib import quote as urlquote
 default_methods = frozenset(('HEAD', 'GET'))
 
 
+class JSONFragments(dict):
+
+    ' A mapping of keys to values that are already JSON encoded, as UTF-8 bytes. A value of None is encoded as null. '
+
+    __slots__ = ()
+
+
+def json_fragments_dumps(items):
+    ' Return the JSON object for items, an iterable of (key, JSON encoded value) pairs, as UTF-8 bytes '
+    return b'{' + b','.join(
+        json_dumps(unicode_type(key)) + b':' + (b'null' if val is None else val) for key, val in items) + b'}'
+
+
+def json_dumps_with_fragments(output):
+    ' Return output, a dict whose values may be JSONFragments, as UTF-8 encoded JSON '
+    plain = {k:v for k, v in iteritems(output) if not isinstance(v, JSONFragments)}
+    parts = [json_dumps(plain)[1:-1]] if plain else []
+    for k, v in iteritems(output):
+        if isinstance(v, JSONFragments):
+            parts.append(json_dumps(unicode_type(k)) + b':' + json_fragments_dumps(iteritems(v)))
+    return b'{' + b','.join(parts) + b'}'
+
+
 def json(ctx, rd, endpoint, output):
     rd.outheaders.set('Content-Type', 'application/json; charset=UTF-8', replace_all=True)
     if isinstance(output, bytes) or hasattr(output, 'fileno'):
         ans = output  # Assume output is already UTF-8 encoded json
+    elif isinstance(output, dict) and any(isinstance(v, JSONFragments) for v in itervalues(output)):
+        # The fragments are spliced in without being decoded and re-encoded
+        ans = json_dumps_with_fragments(output)
     else:
         ans = json_dumps(output)
     return ans
@@ -70,7 +97,11 @@ def endpoint(route,
              postprocess=None,
 
              # Needs write access to the calibre database
-             needs_db_write=False
+             needs_db_write=False,
+
+             # Slow or I/O heavy, such as sending files, run in the HEAVY lane
+             # of the worker pool
+             heavy=False
 
 ):
     from calibre.srv.handler import Context
@@ -88,6 +119,7 @@ def endpoint(route,
         f.ok_code = ok_code
         f.is_endpoint = True
         f.needs_db_write = needs_db_write
+        f.heavy = heavy
         argspec = inspect.getargspec(f)
         if len(argspec.args) < 2:
             raise TypeError('The endpoint %r must take at least two arguments' % f.route)
@@ -280,6 +312,16 @@ class Router(object):
                     return route.endpoint, args
         raise HTTPNotFound()
 
+    def job_lane(self, data):
+        ''' The lane of the worker pool in which the request is run. The
+        matched route is stored in the request data, for use by :meth:`dispatch` '''
+        try:
+            data.route = self.find_route(data.path)
+        except Exception as err:
+            data.route = err
+            return FAST
+        return HEAVY if data.route[0].heavy else FAST
+
     def read_cookies(self, data):
         data.cookies = c = {}
 
@@ -296,7 +338,12 @@ class Router(object):
                         c[k] = v.strip('"')
 
     def dispatch(self, data):
-        endpoint_, args = self.find_route(data.path)
+        route = getattr(data, 'route', None)
+        if route is None:
+            route = self.find_route(data.path)
+        elif isinstance(route, Exception):
+            raise route
+        endpoint_, args = route
         if data.method not in endpoint_.methods:
             raise HTTPSimpleResponse(http_client.METHOD_NOT_ALLOWED)
 
@@ -313,11 +360,11 @@ class Router(object):
             self.ctx.check_for_write_access(data)
         ans = endpoint_(self.ctx, data, *args)
         self.finalize_session(endpoint_, data, ans)
-        outheaders = data.outheaders
 
         pp = endpoint_.postprocess
         if pp is not None:
             ans = pp(self.ctx, data, endpoint_, ans)
+        outheaders = data.outheaders
 
         cc = endpoint_.cache_control
         if cc is not False and 'Cache-Control' not in data.outheaders:
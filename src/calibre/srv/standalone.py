@@ -76,13 +76,20 @@ class Server(object):
         if opts.use_bonjour:
             plugins.append(BonJour())
         self.loop = ServerLoop(
-            create_http_handler(self.handler.dispatch),
+            create_http_handler(self.handler.dispatch, job_lane_for_request=self.handler.job_lane),
             opts=opts,
             log=log,
             access_log=access_log,
             plugins=plugins)
         self.handler.set_log(self.loop.log)
         self.handler.set_jobs_manager(self.loop.jobs_manager)
+        self.handler.set_server_stats(self.loop.stats)
+        # Only the default library is loaded at startup, the others are loaded
+        # when they are first used
+        try:
+            self.handler.ctx.library_broker.get()
+        except Exception:
+            self.loop.log.exception('Failed to load the default library')
         self.serve_forever = self.loop.serve_forever
         self.stop = self.loop.stop
         if is_running_from_develop:
@@ -239,4 +246,5 @@ def main(args=sys.argv):
     try:
         server.serve_forever()
     finally:
+        server.handler.ctx.shutdown()
         shutdown_delete_service()
@@ -51,6 +51,13 @@ class ContentTest(LibraryBaseTest):
             self.ae(json.loads(zlib.decompress(zdata, 16+zlib.MAX_WBITS)), data)
             r, data = request('s?ids=1,2')
             self.ae(set(data), {'1', '2'})
+            self.ae(data['1'], onedata)
+
+            # Cached metadata must be updated when the book is changed
+            self.assertTrue(server.handler.ctx.library_broker.book_json_caches[db.server_library_id])
+            db.set_field('title', {1:'changed'})
+            self.ae(request('s?ids=1,2')[1]['1']['title'], 'changed')
+            self.ae(request('/1')[1]['title'], 'changed')
 
     # }}}
 
@@ -82,6 +89,25 @@ class ContentTest(LibraryBaseTest):
             self.ae(set(data['book_ids']), {1, 2})
             r, data = request('/search?' + urlencode({'query': 'tags:"=Tag One"', 'vl':'1'}))
             self.ae(set(data['book_ids']), {2})
+
+            # Test paging with cursors and invalidation of the sorted results
+            db.set_field('title', {1:'c', 2:'b', 3:'a'})
+            r, data = request('/search?' + urlencode({'num': 2}))
+            self.ae(data['book_ids'], [3, 2])
+            r, data = request('/search?' + urlencode({'cursor': data['next_cursor']}))
+            self.ae(data['book_ids'], [1]), self.ae(data['offset'], 2)
+            self.assertIsNone(data['next_cursor'])
+            db.set_field('title', {3:'z'})
+            r, data = request('/search?' + urlencode({'num': 2}))
+            self.ae(data['book_ids'], [2, 1])
+            r, data = request('/search?' + urlencode({'cursor': 'xyz'}))
+            self.ae(r.status, NOT_FOUND)
+
+            r, data = request('/server-stats')
+            self.ae(r.status, OK)
+            self.assertGreater(data['connections'], 0)
+            self.assertGreater(data['pool']['lanes']['fast']['completed'], 0)
+            self.assertIn(db.server_library_id, data['libraries'])
     # }}}
 
     def test_srv_restrictions(self):  # {{{
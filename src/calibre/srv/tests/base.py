@@ -141,12 +141,13 @@ class LibraryServer(TestServer):
         self.libraries = libraries or (library_path,)
         self.handler = Handler(self.libraries, opts, testing=True)
         self.loop = ServerLoop(
-            create_http_handler(self.handler.dispatch),
+            create_http_handler(self.handler.dispatch, job_lane_for_request=self.handler.job_lane),
             opts=opts,
             plugins=plugins,
             log=ServerLog(level=ServerLog.WARN),
         )
         self.handler.set_log(self.loop.log)
+        self.handler.set_server_stats(self.loop.stats)
         specialize(self)
 
     def __exit__(self, *args):
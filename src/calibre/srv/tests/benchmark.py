@@ -0,0 +1,92 @@
+#!/usr/bin/env python2
+# vim:fileencoding=utf-8
+# License: GPLv3 Copyright: 2019, Kovid Goyal <kovid at kovidgoyal.net>
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+# Measure the number of requests per second the server can handle for small
+# /ajax/book responses, with and without pipelining. Run it with:
+#   calibre-debug -e src/calibre/srv/tests/benchmark.py [path to library]
+# If no library is specified, a copy of the test library is used.
+
+import os
+import shutil
+import socket
+import sys
+import tempfile
+
+from calibre.utils.monotonic import monotonic
+from polyglot.builtins import range
+
+
+def read_response(sock, buf):
+    # Read a single response from sock, returning the remaining data
+    while b'\r\n\r\n' not in buf:
+        data = sock.recv(65536)
+        if not data:
+            raise EOFError('Server closed the connection')
+        buf += data
+    headers, buf = buf.split(b'\r\n\r\n', 1)
+    status = headers.split(b'\r\n', 1)[0]
+    if b' 200 ' not in status:
+        raise ValueError('Unexpected response: %r' % status)
+    length = 0
+    for line in headers.split(b'\r\n')[1:]:
+        k, v = line.partition(b':')[::2]
+        if k.strip().lower() == b'content-length':
+            length = int(v)
+    while len(buf) < length:
+        data = sock.recv(65536)
+        if not data:
+            raise EOFError('Server closed the connection')
+        buf += data
+    return buf[length:]
+
+
+def requests_per_second(address, path, num_requests=2000, depth=1):
+    ' Send num_requests GET requests for path over a single keep-alive connection, depth requests at a time '
+    request = ('GET %s HTTP/1.1\r\nHost: localhost\r\nAccept-Encoding: identity\r\n\r\n' % path).encode('ascii')
+    sock = socket.create_connection(address)
+    try:
+        buf = b''
+        st = monotonic()
+        sent = 0
+        while sent < num_requests:
+            batch = min(depth, num_requests - sent)
+            sock.sendall(request * batch)
+            for i in range(batch):
+                buf = read_response(sock, buf)
+            sent += batch
+        return num_requests / (monotonic() - st)
+    finally:
+        sock.close()
+
+
+def create_library():
+    d = os.path.dirname
+    src = os.path.join(d(d(d(os.path.abspath(__file__)))), 'db', 'tests', 'metadata.db')
+    library_path = tempfile.mkdtemp(prefix='srv-benchmark-')
+    shutil.copy2(src, os.path.join(library_path, 'metadata.db'))
+    return library_path
+
+
+def main(args=sys.argv):
+    from calibre.srv.tests.base import LibraryServer
+    library_path = os.path.abspath(os.path.expanduser(args[1])) if len(args) > 1 else None
+    tdir = None
+    if library_path is None:
+        library_path = tdir = create_library()
+    try:
+        with LibraryServer(library_path, timeout=10) as server:
+            path = '/ajax/book/1'
+            # Warm up caches
+            requests_per_second(server.address, path, num_requests=50)
+            for depth in (1, 8, 32):
+                print('Pipeline depth: %2d  requests/second: %.0f' % (
+                    depth, requests_per_second(server.address, path, depth=depth)))
+    finally:
+        if tdir is not None:
+            shutil.rmtree(tdir, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()
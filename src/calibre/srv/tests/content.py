@@ -225,3 +225,170 @@ class ContentTest(LibraryBaseTest):
             self.ae(zlib.decompress(raw, 16+zlib.MAX_WBITS), data)
 
     # }}}
+
+    def test_file_copy_locking(self):  # {{{
+        'Test concurrent creation of cached file copies'
+        from functools import partial
+        from threading import Thread, Event
+        from calibre.ptempfile import TemporaryDirectory
+        from calibre.srv.content import create_file_copy, file_locks
+
+        class Ctx(object):
+            testing = True
+
+        class RD(object):
+
+            def __init__(self, tdir):
+                self.tdir, self.outheaders = tdir, {}
+
+            def filesystem_file_with_custom_etag(self, f, *args):
+                with f:
+                    return f.read()
+
+        copies, started, release, results = [], Event(), Event(), {}
+
+        def copy_func(data, wait, f):
+            copies.append(data)
+            if wait:
+                started.set()
+                release.wait(5)
+            f.write(data)
+
+        with TemporaryDirectory() as tdir:
+            def get(key, book_id, wait=False):
+                rd = RD(tdir)
+                data = create_file_copy(Ctx(), rd, 'test', 'locking', book_id, 'txt', 1, partial(copy_func, b'%d' % book_id, wait))
+                results[key] = data, rd.outheaders['Used-Cache']
+
+            t1 = Thread(target=get, args=(1, 1, True))
+            t1.start()
+            self.assertTrue(started.wait(5))
+            t2 = Thread(target=get, args=(2, 1))
+            t2.start()
+            # Copies of other files are not blocked
+            get(3, 2)
+            self.ae(results[3], (b'2', 'no'))
+            release.set()
+            t1.join(5), t2.join(5)
+            # Concurrent requests for the same file wait for a single copy
+            self.ae(results[1], (b'1', 'no'))
+            self.ae(results[2], (b'1', 'yes'))
+            self.ae(copies, [b'1', b'2'])
+            self.ae(file_locks, {})
+    # }}}
+
+    def test_thumbnail_store(self):  # {{{
+        'Test the persistent thumbnail store'
+        from calibre.ptempfile import TemporaryDirectory
+        from calibre.srv.thumbnails import ThumbnailStore, ThumbnailPrewarmer
+        from calibre.utils.date import timestampfromdt
+
+        created = []
+
+        def create(data):
+            created.append(data)
+            return data
+
+        def get(store, book_id, data, size=(60, 80), timestamp=1.5):
+            f, used_cache = store.get('lib', book_id, size, timestamp, lambda: create(data))
+            with f:
+                return f.read(), used_cache
+
+        with TemporaryDirectory() as tdir:
+            store = ThumbnailStore(max_size=1, location=tdir)
+            self.ae(get(store, 1, b'a' * 1000), (b'a' * 1000, False))
+            self.ae(get(store, 1, b'x'), (b'a' * 1000, True))
+            self.ae(get(store, 1, b'b' * 1000, timestamp=2.5), (b'b' * 1000, False))
+            self.ae(get(store, 2, b'c' * 1000, size=(100, 100)), (b'c' * 1000, False))
+            self.ae((len(store), store.current_size), (2, 2000))
+            self.assertTrue(store.has('lib', 1, (60, 80), 2.5))
+            self.assertFalse(store.has('lib', 1, (60, 80), 3))
+            self.ae(store.count('lib', (60, 80)), 1)
+            self.ae(store.get('lib', 3, (60, 80), 1, lambda: b'x' * (store.max_size + 1)), (None, False))
+            store.shutdown()
+
+            # The store survives restarts, keeping the order of use
+            store = ThumbnailStore(max_size=1, location=tdir)
+            self.ae(get(store, 1, b'x', timestamp=2.5), (b'b' * 1000, True))
+            self.ae(get(store, 2, b'x', size=(100, 100)), (b'c' * 1000, True))
+            self.ae(len(created), 3)
+            # The least recently used thumbnails are removed first
+            get(store, 4, b'd' * (store.max_size - 1500))
+            self.assertFalse(store.has('lib', 1, (60, 80), 2.5))
+            self.assertTrue(store.has('lib', 2, (100, 100), 1.5))
+            self.assertLessEqual(store.current_size, store.max_size)
+            store.empty()
+            self.ae((len(store), store.current_size), (0, 0))
+
+        with self.create_server() as server:
+            db = server.handler.router.ctx.library_broker.get(None)
+            store = server.handler.router.ctx.thumbnail_store
+            prewarmer = ThumbnailPrewarmer(store)
+            prewarmer('lib', db, (50, 50))
+            self.assertIsNone(prewarmer.thread, 'pre-warmed a size that was never used')
+            prewarmer.min_count = 0
+            prewarmer('lib', db, (50, 50))
+
+            def prewarmed():
+                for book_id in db.all_book_ids():
+                    mtime = db.cover_last_modified(book_id)
+                    if mtime is not None and not store.has('lib', book_id, (50, 50), timestampfromdt(mtime)):
+                        return False
+                return True
+            for i in range(100):
+                if prewarmed():
+                    break
+                time.sleep(0.1)
+            self.assertTrue(prewarmed())
+            prewarmer.forget('lib')
+            self.assertFalse(prewarmer.scheduled)
+            t = prewarmer.stop()
+            t.join(10)
+            self.assertFalse(t.is_alive())
+    # }}}
+
+    def test_library_eviction(self):  # {{{
+        'Test unloading of libraries by the library broker'
+        from calibre.srv import library_broker as lb
+        paths = [self.library_path]
+        for i in range(2):
+            paths.append(self.mkdtemp())
+            self.create_db(paths[-1])
+        broker = lb.LibraryBroker(paths, max_resident=2)
+        default, a, b = tuple(broker.lmap)
+        self.ae(broker.loaded_dbs, {})
+        db = broker.get()
+        self.assertIs(broker.get(default), db)
+        broker.get(a)
+        self.ae(set(broker.loaded_dbs), {default, a})
+        broker.search_caches[a]['x'] = 1
+        # The least recently used library other than the default is unloaded
+        broker.get(b)
+        self.ae(set(broker.loaded_dbs), {default, b})
+        self.assertNotIn(a, broker.search_caches)
+        # and reloaded transparently when next used
+        self.ae(broker.get(a).all_book_ids(), db.all_book_ids())
+        self.ae(set(broker.loaded_dbs), {default, a})
+        usage = broker.resident_libraries()
+        self.ae(set(usage), {default, a})
+        self.assertGreater(usage[default][0], 0)
+        broker.memory_budget = 1
+        broker.prune()
+        self.ae(set(broker.loaded_dbs), {default})
+        broker.close()
+
+        broker = lb.LibraryBroker(paths, idle_timeout=1000)
+        evicted = []
+        broker.on_evict = evicted.append
+        broker.get(), broker.get(a, lease=True)
+        broker.last_used[a] -= 2000
+        # Leased libraries are never evicted
+        broker.prune()
+        self.ae(set(broker.loaded_dbs), {default, a})
+        broker.release(a)
+        broker.last_used[a] -= 2000
+        broker.prune()
+        self.ae(set(broker.loaded_dbs), {default})
+        self.ae(evicted, [a])
+        broker.close()
+    # }}}
@@ -58,6 +58,17 @@ class TestHTTP(BaseTest):
         parse(b'Connection:a\r\n', b'\r\n')
         parse(b' Connection:a\n')
         parse(b':a\n')
+
+        p = HTTPHeaderParser()
+        p.push_block(b'a: one\r\nb: two\r\n 2\r\n\t3\r\nAccept-Encoding: x\r\naccept-encoding: y\r\n\r\n')
+        self.assertTrue(p.finished)
+        self.assertSetEqual(set(p.hdict.items()), {('A', 'one'), ('B', 'two 2 3'), ('Accept-Encoding', 'x, y')})
+        hdict = p.hdict
+        p.reset()
+        p.push_block(b'\r\n')
+        self.assertTrue(p.finished), self.ae(dict(p.hdict), {}), self.ae(hdict['A'], 'one')
+        for block in (b'Connection\r\n\r\n', b' a:b\r\n\r\n', b':a\r\n\r\n', b'a:b\r\n'):
+            self.assertRaises(ValueError, HTTPHeaderParser().push_block, block)
     # }}}
 
     def test_accept_encoding(self):  # {{{
@@ -283,6 +294,14 @@ class TestHTTP(BaseTest):
                 self.ae(r.read(), ('%d' % i).encode('ascii'))
             conn._HTTPConnection__state = http_client._CS_IDLE
 
+            # Test pipelined requests that arrive in a single packet
+            conn.sock.sendall(b''.join(('GET /p%d HTTP/1.1\r\nHost: x\r\n\r\n' % i).encode('ascii') for i in range(5)) +
+                              b'POST /p HTTP/1.1\r\nContent-Length: 4\r\n\r\nbodyGET /end HTTP/1.1\r\n\r\n')
+            for expected in ['p%d' % i for i in range(5)] + ['pbody', 'end']:
+                r = conn.response_class(conn.sock, strict=conn.strict, method='GET')
+                r.begin()
+                self.ae(r.read(), expected.encode('ascii'))
+
             # Test closing
             server.loop.opts.timeout = 10  # ensure socket is not closed because of timeout
             conn.request('GET', '/close', headers={'Connection':'close'})
@@ -337,6 +356,39 @@ class TestHTTP(BaseTest):
             self.ae(str(len(raw)), r.getheader('Calibre-Uncompressed-Length'))
             self.ae(r.status, http_client.OK), self.ae(zlib.decompress(r.read(), 16+zlib.MAX_WBITS), raw)
 
+            # Test caching of compressed bodies and ranges on them
+            server.change_handler(lambda conn: conn.generate_static_output('compressed', lambda: raw))
+            conn = server.connect()
+            conn.request('GET', '/an_etagged_path', headers={'Accept-Encoding':'gzip'})
+            r = conn.getresponse()
+            zdata = r.read()
+            self.ae(r.status, http_client.OK), self.ae(zlib.decompress(zdata, 16+zlib.MAX_WBITS), raw)
+            self.ae(int(r.getheader('Content-Length')), len(zdata))
+            self.ae(r.getheader('Vary'), 'Accept-Encoding')
+            etag = r.getheader('ETag')
+            self.assertTrue(etag.endswith('-gzip"'))
+            conn.request('GET', '/an_etagged_path', headers={'Accept-Encoding':'gzip', 'If-None-Match':etag})
+            r = conn.getresponse()
+            self.ae(r.status, http_client.NOT_MODIFIED), self.ae(r.read(), b'')
+            conn.request('GET', '/an_etagged_path', headers={'Accept-Encoding':'gzip', 'Range':'bytes=10-19', 'If-Range':etag})
+            r = conn.getresponse()
+            self.ae(r.status, http_client.PARTIAL_CONTENT), self.ae(r.read(), zdata[10:20])
+            self.ae(r.getheader('Content-Encoding'), 'gzip')
+            conn.request('GET', '/an_etagged_path')
+            r = conn.getresponse()
+            self.ae(r.status, http_client.OK), self.ae(r.read(), raw)
+            self.assertIsNone(r.getheader('Content-Encoding'))
+            self.ae(r.getheader('Vary'), 'Accept-Encoding')
+
+            # Test that resources sharing an ETag get their own compressed bodies
+            server.change_handler(lambda conn: conn.etagged_dynamic_response('shared', lambda: ''.join(conn.path) * 1000))
+            conn = server.connect()
+            for path in ('first', 'second'):
+                conn.request('GET', '/' + path, headers={'Accept-Encoding':'gzip'})
+                r = conn.getresponse()
+                self.ae(r.status, http_client.OK)
+                self.ae(zlib.decompress(r.read(), 16+zlib.MAX_WBITS), path.encode('ascii') * 1000)
+
             # Test dynamic etagged content
             num_calls = [0]
 
@@ -356,6 +408,59 @@ class TestHTTP(BaseTest):
             self.ae(r.status, http_client.NOT_MODIFIED)
             self.ae(r.read(), b'')
             self.ae(num_calls[0], 1)
+            conn.request('GET', '/an_etagged_path', headers={'Accept-Encoding':'gzip'})
+            r = conn.getresponse()
+            self.ae(r.status, http_client.OK), self.ae(zlib.decompress(r.read(), 16+zlib.MAX_WBITS), b'data')
+            etag = r.getheader('ETag')
+            self.ae(etag, b'"xxx-gzip"')
+            self.ae(num_calls[0], 2)
+            conn.request('GET', '/an_etagged_path', headers={'Accept-Encoding':'gzip', 'If-None-Match':etag})
+            r = conn.getresponse()
+            self.ae(r.status, http_client.NOT_MODIFIED)
+            self.ae(r.getheader('ETag'), etag)
+            self.ae(r.read(), b'')
+            self.ae(num_calls[0], 2)
+
+            # Test that leased libraries are released only after the body
+            # has been generated
+            events = []
+
+            def leasing_handler(conn, output):
+                conn.leased_libraries.append(lambda: events.append('release'))
+                return output()
+
+            def generated():
+                events.append('generate')
+                yield b'a'
+                events.append('generated')
+                yield b'b'
+            server.change_handler(lambda conn: leasing_handler(conn, generated))
+            conn = server.connect()
+            conn.request('GET', '/leased')
+            r = conn.getresponse()
+            self.ae(r.status, http_client.OK), self.ae(r.read(), b'ab')
+            self.ae(events, ['generate', 'generated', 'release'])
+            del events[:]
+            server.change_handler(lambda conn: leasing_handler(
+                conn, lambda: conn.etagged_dynamic_response('leased', lambda: events.append('generate') or b'data')))
+            conn = server.connect()
+            conn.request('GET', '/leased')
+            r = conn.getresponse()
+            self.ae(r.status, http_client.OK), self.ae(r.read(), b'data')
+            self.ae(events, ['generate', 'release'])
+
+            # Test that HTTP/1.0 clients get generated output in one piece,
+            # without chunked transfer encoding or compression
+            server.change_handler(lambda conn: (x * 100 for x in ('a', b'b')))
+            conn = server.connect()
+            conn.send(b'GET /generated HTTP/1.0\r\nAccept-Encoding: gzip\r\n\r\n')
+            conn._HTTPConnection__state = http_client._CS_REQ_SENT
+            r = conn.getresponse()
+            self.ae(r.status, http_client.OK)
+            self.assertIsNone(r.getheader('Transfer-Encoding'))
+            self.assertIsNone(r.getheader('Content-Encoding'))
+            self.ae(r.getheader('Content-Length'), '200')
+            self.ae(r.read(), b'a' * 100 + b'b' * 100)
 
             # Test getting a filesystem file
             for use_sendfile in (True, False):
@@ -424,6 +529,25 @@ class TestHTTP(BaseTest):
                 time_taken = monotonic() - start_time
                 self.assertLess(time_taken, 1, 'Large file transfer took too long')
 
+            # Test reporting of throughput
+            st = server.loop.stats()
+            self.assertGreaterEqual(st['bytes_sent'], 2 * len(data))
+            self.assertTrue(any(c['bytes_per_second'] > 0 for c in st['throughput']))
+
+        # The time taken by a response that is still being sent is counted
+        from calibre.srv.loop import Connection
+
+        class Sending(object):
+            bytes_sent, send_time = 1000, 0.0
+            response_started, response_started_at = True, monotonic() - 1
+        bytes_per_second = Connection.bytes_per_second.fget
+        c = Sending()
+        self.assertTrue(0 < bytes_per_second(c) <= 1000)
+        c.send_time = 1.0
+        self.assertTrue(0 < bytes_per_second(c) <= 500)
+        c.response_started = False
+        self.ae(bytes_per_second(c), 1000)
+
     # }}}
 
     def test_static_generation(self):  # {{{
@@ -103,6 +103,52 @@ class LoopTest(BaseTest):
             server.join()
             self.ae(1, sum(int(w.is_alive()) for w in pool.workers))
 
+    def test_pool(self):
+        ' Test growing, shrinking and lanes of the worker pool '
+        from calibre.srv.pool import ThreadPool, FAST, HEAVY
+        from polyglot.queue import Full, Queue
+        block, done, started = Event(), Event(), Queue()
+
+        def heavy():
+            started.put(None)
+            block.wait()
+
+        pool = ThreadPool(None, done.set, count=2, queue_size=3, max_count=4, idle_timeout=0.1)
+        pool.start()
+        self.ae(len(pool.workers), 2)
+        # Heavy jobs can use only half the workers, wait till they are all busy
+        for i in range(2):
+            pool.put_nowait(i, heavy, HEAVY)
+        for i in range(2):
+            started.get(timeout=5)
+        for i in range(2, 5):
+            pool.put_nowait(i, heavy, HEAVY)
+        with self.assertRaises(Full):
+            pool.put_nowait(5, heavy, HEAVY)
+        # Fast jobs are not blocked by heavy jobs
+        pool.put_nowait(6, lambda: 'fast', FAST)
+        self.assertTrue(done.wait(5))
+        self.ae(pool.get_nowait(), (6, True, 'fast'))
+        st = pool.stats()
+        self.ae(st['lanes'][HEAVY]['running'], 2)
+        self.ae(st['lanes'][HEAVY]['queued'], 3)
+        self.ae(st['lanes'][HEAVY]['rejected'], 1)
+        self.ae(st['lanes'][FAST]['completed'], 1)
+        self.assertGreater(st['workers'], 2)
+        block.set()
+        for i in range(5):
+            self.ae(pool.result_queue.get(timeout=5)[1], True)
+        st = monotonic()
+        while len(pool.workers) > 2 and monotonic() - st < 5:
+            time.sleep(0.01)
+        self.ae(len(pool.workers), 2)
+        st = monotonic()
+        while pool.stats()['lanes'][HEAVY]['completed'] < 5 and monotonic() - st < 5:
+            time.sleep(0.01)
+        self.ae(pool.stats()['lanes'][HEAVY]['completed'], 5)
+        pool.stop(monotonic() + 1)
+        self.ae(pool.workers, [])
+
     def test_fallback_interface(self):
         'Test falling back to default interface'
         def specialize(server):
@@ -139,6 +185,27 @@ class LoopTest(BaseTest):
             self.ae(r.status, http_client.OK)
             self.ae(r.read(), b'testbody')
 
+    def test_event_loops(self):
+        'Test both the poller and the select() based event loops'
+        def use_select(server):
+            server.loop.use_poller = False
+        for specialize in (use_select, lambda server:None):
+            with TestServer(lambda data:(data.path[0] + data.read()), specialize=specialize, timeout=0.2) as server:
+                if not server.loop.use_poller:
+                    self.assertIsNone(server.loop.poller)
+                conns = [server.connect() for i in range(5)]
+                for i, conn in enumerate(conns):
+                    conn.request('GET', '/test%d' % i, 'body')
+                    r = conn.getresponse()
+                    self.ae(r.status, http_client.OK)
+                    self.ae(r.read(), ('test%dbody' % i).encode('ascii'))
+                self.ae(server.loop.num_active_connections, 5)
+                # Idle connections are closed
+                st = monotonic()
+                while server.loop.num_active_connections and monotonic() - st < 5:
+                    time.sleep(0.05)
+                self.ae(server.loop.num_active_connections, 0)
+
     def test_ring_buffer(self):
         'Test the ring buffer used for reads'
         class FakeSocket(object):
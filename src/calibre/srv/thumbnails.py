@@ -0,0 +1,394 @@
+#!/usr/bin/env python2
+# vim:fileencoding=utf-8
+# License: GPLv3 Copyright: 2019, Kovid Goyal <kovid at kovidgoyal.net>
+
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+import errno
+import os
+import sys
+from binascii import hexlify, unhexlify
+from collections import Counter, OrderedDict, namedtuple
+from contextlib import contextmanager
+from functools import partial
+from io import BytesIO
+from threading import Lock, Thread
+
+from calibre import as_unicode, prints
+from calibre.constants import cache_dir
+from calibre.utils.config_base import tweaks
+from calibre.utils.date import timestampfromdt
+from calibre.utils.filenames import atomic_rename
+from calibre.utils.img import scale_image
+from calibre.utils.shared_file import share_open
+from polyglot.builtins import itervalues
+from polyglot.queue import Queue
+
+Entry = namedtuple('Entry', 'path size timestamp')
+
+
+def render_thumbnail(db, book_id, width, height):
+    buf = BytesIO()
+    db.copy_cover_to(book_id, buf)
+    quality = min(99, max(50, tweaks['content_server_thumbnail_compression_quality']))
+    return scale_image(buf.getvalue(), width=width, height=height, compression_quality=quality)[-1]
+
+
+class ThumbnailStore(object):
+
+    '''
+    A persistent disk cache of the cover thumbnails generated by the server,
+    for all libraries and thumbnail sizes. It survives server restarts and is
+    kept below max_size by removing the least recently used thumbnails. The
+    index is built from the file names when the store is first used, the
+    order of use is saved by :meth:`shutdown`.
+    '''
+
+    def __init__(self,
+                 max_size=200,  # The maximum disk space in MB
+                 location=None,  # The location for this cache, if None cache_dir() is used
+                 name='srv-thumbnails'):  # The name of this cache (should be unique in location)
+        self.location = os.path.join(location or cache_dir(), name)
+        self.max_size = int(max(0, max_size) * (1024**2))
+        self.lock = Lock()
+        # Locks for the thumbnails currently being created, protected by self.lock
+        self.creating = {}
+
+    def log(self, *args, **kwargs):
+        kwargs['file'] = sys.stderr
+        prints(*args, **kwargs)
+
+    def _do_delete(self, path):
+        try:
+            os.remove(path)
+        except EnvironmentError as err:
+            if err.errno != errno.ENOENT:
+                self.log('Failed to delete cached thumbnail file:', as_unicode(err))
+
+    def _path_for(self, library_id, book_id, size, timestamp, length):
+        return os.path.join(
+            self.location, hexlify(library_id.encode('utf-8')).decode('ascii'), '%d' % (book_id % 100),
+            '%d-%r-%d-%dx%d' % (book_id, timestamp, length, size[0], size[1]))
+
+    def _load_index(self):
+        'Load the index from the names of the thumbnail files, pruning to fit max_size'
+        try:
+            os.makedirs(self.location)
+        except OSError as err:
+            if err.errno != errno.EEXIST:
+                self.log('Failed to make thumbnail cache dir:', as_unicode(err))
+        self.total_size = 0
+        self.items = OrderedDict()
+        self.counts = Counter()
+        order = self._read_order()
+
+        def listdir(*args):
+            try:
+                return os.listdir(os.path.join(*args))
+            except EnvironmentError:
+                return ()  # not a directory or no permission or whatever
+        entries = ('/'.join((parent, subdir, entry))
+                   for parent in listdir(self.location)
+                   for subdir in listdir(self.location, parent)
+                   for entry in listdir(self.location, parent, subdir))
+        items = []
+        for entry in entries:
+            path = os.path.join(self.location, entry)
+            try:
+                library_id, name = entry.split('/')[0::2]
+                library_id = unhexlify(library_id).decode('utf-8')
+                book_id, timestamp, size, thumbnail_size = name.split('-')
+                book_id, timestamp, size = int(book_id), float(timestamp), int(size)
+                thumbnail_size = tuple(map(int, thumbnail_size.partition('x')[0::2]))
+            except (ValueError, TypeError, IndexError, KeyError, AttributeError):
+                # Left over from a failed write
+                self._do_delete(path)
+                continue
+            key = (library_id, book_id, thumbnail_size)
+            items.append((key, Entry(path, size, timestamp)))
+        items.sort(key=lambda x:order.get(x[0], 0))
+        for key, entry in items:
+            old = self.items.pop(key, None)
+            if old is not None:
+                # Only the latest version of a thumbnail is kept
+                if old.timestamp > entry.timestamp:
+                    old, entry = entry, old
+                self._do_delete(old.path)
+                self.total_size -= old.size
+                self.counts[key[0::2]] -= 1
+            self._add(key, entry)
+        self._apply_size()
+
+    def _ensure_index(self):
+        if not hasattr(self, 'total_size'):
+            self._load_index()
+
+    def _add(self, key, entry):
+        self.items[key] = entry
+        self.total_size += entry.size
+        self.counts[key[0::2]] += 1
+
+    def _remove(self, key):
+        entry = self.items.pop(key, None)
+        if entry is not None:
+            self._do_delete(entry.path)
+            self.total_size -= entry.size
+            self.counts[key[0::2]] -= 1
+
+    def _apply_size(self):
+        while self.total_size > self.max_size and self.items:
+            self._remove(next(iter(self.items)))
+
+    def _order_key(self, key):
+        return '%s %d %dx%d' % (hexlify(key[0].encode('utf-8')).decode('ascii'), key[1], key[2][0], key[2][1])
+
+    def _write_order(self):
+        if hasattr(self, 'items'):
+            try:
+                data = '\n'.join(map(self._order_key, self.items))
+                with lopen(os.path.join(self.location, 'order'), 'wb') as f:
+                    f.write(data.encode('utf-8'))
+            except EnvironmentError as err:
+                self.log('Failed to save thumbnail cache order:', as_unicode(err))
+
+    def _read_order(self):
+        order = {}
+        try:
+            with lopen(os.path.join(self.location, 'order'), 'rb') as f:
+                for line in f.read().decode('utf-8').splitlines():
+                    parts = line.split(' ')
+                    if len(parts) == 3:
+                        size = tuple(map(int, parts[2].partition('x')[0::2]))
+                        order[(unhexlify(parts[0]).decode('utf-8'), int(parts[1]), size)] = len(order)
+        except Exception as err:
+            if getattr(err, 'errno', None) != errno.ENOENT:
+                self.log('Failed to load thumbnail cache order:', as_unicode(err))
+        return order
+
+    def shutdown(self):
+        with self.lock:
+            self._write_order()
+
+    @contextmanager
+    def _lock_for(self, key):
+        with self.lock:
+            entry = self.creating.get(key)
+            if entry is None:
+                entry = self.creating[key] = [Lock(), 0]
+            entry[1] += 1
+        try:
+            with entry[0]:
+                yield
+        finally:
+            with self.lock:
+                entry[1] -= 1
+                if not entry[1]:
+                    del self.creating[key]
+
+    def _open(self, key, timestamp):
+        entry = self.items.pop(key, None)
+        if entry is None:
+            return
+        if entry.timestamp < timestamp:
+            # The cover has changed since this thumbnail was created
+            self._do_delete(entry.path)
+            self.total_size -= entry.size
+            self.counts[key[0::2]] -= 1
+            return
+        try:
+            ans = share_open(entry.path, 'rb')
+        except EnvironmentError as err:
+            if err.errno != errno.ENOENT:
+                self.log('Failed to read cached thumbnail:', entry.path, as_unicode(err))
+            self.total_size -= entry.size
+            self.counts[key[0::2]] -= 1
+            return
+        self.items[key] = entry
+        return ans
+
+    def _insert(self, key, timestamp, data):
+        library_id, book_id, size = key
+        path = self._path_for(library_id, book_id, size, timestamp, len(data))
+        try:
+            os.makedirs(os.path.dirname(path))
+        except EnvironmentError as err:
+            if err.errno != errno.EEXIST:
+                self.log('Failed to make thumbnail cache dir:', as_unicode(err))
+                return
+        try:
+            # Write to a temporary file first, so that a partially written
+            # thumbnail is never used
+            with open(path + '.tmp', 'wb') as f:
+                f.write(data)
+            atomic_rename(path + '.tmp', path)
+            ans = share_open(path, 'rb')
+        except EnvironmentError as err:
+            self.log('Failed to write cached thumbnail:', path, as_unicode(err))
+            return
+        with self.lock:
+            self._remove(key)
+            self._add(key, Entry(path, len(data), timestamp))
+            self._apply_size()
+        return ans
+
+    def get(self, library_id, book_id, size, timestamp, create):
+        '''
+        Return an open file containing the thumbnail of size (width, height)
+        for the specified book and a flag indicating if the cached thumbnail
+        was used. If there is no cached thumbnail that is at least as new as
+        timestamp, it is created by calling create(), which must return the
+        thumbnail data. Concurrent calls for the same thumbnail wait for a
+        single call to create(). Returns None for the file if the thumbnail
+        could not be stored, for example, because it is larger than max_size.
+        '''
+        key = (library_id, book_id, tuple(size))
+        with self._lock_for(key):
+            with self.lock:
+                self._ensure_index()
+                ans = self._open(key, timestamp)
+            if ans is not None:
+                return ans, True
+            data = create()
+            if len(data) > self.max_size:
+                return None, False
+            return self._insert(key, timestamp, data), False
+
+    def has(self, library_id, book_id, size, timestamp):
+        ' Return True iff an up-to-date thumbnail is cached. Does not change the order of use. '
+        with self.lock:
+            self._ensure_index()
+            entry = self.items.get((library_id, book_id, tuple(size)))
+            return entry is not None and entry.timestamp >= timestamp
+
+    def count(self, library_id, size):
+        ' The number of thumbnails of the specified size cached for the specified library '
+        with self.lock:
+            self._ensure_index()
+            return self.counts[(library_id, tuple(size))]
+
+    @property
+    def is_full(self):
+        with self.lock:
+            self._ensure_index()
+            return self.total_size >= self.max_size
+
+    @property
+    def current_size(self):
+        with self.lock:
+            self._ensure_index()
+            return self.total_size
+
+    def __len__(self):
+        with self.lock:
+            self._ensure_index()
+            return len(self.items)
+
+    def invalidate(self, library_id):
+        ' Remove all thumbnails for the specified library '
+        with self.lock:
+            self._ensure_index()
+            for key in tuple(self.items):
+                if key[0] == library_id:
+                    self._remove(key)
+
+    def empty(self):
+        with self.lock:
+            try:
+                os.remove(os.path.join(self.location, 'order'))
+            except EnvironmentError:
+                pass
+            self._ensure_index()
+            for entry in itervalues(self.items):
+                self._do_delete(entry.path)
+            self.total_size = 0
+            self.items = OrderedDict()
+            self.counts = Counter()
+
+
+class ThumbnailPrewarmer(object):
+
+    '''
+    Renders thumbnails for all the books in a library in a background
+    thread, so that they are already in the store when browsing. A library is
+    pre-warmed for a thumbnail size once at least min_count thumbnails of that
+    size have been requested, that is, for the sizes used by the web UI on the
+    devices actually connecting to the server. Pre-warming never evicts
+    thumbnails from the store, it stops once the store is full.
+    '''
+
+    min_count = 10
+
+    def __init__(self, store):
+        self.store = store
+        self.lock = Lock()
+        # Map of (library_id, size) to the token identifying the job for it
+        self.scheduled = {}
+        self.queue = self.thread = None
+
+    def log(self, *args, **kwargs):
+        kwargs['file'] = sys.stderr
+        prints(*args, **kwargs)
+
+    def __call__(self, library_id, db, size):
+        ' Called whenever a thumbnail of the specified size is requested from the specified library '
+        key = library_id, tuple(size)
+        with self.lock:
+            if key in self.scheduled or not self.store.max_size:
+                return
+            if self.store.count(library_id, size) < self.min_count:
+                return
+            self.scheduled[key] = token = object()
+            if self.thread is None:
+                self.queue = Queue()
+                self.thread = t = Thread(name='ThumbnailPrewarmer', target=self.run, args=(self.queue,))
+                t.daemon = True
+                t.start()
+            self.queue.put((library_id, db, key[1], token))
+
+    def is_current(self, library_id, size, token):
+        return self.scheduled.get((library_id, size)) is token
+
+    def run(self, queue):
+        while True:
+            job = queue.get()
+            if job is None:
+                break
+            if not self.is_current(job[0], job[2], job[3]):
+                continue
+            try:
+                self.prewarm(queue, *job)
+            except Exception as err:
+                # Errors caused by the library being closed are expected
+                if self.is_current(job[0], job[2], job[3]):
+                    self.log('Failed to pre-warm thumbnails for library:', job[0], as_unicode(err))
+
+    def prewarm(self, queue, library_id, db, size, token):
+        # Newest books first, as that is how the web UI sorts by default
+        for book_id in db.multisort([('timestamp', False)]):
+            if queue is not self.queue or self.store.is_full or not self.is_current(library_id, size, token):
+                break
+            mtime = db.cover_last_modified(book_id)
+            if mtime is None:
+                continue
+            timestamp = timestampfromdt(mtime)
+            if not self.store.has(library_id, book_id, size, timestamp):
+                f = self.store.get(library_id, book_id, size, timestamp, partial(render_thumbnail, db, book_id, size[0], size[1]))[0]
+                if f is not None:
+                    f.close()
+
+    def forget(self, library_id):
+        ' Stop pre-warming the specified library, for example, because it is being closed '
+        with self.lock:
+            for key in tuple(self.scheduled):
+                if key[0] == library_id:
+                    del self.scheduled[key]
+
+    def stop(self):
+        ' Stop pre-warming, returns the pre-warming thread, if any '
+        with self.lock:
+            self.scheduled.clear()
+            t, q = self.thread, self.queue
+            self.thread = self.queue = None
+        if q is not None:
+            q.put(None)
+        return t
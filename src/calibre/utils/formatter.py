@@ -9,6 +9,8 @@ __copyright__ = '2010, Kovid Goyal <kovid@kovidgoyal.net>'
 __docformat__ = 'restructuredtext en'
 
 import re, string, traceback, numbers
+from collections import OrderedDict
+from threading import Lock
 
 from calibre import prints
 from calibre.constants import DEBUG
@@ -16,7 +18,96 @@ from calibre.utils.formatter_functions import formatter_functions
 from polyglot.builtins import unicode_type
 
 
+class Node(object):
+
+    ''' A node in the tree produced by compiling a template program. Programs
+    are compiled once and the tree is evaluated for every book. '''
+
+    __slots__ = ()
+
+    def evaluate(self, formatter, locals):
+        raise NotImplementedError()
+
+
+class ConstantNode(Node):
+
+    __slots__ = ('value',)
+
+    def __init__(self, value):
+        self.value = value
+
+    def evaluate(self, formatter, locals):
+        return self.value
+
+
+class VariableNode(Node):
+
+    __slots__ = ('name', 'near')
+
+    def __init__(self, name, near):
+        self.name, self.near = name, near
+
+    def evaluate(self, formatter, locals):
+        val = locals.get(self.name, None)
+        if val is None:
+            _error(_('Unknown identifier ') + self.name, self.near)
+        return val
+
+
+class AssignNode(Node):
+
+    __slots__ = ('name', 'expr')
+
+    def __init__(self, name, expr):
+        self.name, self.expr = name, expr
+
+    def evaluate(self, formatter, locals):
+        return formatter.funcs['assign'].eval_(
+            formatter, formatter.kwargs, formatter.book, locals, self.name, self.expr.evaluate(formatter, locals))
+
+
+class FunctionNode(Node):
+
+    __slots__ = ('name', 'args', 'near', 'end_near')
+
+    def __init__(self, name, args, near, end_near):
+        self.name, self.args, self.near, self.end_near = name, args, near, end_near
+
+    def evaluate(self, formatter, locals):
+        # The set of functions can change between evaluations, for example,
+        # when user defined template functions are changed, so we look them up
+        # here rather than when compiling
+        cls = formatter.funcs.get(self.name)
+        if cls is None:
+            _error(_('unknown function {0}').format(self.name), self.near)
+        args = [arg.evaluate(formatter, locals) for arg in self.args]
+        if cls.arg_count != -1 and len(args) != cls.arg_count:
+            _error('incorrect number of arguments for function {}'.format(self.name), self.end_near)
+        return cls.eval_(formatter, formatter.kwargs, formatter.book, locals, *args)
+
+
+class StatementsNode(Node):
+
+    __slots__ = ('exprs',)
+
+    def __init__(self, exprs):
+        self.exprs = exprs
+
+    def evaluate(self, formatter, locals):
+        val = None
+        for expr in self.exprs:
+            val = expr.evaluate(formatter, locals)
+        return val
+
+
+def _error(message, near):
+    raise ValueError('Formatter: ' + message + _(' near ') + ' ' + near)
+
+
 class _Parser(object):
+
+    ''' Compiles the lexed tokens of a template program into a tree of nodes '''
+
     LEX_OP  = 1
     LEX_ID  = 2
     LEX_STR = 3
@@ -25,27 +116,22 @@ class _Parser(object):
 
     LEX_CONSTANTS = frozenset([LEX_STR, LEX_NUM])
 
-    def __init__(self, val, prog, funcs, parent):
+    def __init__(self, prog):
         self.lex_pos = 0
         self.prog = prog[0]
         self.prog_len = len(self.prog)
         if prog[1] != '':
             self.error(_('failed to scan program. Invalid input {0}').format(prog[1]))
-        self.parent = parent
-        self.parent_kwargs = parent.kwargs
-        self.parent_book = parent.book
-        self.locals = {'$':val}
-        self.funcs = funcs
 
-    def error(self, message):
-        m = 'Formatter: ' + message + _(' near ')
+    def near(self):
         if self.lex_pos > 0:
-            m = '{0} {1}'.format(m, self.prog[self.lex_pos-1][1])
-        elif self.lex_pos < self.prog_len:
-            m = '{0} {1}'.format(m, self.prog[self.lex_pos+1][1])
-        else:
-            m = '{0} {1}'.format(m, _('end of program'))
-        raise ValueError(m)
+            return self.prog[self.lex_pos-1][1]
+        if self.lex_pos < self.prog_len:
+            return self.prog[self.lex_pos+1][1]
+        return _('end of program')
+
+    def error(self, message):
+        _error(message, self.near())
 
     def token(self):
         if self.lex_pos >= self.prog_len:
@@ -110,15 +196,15 @@ class _Parser(object):
         return val
 
     def statement(self):
+        exprs = []
         while True:
-            val = self.expr()
-            if self.token_is_eof():
-                return val
-            if not self.token_op_is_a_semicolon():
-                return val
+            exprs.append(self.expr())
+            if self.token_is_eof() or not self.token_op_is_a_semicolon():
+                break
             self.consume()
             if self.token_is_eof():
-                return val
+                break
+        return exprs[0] if len(exprs) == 1 else StatementsNode(exprs)
 
     def expr(self):
         if self.token_is_id():
@@ -128,19 +214,11 @@ class _Parser(object):
                 if self.token_op_is_a_equals():
                     # classic assignment statement
                     self.consume()
-                    cls = self.funcs['assign']
-                    return cls.eval_(self.parent, self.parent_kwargs,
-                                    self.parent_book, self.locals, id, self.expr())
-                val = self.locals.get(id, None)
-                if val is None:
-                    self.error(_('Unknown identifier ') + id)
-                return val
+                    return AssignNode(id, self.expr())
+                return VariableNode(id, self.near())
             # We have a function.
-            # Check if it is a known one. We do this here so error reporting is
-            # better, as it can identify the tokens near the problem.
             id = id.strip()
-            if id not in self.funcs:
-                self.error(_('unknown function {0}').format(id))
+            near = self.near()
 
             # Eat the paren
             self.consume()
@@ -152,29 +230,59 @@ class _Parser(object):
                     # the value.
                     if not self.token_is_id():
                         self.error('assign requires the first parameter be an id')
-                    args.append(self.token())
+                    args.append(ConstantNode(self.token()))
                 else:
-                    # evaluate the argument (recursive call)
+                    # compile the argument (recursive call)
                     args.append(self.statement())
                 if not self.token_op_is_a_comma():
                     break
                 self.consume()
             if self.token() != ')':
                 self.error(_('missing closing parenthesis'))
-
-            # Evaluate the function
-            cls = self.funcs[id]
-            if cls.arg_count != -1 and len(args) != cls.arg_count:
-                self.error('incorrect number of arguments for function {}'.format(id))
-            return cls.eval_(self.parent, self.parent_kwargs,
-                            self.parent_book, self.locals, *args)
+            return FunctionNode(id, tuple(args), near, self.near())
         elif self.token_is_constant():
             # String or number
-            return self.token()
+            return ConstantNode(self.token())
         else:
             self.error(_('expression is not function or constant'))
 
 
+class CompiledCache(object):
+
+    ''' A thread safe, size bounded, least recently used cache for compiled
+    templates, keyed by the template text. '''
+
+    def __init__(self, limit=500):
+        self.limit = limit
+        self.items = OrderedDict()
+        self.lock = Lock()
+
+    def get(self, key, compile_func):
+        with self.lock:
+            try:
+                ans = self.items.pop(key)
+            except KeyError:
+                pass
+            else:
+                self.items[key] = ans
+                return ans
+        ans = compile_func(key)
+        with self.lock:
+            self.items[key] = ans
+            while len(self.items) > self.limit:
+                self.items.popitem(last=False)
+        return ans
+
+    def clear(self):
+        with self.lock:
+            self.items.clear()
+
+
+program_cache = CompiledCache()
+format_string_cache = CompiledCache()
+_parse_format_string = string.Formatter().parse
+
+
 class TemplateFormatter(string.Formatter):
     '''
     Provides a format function that substitutes '' for any missing value
@@ -250,22 +358,28 @@ class TemplateFormatter(string.Formatter):
                 (r'\s',                 None)
         ], flags=re.DOTALL)
 
+    def compile_program(self, prog):
+        return _Parser(self.lex_scanner.scan(prog)).program()
+
     def _eval_program(self, val, prog, column_name):
-        # keep a cache of the lex'ed program under the theory that re-lexing
-        # is much more expensive than the cache lookup. This is certainly true
-        # for more than a few tokens, but it isn't clear for simple programs.
+        # Compiled programs are cached by their text, so that they are shared
+        # between columns, books and formatter instances. The per column
+        # template_cache avoids the locking in the shared cache.
         if column_name is not None and self.template_cache is not None:
-            lprog = self.template_cache.get(column_name, None)
-            if not lprog:
-                lprog = self.lex_scanner.scan(prog)
-                self.template_cache[column_name] = lprog
+            cached = self.template_cache.get(column_name, None)
+            if cached is None or cached[0] != prog:
+                cached = self.template_cache[column_name] = (prog, program_cache.get(prog, self.compile_program))
+            compiled = cached[1]
         else:
-            lprog = self.lex_scanner.scan(prog)
-        parser = _Parser(val, lprog, self.funcs, self)
-        return parser.program()
+            compiled = program_cache.get(prog, self.compile_program)
+        return compiled.evaluate(self, {'$':val})
 
     # ################# Override parent classes methods #####################
 
+    def parse(self, format_string):
+        # Avoid re-parsing the same format strings for every book
+        return format_string_cache.get(format_string, lambda x: tuple(_parse_format_string(x)))
+
     def get_value(self, key, args, kwargs):
         raise Exception('get_value must be implemented in the subclass')
 
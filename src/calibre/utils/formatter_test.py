@@ -0,0 +1,162 @@
+#!/usr/bin/env python2
+# vim:fileencoding=utf-8
+# License: GPLv3 Copyright: 2019, Kovid Goyal <kovid at kovidgoyal.net>
+
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+import unittest
+
+from calibre.utils.formatter import EvalFormatter, _Parser
+from calibre.utils.formatter_functions import load_user_template_functions, unload_user_template_functions
+
+
+class InterpretingParser(_Parser):
+
+    ''' Evaluates template programs while parsing them, the way programs were
+    run before they were compiled. Used to check that compiled programs give
+    the same results. '''
+
+    def __init__(self, val, prog, funcs, parent):
+        _Parser.__init__(self, prog)
+        self.parent = parent
+        self.locals = {'$':val}
+        self.funcs = funcs
+
+    def statement(self):
+        while True:
+            val = self.expr()
+            if self.token_is_eof() or not self.token_op_is_a_semicolon():
+                return val
+            self.consume()
+            if self.token_is_eof():
+                return val
+
+    def expr(self):
+        parent = self.parent
+        if self.token_is_id():
+            id = self.token()
+            if not self.token_op_is_a_lparen():
+                if self.token_op_is_a_equals():
+                    self.consume()
+                    return self.funcs['assign'].eval_(parent, parent.kwargs, parent.book, self.locals, id, self.expr())
+                val = self.locals.get(id, None)
+                if val is None:
+                    self.error(_('Unknown identifier ') + id)
+                return val
+            id = id.strip()
+            if id not in self.funcs:
+                self.error(_('unknown function {0}').format(id))
+            self.consume()
+            args = []
+            while not self.token_op_is_a_rparen():
+                if id == 'assign' and not args:
+                    if not self.token_is_id():
+                        self.error('assign requires the first parameter be an id')
+                    args.append(self.token())
+                else:
+                    args.append(self.statement())
+                if not self.token_op_is_a_comma():
+                    break
+                self.consume()
+            if self.token() != ')':
+                self.error(_('missing closing parenthesis'))
+            cls = self.funcs[id]
+            if cls.arg_count != -1 and len(args) != cls.arg_count:
+                self.error('incorrect number of arguments for function {}'.format(id))
+            return cls.eval_(parent, parent.kwargs, parent.book, self.locals, *args)
+        elif self.token_is_constant():
+            return self.token()
+        else:
+            self.error(_('expression is not function or constant'))
+
+
+class InterpretingFormatter(EvalFormatter):
+
+    def _eval_program(self, val, prog, column_name):
+        return InterpretingParser(val, self.lex_scanner.scan(prog), self.funcs, self).program()
+
+
+class TestFormatter(unittest.TestCase):
+
+    kwargs = {'title': 'The Title', 'series': 'A Series', 'num': '3', 'tags': 'one, two, three', 'empty': ''}
+
+    def test_compiled_and_interpreted(self):
+        compiled, interpreted = EvalFormatter(), InterpretingFormatter()
+        for template in (
+            "program: 'constant'",
+            'program: 3.5',
+            "program: x = 'abc'; uppercase(x)",
+            "program: assign(x, strcat('a', 'b')); strcat(x, x)",
+            "program: a = b = 'chained'; strcat(a, b)",
+            "program: x = 'one'; x = strcat(x, 'two'); x;",
+            "program: strcat(uppercase(field('title')), '-', test(field('empty'), 'yes', 'no'))",
+            "program: strcat(lowercase(uppercase(strcat('A', 'b'))), 'c')",
+            'program: add(1, multiply(2, subtract(field("num"), 1)))',
+            "program: list_item(field('tags'), 1, ',')",
+            "program:\n# A comment\nfirst_non_empty(field('empty'), field('series'))",
+            "program: strcat(x = 'inner', x)",
+            '{title:uppercase()}',
+            '{series:test(yes,no)}',
+            '{empty:test(yes,no)}',
+            '{title:shorten(2,-,3)}',
+            '{num:0>3s}',
+            "{title:'lowercase($)'}",
+            "{title:'strcat($, x = \"y\"; x)'}",
+            '{series:|[|]}{empty:|[|]}',
+            '{title} - {series}',
+        ):
+            for i in range(2):
+                # The second run uses the cached compiled program
+                self.assertEqual(compiled.unsafe_format(template, self.kwargs, None),
+                                 interpreted.unsafe_format(template, self.kwargs, None), template)
+
+    def test_errors(self):
+        compiled, interpreted = EvalFormatter(), InterpretingFormatter()
+        for template, message in (
+            ('program: nofunc(1)', 'unknown function nofunc'),
+            ("program: strcat('a', nofunc(1))", 'unknown function nofunc'),
+            ("program: uppercase('a', 'b')", 'incorrect number of arguments for function uppercase'),
+            ("program: strcat('a', x)", 'Unknown identifier x'),
+            ("program: uppercase('a'", 'missing closing parenthesis'),
+            ("program: strcat('a', 'b'", 'missing closing parenthesis'),
+            ("program: 'a' 'b'", 'syntax error'),
+        ):
+            with self.assertRaises(ValueError) as cm:
+                compiled.unsafe_format(template, self.kwargs, None)
+            error = cm.exception.args[0]
+            self.assertIn(message, error, template)
+            with self.assertRaises(ValueError) as cm:
+                interpreted.unsafe_format(template, self.kwargs, None)
+            self.assertEqual(error, cm.exception.args[0], template)
+
+    def test_template_changes(self):
+        f = EvalFormatter()
+        template_cache = {}
+
+        def column(template):
+            return f.safe_format(template, self.kwargs, 'ERROR', None, column_name='#col', template_cache=template_cache)
+
+        self.assertEqual(column("program: 'one'"), 'one')
+        self.assertEqual(column("program: 'one'"), 'one')
+        # Changing the template of a column must not use its old program
+        self.assertEqual(column("program: 'two'"), 'two')
+        self.assertEqual(column("program: field('title')"), 'The Title')
+
+        def user_function(val):
+            return ['myfunc', '', 0, "def evaluate(self, formatter, kwargs, mi, locals):\n\treturn '%s'" % val]
+
+        template = 'program: myfunc()'
+        try:
+            load_user_template_functions('formatter-test', [user_function('first')])
+            self.assertEqual(column(template), 'first')
+            load_user_template_functions('formatter-test', [user_function('second')])
+            self.assertEqual(column(template), 'second')
+            unload_user_template_functions('formatter-test')
+            self.assertTrue(column(template).startswith('ERROR'))
+            self.assertIn('unknown function myfunc', column(template))
+        finally:
+            unload_user_template_functions('formatter-test')
+
+
+def find_tests():
+    return unittest.defaultTestLoader.loadTestsFromTestCase(TestFormatter)
@@ -35,6 +35,9 @@ class BaseJob(object):
         self.start_time    = None
         self.result        = None
         self.duration      = None
+        # Time spent waiting for a worker process, None if the job does not
+        # use worker processes
+        self.worker_startup_time = None
         self.log_path      = None
         self.notifications = Queue()
 
@@ -61,6 +64,8 @@ class BaseJob(object):
                 try:
                     prints('Job:', self.id, self.description, 'finished',
                         safe_encode=True)
+                    if self.worker_startup_time is not None:
+                        prints('\tWorker startup took: %.2f seconds' % self.worker_startup_time)
                     prints('\t'.join(self.details.splitlines(True)),
                         safe_encode=True)
                 except:
@@ -15,6 +15,7 @@ from calibre.constants import iswindows, DEBUG
 from calibre.ptempfile import PersistentTemporaryFile
 from calibre.utils import join_with_timeout
 from calibre.utils.ipc import eintr_retry_call
+from calibre.utils.monotonic import monotonic
 from calibre.utils.serialize import msgpack_dumps, msgpack_loads, pickle_dumps, pickle_loads
 from polyglot.builtins import iteritems, itervalues
 from polyglot.queue import Queue
@@ -95,6 +96,9 @@ class Worker(object):
         self.process, self.conn = p, conn
         self.events = events
         self.name = name or ''
+        self.jobs_done = 0
+        # Time taken to start the worker process, in seconds
+        self.startup_time = None
 
     def __call__(self, job):
         eintr_retry_call(self.conn.send_bytes, pickle_dumps(job))
@@ -122,9 +126,14 @@ class Pool(Thread):
 
     daemon = True
 
-    def __init__(self, max_workers=None, name=None):
+    def __init__(self, max_workers=None, name=None, max_jobs_per_worker=0):
+        ''' Worker processes are re-used for multiple jobs. If
+        max_jobs_per_worker is non-zero, a worker is replaced by a new
+        process after it has run that many jobs, to limit the effects of
+        memory leaks and the like in long running pools. '''
         Thread.__init__(self, name=name)
         self.max_workers = max_workers or detect_ncpus()
+        self.max_jobs_per_worker = max_jobs_per_worker
         self.available_workers = []
         self.busy_workers = {}
         self.pending_jobs = []
@@ -188,6 +197,7 @@ class Pool(Thread):
         self.shutdown_workers(wait_time=wait_time)
 
     def create_worker(self):
+        st = monotonic()
         p = start_worker('from {0} import run_main, {1}; run_main({1})'.format(self.__class__.__module__, 'worker_main'))
         sys.stdout.flush()
         eintr_retry_call(p.stdin.write, self.worker_data)
@@ -196,6 +206,9 @@ class Pool(Thread):
         w = Worker(p, conn, self.events, self.name)
         if self.common_data != pickle_dumps(None):
             w.set_common_data(self.common_data)
+        w.startup_time = monotonic() - st
+        if DEBUG:
+            prints('Pool worker startup took: %.2f seconds' % w.startup_time)
         return w
 
     def start_worker(self):
@@ -236,8 +249,13 @@ class Pool(Thread):
             return self.run_job(job)
         elif isinstance(event, WorkerResult):
             worker_result = event
-            self.busy_workers.pop(worker_result.worker, None)
-            self.available_workers.append(worker_result.worker)
+            worker = worker_result.worker
+            self.busy_workers.pop(worker, None)
+            worker.jobs_done += 1
+            if self.max_jobs_per_worker and worker.jobs_done >= self.max_jobs_per_worker and not worker_result.is_terminal_failure:
+                self.retire_worker(worker)
+            else:
+                self.available_workers.append(worker)
             self.tracker.task_done()
             if worker_result.is_terminal_failure:
                 self.terminal_failure = TerminalFailure('Worker process crashed while executing job', worker_result.result.traceback, worker_result.id)
@@ -260,7 +278,10 @@ class Pool(Thread):
                     self.terminal_error()
                     return False
 
-        while self.pending_jobs and self.available_workers:
+        while self.pending_jobs and (self.available_workers or len(self.busy_workers) < self.max_workers):
+            # Workers that have been retired need to be replaced
+            if not self.available_workers and self.start_worker() is False:
+                return False
             if self.run_job(self.pending_jobs.pop()) is False:
                 return False
 
@@ -275,6 +296,19 @@ class Pool(Thread):
             return False
         self.busy_workers[worker] = job
 
+    def retire_worker(self, worker):
+        try:
+            worker(None)
+        except Exception:
+            pass
+        try:
+            worker.conn.close()
+        except Exception:
+            pass
+        t = Thread(target=worker.process.wait, name='ReapPoolWorker')
+        t.daemon = True
+        t.start()
+
     @property
     def failed(self):
         return self.terminal_failure is not None
@@ -440,6 +474,16 @@ def test():
         raise SystemExit('%r != %r' % (expected_results, results))
     p.shutdown(), p.join()
 
+    # Test recycling of workers
+    p = Pool(name='Test', max_workers=2, max_jobs_per_worker=10)
+    for i in range(100):
+        p(i, 'import os\ndef x(i):\n return os.getpid()', 'x', i)
+    p.wait_for_tasks(30)
+    pids = {v.value for v in itervalues(get_results(p))}
+    if len(pids) < 10:
+        raise SystemExit('Workers were not recycled, only %d workers were used' % len(pids))
+    p.shutdown(), p.join()
+
     # Test large common data
     p = Pool(name='Test')
     data = b'a' * (4 * MAX_SIZE)
@@ -32,6 +32,13 @@ from polyglot.queue import Empty, Queue
 
 _counter = 0
 
+# Modules imported by prewarmed workers while they wait for a job. Modules
+# that load plugins or preferences, such as calibre.customize.ui, must not be
+# preloaded, as these can change between the time the spare worker is started
+# and the time it is used.
+PRELOAD_MODULES = ('lxml.etree', 'css_parser', 'calibre.ebooks.oeb.base',
+                   'calibre.ebooks.oeb.stylizer')
+
 
 class ConnectedWorker(Thread):
 
@@ -184,8 +191,19 @@ else:
 
 class Server(Thread):
 
+    # The time to wait for a spare worker that is still starting, before
+    # launching a new worker instead
+    SPARE_WORKER_TIMEOUT = 1  # seconds
+
     def __init__(self, notify_on_job_done=lambda x: x, pool_size=None,
-            limit=sys.maxsize, enforce_cpu_limit=True):
+            limit=sys.maxsize, enforce_cpu_limit=True, prewarm=False,
+            preload_modules=PRELOAD_MODULES):
+        '''
+        If prewarm is True, a spare worker process is always kept running,
+        with preload_modules already imported, and is used for the next job.
+        This reduces the time taken to start jobs at the cost of an extra
+        idle process.
+        '''
         Thread.__init__(self)
         self.daemon = True
         global _counter
@@ -204,10 +222,12 @@ class Server(Thread):
         self.workers = deque()
         self.launched_worker_count = 0
         self._worker_launch_lock = RLock()
+        self.prewarm, self.preload_modules = prewarm, preload_modules
+        self.spare_workers = Queue()
 
         self.start()
 
-    def launch_worker(self, gui=False, redirect_output=None, job_name=None):
+    def launch_worker(self, gui=False, redirect_output=None, job_name=None, preload=False):
         start = time.time()
         with self._worker_launch_lock:
             self.launched_worker_count += 1
@@ -224,6 +244,8 @@ class Server(Thread):
                 'CALIBRE_WORKER_KEY' : environ_item(hexlify(self.auth_key)),
                 'CALIBRE_WORKER_RESULT' : environ_item(hexlify(rfile.encode('utf-8'))),
               }
+        if preload and self.preload_modules:
+            env['CALIBRE_WORKER_PRELOAD'] = environ_item(','.join(self.preload_modules))
         cw = self.do_launch(env, gui, redirect_output, rfile, job_name=job_name)
         if isinstance(cw, string_or_bytes):
             raise CriticalError('Failed to launch worker process:\n'+cw)
@@ -235,8 +257,11 @@ class Server(Thread):
         w = Worker(env, gui=gui, job_name=job_name)
 
         try:
-            w(redirect_output=redirect_output)
-            conn = eintr_retry_call(self.listener.accept)
+            # Workers can be launched from multiple threads, ensure each
+            # gets its own connection
+            with self._worker_launch_lock:
+                w(redirect_output=redirect_output)
+                conn = eintr_retry_call(self.listener.accept)
             if conn is None:
                 raise Exception('Failed to launch worker process')
         except BaseException:
@@ -248,15 +273,47 @@ class Server(Thread):
             return traceback.format_exc()
         return ConnectedWorker(w, conn, rfile)
 
+    def prewarm_worker(self):
+        ' Launch a spare worker in the background, for use by the next job '
+        def launch():
+            try:
+                w = self.launch_worker(preload=True)
+            except Exception:
+                import traceback
+                traceback.print_exc()
+                w = None
+            self.spare_workers.put(w)
+        t = Thread(target=launch, name='PrewarmWorker')
+        t.daemon = True
+        t.start()
+
+    def get_worker(self):
+        if self.prewarm:
+            try:
+                w = self.spare_workers.get(timeout=self.SPARE_WORKER_TIMEOUT)
+            except Empty:
+                # The spare worker will be used by the next job
+                return self.launch_worker()
+            self.prewarm_worker()
+            if w is not None and w.is_alive:
+                return w
+            if w is not None:
+                w.kill()
+        return self.launch_worker()
+
     def add_job(self, job):
         job.done2 = self.notify_on_job_done
         self.add_jobs_queue.put(job)
 
     def run_job(self, job, gui=True, redirect_output=False):
+        st = time.time()
         w = self.launch_worker(gui=gui, redirect_output=redirect_output, job_name=getattr(job, 'name', None))
+        job.worker_startup_time = time.time() - st
         w.start_job(job)
 
     def run(self):
+        if self.prewarm:
+            self.prewarm_worker()
         while True:
             try:
                 job = self.add_jobs_queue.get(True, 0.2)
@@ -308,7 +365,8 @@ class Server(Thread):
                     job.killed = job.failed = True
                     job.result = None
                 else:
-                    worker = self.launch_worker()
+                    worker = self.get_worker()
+                    job.worker_startup_time = time.time() - job.start_time
                     worker.start_job(job)
                     self.workers.append(worker)
                     job.log_path = worker.log_path
@@ -389,6 +447,13 @@ class Server(Thread):
                 worker.kill()
             except:
                 pass
+        while True:
+            try:
+                worker = self.spare_workers.get_nowait()
+            except Empty:
+                break
+            if worker is not None:
+                worker.kill()
 
     def __enter__(self):
         return self
@@ -187,6 +187,15 @@ def main():
     key     = unhexlify(os.environ['CALIBRE_WORKER_KEY'])
     resultf = unhexlify(os.environ['CALIBRE_WORKER_RESULT']).decode('utf-8')
     with closing(Client(address, authkey=key)) as conn:
+        preload = os.environ.get('CALIBRE_WORKER_PRELOAD')
+        if preload:
+            # We are a prewarmed worker, import modules while waiting for
+            # the job
+            for mod in preload.split(','):
+                try:
+                    importlib.import_module(mod)
+                except Exception:
+                    pass
         name, args, kwargs, desc = eintr_retry_call(conn.recv)
         if desc:
             prints(desc)
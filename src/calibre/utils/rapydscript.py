@@ -233,6 +233,10 @@ def compile_srv():
 
     atomic_write('index-generated.html', html)
     atomic_write('calibre.appcache', manifest)
+    # Precompress the main page, so that the server does not have to compress
+    # it at runtime
+    from calibre.srv.http_response import precompress_file
+    precompress_file(os.path.join(base, 'index-generated.html'))
 
 # }}}
 
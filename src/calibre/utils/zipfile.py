@@ -11,7 +11,7 @@ from tempfile import SpooledTemporaryFile
 from calibre import sanitize_file_name2
 from calibre.constants import filesystem_encoding
 from calibre.ebooks.chardet import detect
-from polyglot.builtins import unicode_type, string_or_bytes
+from polyglot.builtins import iteritems, unicode_type, string_or_bytes
 
 try:
     import zlib  # We may need its compression method
@@ -1463,11 +1463,153 @@ class ZipFile:
         self.fp = None
 
 
+# Header id of the extra field used to pad local file headers when a file is
+# replaced in place. This is the id used by Android's zipalign for padding.
+PADDING_EXTRA_ID = 0xD935
+
+
+def padding_extra(size):
+    ' Return an extra field of size bytes (0 or 4 to 65535) that contains only padding '
+    if not size:
+        return b''
+    return struct.pack('<HH', PADDING_EXTRA_ID, size - 4) + b'\0' * (size - 4)
+
+
+def replace_in_place(zipstream, replacements, add_missing=False):
+    '''
+    Replace files in the zip file in zipstream without re-creating it. The new
+    data for a file is written over its existing entry, which is possible only
+    if the compressed data is no larger than the existing entry. Any space left
+    over becomes padding in the extra field of the local header, so that the
+    entries remain contiguous. Missing files are added after the last entry,
+    then the central directory is re-written. The result is verified, if
+    verification fails the original bytes are restored.
+
+    :param replacements: Mapping of names to bytes
+    :param add_missing: If a replacement does not exist in the zip file, it is
+                        added.
+
+    :return: True if the files were replaced, False if zipstream was left
+             unchanged because the files could not be replaced in place.
+    '''
+    try:
+        ZipFile(zipstream, 'r').close()
+    except BadZipfile:
+        return False
+    zf = ZipFile(zipstream, 'a')
+    infos = zf.infolist()
+    end_of_data = zf.start_dir
+    names = zf.namelist()
+    if (not infos or len(set(names)) != len(names) or end_of_data > ZIP64_LIMIT or
+            len(infos) + len(replacements) >= ZIP_FILECOUNT_LIMIT):
+        return False
+    for zi in infos:
+        if zi.file_size > ZIP64_LIMIT or zi.compress_size > ZIP64_LIMIT or zi.header_offset >= end_of_data:
+            return False
+    missing = [name for name in replacements if name not in zf.NameToInfo] if add_missing else []
+
+    # Each entry extends up to the start of the next entry
+    offsets = sorted(set(zi.header_offset for zi in infos)) + [end_of_data]
+    entry_end = {o:offsets[i+1] for i, o in enumerate(offsets[:-1])}
+
+    plan = []
+    for zi in infos:
+        if zi.filename not in replacements:
+            continue
+        if zi.flag_bits & 0x1 or zi.compress_type not in (ZIP_STORED, ZIP_DEFLATED):
+            return False
+        raw = replacements[zi.filename]
+        available = entry_end[zi.header_offset] - zi.header_offset - sizeFileHeader - len(zi.orig_filename)
+        for level in (zlib.Z_DEFAULT_COMPRESSION, zlib.Z_BEST_COMPRESSION):
+            data = raw
+            if zi.compress_type == ZIP_DEFLATED:
+                co = zlib.compressobj(level, zlib.DEFLATED, -15)
+                data = co.compress(raw) + co.flush()
+            padding = available - len(data)
+            if padding == 0 or 4 <= padding <= 0xFFFF or zi.compress_type == ZIP_STORED:
+                break
+        if padding != 0 and not 4 <= padding <= 0xFFFF:
+            return False
+        if padding and zi.filename == 'mimetype':
+            # The OCF spec does not allow an extra field for the mimetype file
+            return False
+        plan.append((zi, raw, data, padding))
+
+    # The entries that follow the replaced ones, these are the first to be
+    # damaged if the new data does not fit
+    neighbours = {entry_end[zi.header_offset] for zi, _, _, _ in plan}
+    neighbours = [zi for zi in infos if zi.header_offset in neighbours and zi.filename not in replacements]
+
+    # Save everything that is going to be overwritten, and the neighbours
+    zipstream.seek(0, 2)
+    original_size = zipstream.tell()
+    saved = []
+    regions = [(zi.header_offset, entry_end[zi.header_offset] - zi.header_offset)
+               for zi in [x[0] for x in plan] + neighbours]
+    regions.append((end_of_data, original_size - end_of_data))
+    for offset, size in regions:
+        zipstream.seek(offset)
+        saved.append((offset, zipstream.read(size)))
+
+    try:
+        for zi in infos:
+            if not zi.flag_bits & 0x800:
+                # Keep the names exactly as they are in the local headers
+                zi.filename = zi.orig_filename
+        headers = []
+        for zi, raw, data, padding in plan:
+            extra = zi.extra
+            zi.CRC = crc32(raw) & 0xffffffff
+            zi.file_size, zi.compress_size = len(raw), len(data)
+            zi.flag_bits &= ~0x08
+            zi.extra = padding_extra(padding)
+            header = zi.FileHeader()
+            zi.extra = extra
+            if len(header) + len(data) != entry_end[zi.header_offset] - zi.header_offset:
+                raise BadZipfile('The new data for %s does not fit in its entry' % zi.filename)
+            headers.append(header)
+        for header, (zi, raw, data, padding) in zip(headers, plan):
+            zipstream.seek(zi.header_offset)
+            zipstream.write(header)
+            zipstream.write(data)
+        zipstream.seek(end_of_data)
+        for name in missing:
+            zf.writestr(name, replacements[name])
+        zf._didModify = True
+        zf.close()
+        zipstream.truncate()
+        zipstream.flush()
+
+        # Verify the result
+        z = ZipFile(zipstream, 'r')
+        if z.namelist() != names + missing:
+            raise BadZipfile('Incorrect list of files after replacement')
+        for zi in neighbours:
+            # Reading checks the local header and the CRC of the data
+            z.read(zi.filename)
+        for name, raw in iteritems(replacements):
+            if (name in z.NameToInfo) and z.read(name) != raw:
+                raise BadZipfile('Replacing %s failed' % name)
+    except Exception:
+        import traceback
+        traceback.print_exc()
+        zf.fp = None
+        for offset, data in saved:
+            zipstream.seek(offset)
+            zipstream.write(data)
+        zipstream.truncate(original_size)
+        zipstream.flush()
+        return False
+    return True
+
+
 def safe_replace(zipstream, name, datastream, extra_replacements={},
         add_missing=False):
     '''
-    Replace a file in a zip file in a safe manner. This proceeds by extracting
-    and re-creating the zipfile. This is necessary because :method:`ZipFile.replace`
+    Replace a file in a zip file in a safe manner. When possible, the files
+    are replaced in place, see :func:`replace_in_place`, leaving the rest of
+    the archive untouched. Otherwise this proceeds by extracting and
+    re-creating the zipfile. This is necessary because :method:`ZipFile.replace`
     sometimes created corrupted zip files.
 
 
@@ -1481,31 +1623,30 @@ def safe_replace(zipstream, name, datastream, extra_replacements={},
                         are not created.
 
     '''
-    z = ZipFile(zipstream, 'r')
     replacements = {name:datastream}
     replacements.update(extra_replacements)
+    for name, r in tuple(iteritems(replacements)):
+        if not isinstance(r, bytes):
+            replacements[name] = r.read()
+    if replace_in_place(zipstream, replacements, add_missing=add_missing):
+        return
+    z = ZipFile(zipstream, 'r')
     names = frozenset(replacements.keys())
     found = set([])
 
-    def rbytes(name):
-        r = replacements[name]
-        if not isinstance(r, bytes):
-            r = r.read()
-        return r
-
     with SpooledTemporaryFile(max_size=100*1024*1024) as temp:
         ztemp = ZipFile(temp, 'w')
         for obj in z.infolist():
             if isinstance(obj.filename, unicode_type):
                 obj.flag_bits |= 0x16  # Set isUTF-8 bit
             if obj.filename in names:
-                ztemp.writestr(obj, rbytes(obj.filename))
+                ztemp.writestr(obj, replacements[obj.filename])
                 found.add(obj.filename)
             else:
                 ztemp.writestr(obj, z.read_raw(obj), raw_bytes=True)
         if add_missing:
             for name in names - found:
-                ztemp.writestr(name, rbytes(name))
+                ztemp.writestr(name, replacements[name])
         ztemp.close()
         z.close()
         temp.seek(0)
@@ -1615,6 +1756,78 @@ class PyZipFile(ZipFile):
         return (fname, archivename)
 
 
+def find_tests():
+    import unittest
+
+    class ZipFileTest(unittest.TestCase):
+
+        def create(self):
+            buf = io.BytesIO()
+            with ZipFile(buf, 'w') as zf:
+                zi = ZipInfo('mimetype')
+                zi.compress_type = ZIP_STORED
+                zf.writestr(zi, b'application/epub+zip')
+                zf.writestr('content.opf', b'<package>' + b'a' * 5000 + b'</package>')
+                zf.writestr('image.jpg', os.urandom(50000))
+                zf.writestr('text.html', b'<p>text</p>' * 100)
+            return buf
+
+        def test_safe_replace(self):
+            ae = self.assertEqual
+            buf = self.create()
+            original = buf.getvalue()
+            image = ZipFile(buf).read('image.jpg')
+
+            # Smaller data is replaced in place
+            opf = b'<package>' + b'b' * 100 + b'</package>'
+            safe_replace(buf, 'content.opf', io.BytesIO(opf))
+            ae(len(buf.getvalue()), len(original))
+            zf = ZipFile(buf)
+            ae(zf.read('content.opf'), opf)
+            ae(zf.read('image.jpg'), image)
+            ae(zf.namelist(), ['mimetype', 'content.opf', 'image.jpg', 'text.html'])
+            ae(original[:zf.getinfo('content.opf').header_offset], buf.getvalue()[:zf.getinfo('content.opf').header_offset])
+            self.assertIsNone(zf.testzip())
+
+            # Missing files are added after the last entry
+            self.assertTrue(replace_in_place(buf, {'text.html': b'x', 'new.txt': b'new'}, add_missing=True))
+            zf = ZipFile(buf)
+            ae(zf.namelist(), ['mimetype', 'content.opf', 'image.jpg', 'text.html', 'new.txt'])
+            ae(zf.read('text.html'), b'x'), ae(zf.read('new.txt'), b'new')
+            self.assertIsNone(zf.testzip())
+
+            # Larger data cannot be replaced in place and the archive is left unchanged
+            before = buf.getvalue()
+            large = os.urandom(20000)
+            self.assertFalse(replace_in_place(buf, {'content.opf': large}))
+            ae(buf.getvalue(), before)
+
+            # Data that overruns its entry and damages the next one is detected
+            # and the archive is restored
+            class Overrun(io.BytesIO):
+                armed, corrupt = True, False
+
+                def write(self, b):
+                    if self.corrupt:
+                        self.corrupt = False
+                        b += b'\0' * 6000
+                    elif self.armed and b.startswith(stringFileHeader) and b'content.opf' in b:
+                        self.armed, self.corrupt = False, True
+                    return io.BytesIO.write(self, b)
+
+            damaged = Overrun(before)
+            self.assertFalse(replace_in_place(damaged, {'content.opf': b'<package/>'}))
+            ae(damaged.getvalue(), before)
+
+            safe_replace(buf, 'content.opf', io.BytesIO(large))
+            zf = ZipFile(buf)
+            ae(zf.read('content.opf'), large)
+            ae(zf.read('image.jpg'), image)
+            self.assertIsNone(zf.testzip())
+
+    return unittest.defaultTestLoader.loadTestsFromTestCase(ZipFileTest)
+
+
 def main(args=None):
     import textwrap
     USAGE=textwrap.dedent("""\
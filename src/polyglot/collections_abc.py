@@ -0,0 +1,10 @@
+#!/usr/bin/env python2
+# vim:fileencoding=utf-8
+# License: GPL v3 Copyright: 2019, Kovid Goyal <kovid at kovidgoyal.net>
+
+from polyglot.builtins import is_py3
+
+if is_py3:
+    from collections.abc import Iterable, Mapping, MutableMapping, MutableSequence, MutableSet, Sequence, Set  # noqa
+else:
+    from collections import Iterable, Mapping, MutableMapping, MutableSequence, MutableSet, Sequence, Set  # noqa